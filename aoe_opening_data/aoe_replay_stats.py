@@ -1,15 +1,27 @@
 import os
 import sys
+import argparse
 import math
 import json
 import io
+import hashlib
+import mmap
+import pickle
+import tempfile
 import time
+import struct
+import numpy as np
 from mgz import header, fast, enums, const, summary
 from mgz.enums import OperationEnum
+from mgz.common.map import extract_from_instructions, get_modes, lookup_name
+from mgz.reference import get_dataset
 from construct import Byte
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager, ExitStack
 from enum import Enum
 
+import stage_timing
+
 PARSER_VERSION = 10  #Move to flags system for better resolution
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -32,6 +44,13 @@ class EventType(Enum):
     TRIBUTE = 5
 
 
+class EventCategory(Enum):
+    Other = 0
+    Known = 1  # in our local id records
+    UniqueUnit = 2
+    Ignored = 3  # buildings we dont care about
+
+
 class OpeningType(Enum):
     # Dark Age
     Unknown = 0
@@ -83,6 +102,82 @@ class OpeningType(Enum):
     ScoutsSkirms = 0x4400
 
 
+class Transition(Enum):
+    Age = 1  # move to age, flag if clicked before FAST_CASTLE_TIME
+    Stop = 2  # we arent parsing anything in imp
+    Flag = 3  # flag if in age
+    DrushMaa = 4  # flag if in age and the only thing so far is a drush
+    Mill = 5
+    Barracks = 6
+    Militia = 7  # premill/postmill drush in dark age or maa in feudal, first unit only
+    FirstUnit = 8  # opening if first unit made otherwise followup, once each
+    Eagle = 9  # flag if in age, counts as the opening unit
+
+
+FAST_CASTLE_TIME = 920000  #15:20 in millis, if clicking now you will land at 18:00
+
+# Plain ints so the classifier loop doesnt compare enum members
+AGE = Transition.Age.value
+STOP = Transition.Stop.value
+FLAG = Transition.Flag.value
+DRUSH_MAA = Transition.DrushMaa.value
+MILL = Transition.Mill.value
+BARRACKS = Transition.Barracks.value
+MILITIA = Transition.Militia.value
+FIRST_UNIT = Transition.FirstUnit.value
+EAGLE = Transition.Eagle.value
+
+# (event type, name or category, transition, age, flags)
+# Names are resolved to ids through the lookup tables, category rules only
+# apply to ids no named rule claimed
+OPENING_RULES = [
+    (EventType.TECH, "Feudal Age", Transition.Age, 1, ()),
+    (EventType.TECH, "Castle Age", Transition.Age, 2,
+     (OpeningType.FastCastle.value,)),
+    (EventType.TECH, "Imperial Age", Transition.Stop, 3, ()),
+    (EventType.TECH, "Crossbowman", Transition.Flag, 2,
+     (OpeningType.CastleCrossbows.value,)),
+    (EventType.TECH, "Elite Skirmisher", Transition.Flag, 2,
+     (OpeningType.CastleEliteSkirm.value,)),
+    (EventType.TECH, "Pikeman", Transition.Flag, 2,
+     (OpeningType.CastlePikemen.value,)),
+    (EventType.TECH, "Eagle Warrior", Transition.Flag, 2,
+     (OpeningType.CastleEagles.value,)),
+    (EventType.TECH, "Man-at-Arms", Transition.DrushMaa, 1,
+     (OpeningType.Maa.value,)),
+    (EventType.BUILDING, "Mill", Transition.Mill, 0, ()),
+    (EventType.BUILDING, "Barracks", Transition.Barracks, 0, ()),
+    (EventType.BUILDING, "Watch Tower", Transition.Flag, 1,
+     (OpeningType.FeudalTowers.value,)),
+    (EventType.UNIT, "Militia", Transition.Militia, 0,
+     (OpeningType.PremillDrush.value, OpeningType.PostmillDrush.value,
+      OpeningType.Maa.value)),
+    (EventType.UNIT, "Archer", Transition.FirstUnit, 1,
+     (OpeningType.FeudalArcherOpening.value,
+      OpeningType.FeudalArcherFollowup.value)),
+    (EventType.UNIT, "Scout", Transition.FirstUnit, 1,
+     (OpeningType.FeudalScoutOpening.value,
+      OpeningType.FeudalScoutFollowup.value)),
+    (EventType.UNIT, "Skirmisher", Transition.FirstUnit, 1,
+     (OpeningType.FeudalSkirmOpening.value,
+      OpeningType.FeudalSkirmFollowup.value)),
+    (EventType.UNIT, "Eagle", Transition.Eagle, 1,
+     (OpeningType.FeudalEagles.value,)),
+    (EventType.UNIT, "Knight", Transition.Flag, 2,
+     (OpeningType.CastleKnights.value,)),
+    (EventType.UNIT, "Camel", Transition.Flag, 2,
+     (OpeningType.CastleCamels.value,)),
+    (EventType.UNIT, "Mangonel", Transition.Flag, 2,
+     (OpeningType.CastleSiege.value,)),
+    (EventType.UNIT, "Scorpion", Transition.Flag, 2,
+     (OpeningType.CastleSiege.value,)),
+    (EventType.UNIT, "Battering Ram", Transition.Flag, 2,
+     (OpeningType.CastleSiege.value,)),
+    (EventType.UNIT, EventCategory.UniqueUnit, Transition.Flag, 2,
+     (OpeningType.CastleUU.value,)),
+]
+
+
 # UNIT IDS #
 UNIT_IDS = {
     "Archer": 4,
@@ -240,6 +335,13 @@ ID_BUILDINGS = {v: k for k, v in BUILDING_IDS.items()}
 ID_IGNORE = {v: k for k, v in IGNORE_IDS.items()}
 ID_TECHS = {v: k for k, v in TECH_IDS.items()}
 
+# Age up techs and the age they lead into, dark = 0, feudal, castle, imp
+AGE_TECH_IDS = {
+    TECH_IDS["Feudal Age"]: 1,
+    TECH_IDS["Castle Age"]: 2,
+    TECH_IDS["Imperial Age"]: 3,
+}
+
 
 with open(os.path.join(SCRIPT_DIR, 'aoe2techtree', 'data', 'data.json')) as json_file:
     AOE_DATA = json.load(json_file)
@@ -247,11 +349,172 @@ with open(os.path.join(SCRIPT_DIR, 'aoe2techtree', 'data', 'data.json')) as json
 with open(os.path.join(SCRIPT_DIR, 'aoe2techtree', 'data', 'locales', 'en', 'strings.json')) as json_file:
     AOE_STRINGS = json.load(json_file)
 
-def item_in_list(event, list):
-    for i in list:
-        if i == event:
-            return i
-    return False
+# Everything we need to know about a unit, tech or building id in one access
+EventInfo = namedtuple('EventInfo',
+                       ['name', 'internal_name', 'duration', 'category'])
+
+
+def build_event_lookup(event_type, data_key, local_ids):
+    # Dense list indexed by id, resolved the same way a replay names its events
+    aoe_entries = AOE_DATA["data"][data_key]
+    size = max([int(i) for i in aoe_entries] + list(local_ids) +
+               list(ID_UNIQUE_UNITS) + list(ID_IGNORE)) + 1
+    table = []
+    for i in range(size):
+        name = str(i)
+        internal_name = None
+        duration = 0
+        category = EventCategory.Other
+        if str(i) in aoe_entries:
+            entry = aoe_entries[str(i)]
+            name = AOE_STRINGS.get(str(entry["LanguageNameId"]), name)
+            internal_name = entry["internal_name"]
+            if event_type == EventType.TECH:
+                duration = int(entry["ResearchTime"]) * 1000
+        if i in local_ids:
+            name = local_ids[i]
+            category = EventCategory.Known
+        elif event_type == EventType.UNIT and i in ID_UNIQUE_UNITS:
+            category = EventCategory.UniqueUnit
+        elif event_type == EventType.BUILDING and i in ID_IGNORE:
+            category = EventCategory.Ignored
+        table.append(EventInfo(name, internal_name, duration, category))
+    return table
+
+
+EVENT_LOOKUP = {
+    EventType.UNIT: build_event_lookup(EventType.UNIT, "units", ID_UNITS),
+    EventType.TECH: build_event_lookup(EventType.TECH, "techs", ID_TECHS),
+    EventType.BUILDING: build_event_lookup(EventType.BUILDING, "buildings",
+                                           ID_BUILDINGS),
+}
+
+
+def lookup_event(event_type, id):
+    table = EVENT_LOOKUP[event_type]
+    if 0 <= id < len(table):
+        return table[id]
+    return EventInfo(str(id), None, 0, EventCategory.Other)
+
+
+def compile_opening_rules(rules):
+    # (event type value, id) -> (transition value, age, flags)
+    transitions = {}
+    for by_category in (False, True):
+        for event_type, match, transition, age, flags in rules:
+            if isinstance(match, EventCategory) != by_category:
+                continue
+            table = EVENT_LOOKUP[event_type]
+            for i in range(len(table)):
+                if (table[i].category if by_category else table[i].name) == match:
+                    transitions.setdefault((event_type.value, i),
+                                           (transition.value, age, flags))
+    return transitions
+
+
+OPENING_TRANSITIONS = compile_opening_rules(OPENING_RULES)
+
+# Each group of opening rules has a version and the opening bits it decides.
+# Bump a group's version when its rules change and reanalysis only rewrites
+# those bits on rows classified with an older version of the group. Groups
+# share the opening position (first unit made), a change that moves it has
+# to bump every group it can affect
+OPENING_RULE_VERSIONS = {
+    "drush": (1, OpeningType.PremillDrush.value | OpeningType.PostmillDrush.value),
+    "maa": (1, OpeningType.Maa.value),
+    "feudal_units": (1, OpeningType.FeudalArcherOpening.value |
+                     OpeningType.FeudalScoutOpening.value |
+                     OpeningType.FeudalSkirmOpening.value |
+                     OpeningType.FeudalArcherFollowup.value |
+                     OpeningType.FeudalScoutFollowup.value |
+                     OpeningType.FeudalSkirmFollowup.value |
+                     OpeningType.FeudalEagles.value),
+    "feudal_towers": (2, OpeningType.FeudalTowers.value),
+    "fast_castle": (1, OpeningType.FastCastle.value),
+    "castle_units": (1, OpeningType.CastleCrossbows.value |
+                     OpeningType.CastleKnights.value |
+                     OpeningType.CastleSiege.value |
+                     OpeningType.CastleEliteSkirm.value |
+                     OpeningType.CastlePikemen.value |
+                     OpeningType.CastleEagles.value |
+                     OpeningType.CastleCamels.value |
+                     OpeningType.CastleUU.value),
+}
+# Rows classified with PARSER_VERSION but no stored rule versions predate
+# rule versions and count as this version of every group
+BASE_RULE_VERSION = 1
+
+
+def outdated_opening_mask(parser_version, rule_versions):
+    # Opening bits of a match player that need recomputing, rule_versions is
+    # {rule: version} as stored for it
+    if parser_version < PARSER_VERSION:
+        return OpeningType.DidNothing.value
+    mask = 0
+    for rule, (version, rule_mask) in OPENING_RULE_VERSIONS.items():
+        if rule_versions.get(rule, BASE_RULE_VERSION) < version:
+            mask |= rule_mask
+    return mask
+
+
+def merge_opening(old_opening, new_opening, mask):
+    # Keep old_opening outside mask and take new_opening inside it
+    if mask == OpeningType.DidNothing.value:
+        return new_opening
+    if old_opening == OpeningType.DidNothing.value:
+        old_opening = 0
+    if new_opening == OpeningType.DidNothing.value:
+        new_opening = 0
+    opening = (old_opening & ~mask) | (new_opening & mask)
+    if opening == 0:
+        return OpeningType.DidNothing.value
+    return opening
+
+
+CIVS = {int(value) - 10270: name for name, value in AOE_DATA["civ_names"].items()}
+CIV_IDS = {v: k for k, v in CIVS.items()}
+
+
+class PlayerEvents:
+    # Chronological event list for one player. Researches are indexed by
+    # (event_type, name) so clicking a tech again replaces the earlier click in
+    # constant time, the old slot is blanked and skipped when iterating
+
+    def __init__(self):
+        self.events = []
+        self.research_index = {}
+        self.removed = 0
+
+    def __iter__(self):
+        for event in self.events:
+            if event is not None:
+                yield event
+
+    def __len__(self):
+        return len(self.events) - self.removed
+
+    def append(self, event):
+        self.events.append(event)
+
+    def replace_research(self, event):
+        key = (event.event_type, event.name)
+        index = self.research_index.get(key)
+        if index is not None:
+            self.events[index] = None
+            self.removed += 1
+        self.research_index[key] = len(self.events)
+        self.events.append(event)
+        if self.removed > 64 and self.removed * 2 > len(self.events):
+            self.compact()
+
+    def compact(self):
+        self.events = [event for event in self.events if event is not None]
+        self.removed = 0
+        self.research_index = {}
+        for i in range(len(self.events)):
+            if self.events[i].event_type == EventType.TECH:
+                self.research_index[(self.events[i].event_type,
+                                     self.events[i].name)] = i
 
 
 def output_time(millis):
@@ -260,19 +523,34 @@ def output_time(millis):
     return str(minutes).zfill(2) + ":" + str(seconds).zfill(2)
 
 
+# Only the parts of a DE_TRIBUTE action we print
+Tribute = namedtuple('Tribute',
+                     ['player_id_to', 'food', 'wood', 'gold', 'stone'])
+
+
 class Event:
+    # Slotted since a replay makes thousands of these, the name is only
+    # resolved when something asks for it
+    __slots__ = ('event_type', 'id', '_name', 'timestamp', 'duration', 'data')
 
-    def __init__(self, event_type, id, name, timestamp, duration=0, data={}):
+    def __init__(self, event_type, id, name, timestamp, duration=0, data=None):
         self.event_type = event_type
         self.id = id
-        if name is None:
-            self.update_name()
-        else:
-            self.name = name
+        self._name = name
         self.timestamp = timestamp
         self.duration = duration
         self.data = data
 
+    @property
+    def name(self):
+        if self._name is None:
+            self.update_name()
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+
     def __str__(self):
         ret_string = f'{self.event_type.name}: {self.name} {output_time(self.timestamp)}'
         if self.event_type == EventType.TRIBUTE:
@@ -290,26 +568,13 @@ class Event:
         return hash(self.event_type.name)
 
     def update_name(self):
-        if self.event_type == EventType.UNIT:
-            if self.id in ID_UNITS:
-                self.name = ID_UNITS[self.id]
-            elif str(self.id) in AOE_DATA["data"]["units"]:
+        if self.event_type in EVENT_LOOKUP:
+            info = lookup_event(self.event_type, self.id)
+            if info.category == EventCategory.Known:
+                self.name = info.name
+            elif info.internal_name is not None:
                 #unit not found in local records
-                self.name = f'{AOE_DATA["data"]["units"][str(self.id)]["internal_name"]} ({self.id})'
-            else:
-                self.name = str(self.id)
-        elif self.event_type == EventType.TECH:
-            if self.id in ID_TECHS:
-                self.name = ID_TECHS[self.id]
-            elif str(self.id) in AOE_DATA["data"]["techs"]:
-                self.name = f'{AOE_DATA["data"]["techs"][str(self.id)]["internal_name"]} ({self.id})'
-            else:
-                self.name = str(self.id)
-        elif self.event_type == EventType.BUILDING:
-            if self.id in ID_BUILDINGS:
-                self.name = ID_BUILDINGS[self.id]
-            elif str(self.id) in AOE_DATA["data"]["buildings"]:
-                self.name = f'{AOE_DATA["data"]["buildings"][str(self.id)]["internal_name"]} ({self.id})'
+                self.name = f'{info.internal_name} ({self.id})'
             else:
                 self.name = str(self.id)
         elif self.event_type == EventType.RESIGN:
@@ -318,281 +583,755 @@ class Event:
             self.name = 'Tribute'
 
 
-def parse_replay(data):
-    if type(data) is io.BytesIO:
-        eof = len(data.getvalue())
-    elif type(data) is str:
-        data = open(data, 'rb')
-        eof = os.fstat(data.fileno()).st_size
-    else:
-        eof = os.fstat(data.fileno()).st_size
+REPLAY_CACHE_MAX_BYTES = 1 << 30
+# Part of every cache key, bump it when what is pickled or how the cutoffs
+# cut changes
+REPLAY_CACHE_FORMAT = 2
+
+# What a cache hit returns in place of the parsed header, the fields
+# parse_match reads and nothing else
+HeaderSummary = namedtuple('HeaderSummary', ['save_version', 'de'])
+DeHeaderSummary = namedtuple('DeHeaderSummary', ['selected_map_id', 'players'])
+PlayerHeaderSummary = namedtuple('PlayerHeaderSummary', ['civ_id'])
+
+
+def summarize_header(h):
+    # plain tuples so the pickle doesn't depend on the classes above
+    if h.de is None:
+        return h.save_version, None, None
+    return (h.save_version, h.de.selected_map_id,
+            [player.civ_id for player in h.de.players])
+
+
+def header_summary(fields):
+    save_version, map_id, civ_ids = fields
+    de = None
+    if civ_ids is not None:
+        de = DeHeaderSummary(map_id, [PlayerHeaderSummary(civ_id)
+                                      for civ_id in civ_ids])
+    return HeaderSummary(save_version, de)
+
+
+class ReplayCache:
+    # On disk cache of parsed replays keyed by a hash of the replay bytes, the
+    # cache format, the parser version and the cutoffs. One pickle per replay
+    # holding the events, loser ids and a summary of the header, the file
+    # mtime is the LRU clock and the oldest files go once max_bytes is passed.
+    # Several processes can share a directory, entries are written atomically
+
+    def __init__(self, directory, max_bytes=REPLAY_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for path, mtime, size in self.entries())
+
+    def entries(self):
+        for file in os.listdir(self.directory):
+            if not file.endswith('.pickle'):
+                continue
+            path = os.path.join(self.directory, file)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield path, stat.st_mtime_ns, stat.st_size
+
+    def key(self, stream, eof, cutoff_time, cutoff_age):
+        # hashes the rest of the stream and puts it back where it was
+        start = stream.tell()
+        digest = hashlib.blake2b(
+            f'{REPLAY_CACHE_FORMAT}:{PARSER_VERSION}:{cutoff_time}:{cutoff_age}'.encode(),
+            digest_size=20)
+        while stream.tell() < eof:
+            digest.update(stream.read(1 << 20))
+        stream.seek(start)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                players, loser_ids, header_fields = pickle.load(f)
+            os.utime(self.path(key))
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        player_events = []
+        for events in players:
+            player = PlayerEvents()
+            for event_type, id, name, timestamp, duration, data in events:
+                player.append(Event(EventType(event_type), id, name, timestamp,
+                                    duration, data))
+            player_events.append(player)
+        return player_events, header_summary(header_fields), loser_ids
+
+    def put(self, key, players, h, loser_ids):
+        players = [[(event.event_type.value, event.id, event.name,
+                     event.timestamp, event.duration, event.data)
+                    for event in player] for player in players]
+        # a failed write only costs the cache entry, never the parse
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((players, loser_ids, summarize_header(h)), f,
+                            pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, self.path(key))
+        except OSError as e:
+            print(f'Replay cache: {e}', file=sys.stderr)
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            return
+        self.size += size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # other processes write here too so go by what is really on disk
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        self.size = sum(size for path, mtime, size in entries)
+        for path, mtime, size in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.size}
+
+
+#set with enable_replay_cache, parse_replay uses it when set
+replay_cache = None
+
+
+def enable_replay_cache(directory, max_bytes=REPLAY_CACHE_MAX_BYTES):
+    global replay_cache
+    replay_cache = ReplayCache(directory, max_bytes)
+    return replay_cache
+
+
+def take_cache_counts():
+    # (hits, misses) of this process since the last call. Workers send them
+    # back with their results, like stage_timing.take()
+    if replay_cache is None:
+        return 0, 0
+    counts = replay_cache.hits, replay_cache.misses
+    replay_cache.hits = replay_cache.misses = 0
+    return counts
+
+
+def parse_replay(data, cutoff_time=None, cutoff_age=None, selective=None):
+    # cutoff_time (millis) and cutoff_age (1 = feudal ... 3 = imp) end the
+    # opening window early, cutoff_age once every player's age up research
+    # has finished. Once the window closes only resignations are looked for
+    # so loser ids stay correct. The returned events, and so the match actions
+    # stored from them, stop at the window. data is a path, file object,
+    # BytesIO or the raw bytes of the replay, see open_replay. selective
+    # overrides SELECTIVE_DECODING. With the replay cache on, a hit returns a
+    # HeaderSummary in place of the header. Stage times go to stage_timing,
+    # the parse_actions stage includes the op_loop one since the body is read
+    # lazily
+    with open_replay(data) as (data, eof):
+        if replay_cache is None:
+            h, actions = stream_actions(data, cutoff_time, cutoff_age,
+                                        selective)
+            with stage_timing.stage('parse_actions'):
+                players, civs, loser_ids = parse_actions(actions)
+            return players, h, civs, loser_ids
+        return parse_replay_cached(data, eof, cutoff_time, cutoff_age,
+                                   selective)
+
+
+def parse_replay_cached(data, eof, cutoff_time, cutoff_age, selective):
+    with stage_timing.stage('cache_lookup', eof - data.tell()):
+        key = replay_cache.key(data, eof, cutoff_time, cutoff_age)
+        cached = replay_cache.get(key)
+    if cached is not None:
+        # h is a HeaderSummary, the header itself isn't parsed again
+        players, h, loser_ids = cached
+        return players, h, CIVS, loser_ids
+    h, actions = stream_actions(data, cutoff_time, cutoff_age, selective)
+    with stage_timing.stage('parse_actions'):
+        players, civs, loser_ids = parse_actions(actions)
+    with stage_timing.stage('cache_store'):
+        replay_cache.put(key, players, h, loser_ids)
+    return players, h, civs, loser_ids
+
+
+def stream_replay(data, cutoff_time=None, cutoff_age=None, selective=None):
+    # Same as parse_replay but hands back (player_id, event) pairs as the body
+    # is read instead of the finished per player lists
+    h, actions = stream_actions(data, cutoff_time, cutoff_age, selective)
+    return h, iter_events(actions)
+
+
+class ReplayBuffer:
+    # Minimal read only file interface over a buffer (bytes, bytearray,
+    # memoryview, mmap) so a replay already in memory is parsed in place.
+    # Only the slices handed out by read() are copied
+    def __init__(self, buffer):
+        self.view = memoryview(buffer).cast('B')
+        self.pos = 0
 
-    h = header.parse_stream(data)
-    fast.meta(data)
-    actions = []
+    def __len__(self):
+        return len(self.view)
+
+    def read(self, size=-1):
+        start = self.pos
+        if size is None or size < 0:
+            self.pos = len(self.view)
+        else:
+            self.pos = min(start + size, len(self.view))
+        return self.view[start:self.pos].tobytes()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
+def map_file(fileno):
+    # mmap refuses empty files, an empty stream gets them to the header
+    # parser which fails on them like on any other truncated replay
+    size = os.fstat(fileno).st_size
+    if size == 0:
+        return io.BytesIO(), 0
+    return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ), size
+
+
+@contextmanager
+def open_replay(data):
+    # Yields a readable stream over the replay and where its body ends.
+    # Paths and real files are memory mapped and unmapped on exit, in memory
+    # replays are read in place and never copied as a whole
+    if isinstance(data, (str, os.PathLike)):
+        with open(data, 'rb') as f:
+            stream, eof = map_file(f.fileno())
+        with stream:
+            yield stream, eof
+        return
+    if isinstance(data, mmap.mmap):
+        yield data, len(data)
+        return
+    if isinstance(data, bytes):
+        # a BytesIO made from bytes shares them until written to
+        yield io.BytesIO(data), len(data)
+        return
+    if isinstance(data, (bytearray, memoryview)):
+        stream = ReplayBuffer(data)
+        yield stream, len(stream)
+        return
+    if not isinstance(data, io.BytesIO):
+        try:
+            fileno = data.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            fileno = None
+        if fileno is not None:
+            stream, eof = map_file(fileno)
+            with stream:
+                stream.seek(data.tell())
+                yield stream, eof
+            return
+    # BytesIO and any other seekable stream, getvalue() would copy a BytesIO
+    position = data.tell()
+    eof = data.seek(0, io.SEEK_END)
+    data.seek(position)
+    yield data, eof
+
+
+def stream_actions(data, cutoff_time=None, cutoff_age=None, selective=None):
+    # The actions are read lazily, a replay opened here stays open until they
+    # run out or the iterator is closed
+    with ExitStack() as stack:
+        data, eof = stack.enter_context(open_replay(data))
+        with stage_timing.stage('header') as sample:
+            start = data.tell()
+            h = header.parse_stream(data)
+            sample.bytes = data.tell() - start
+        with stage_timing.stage('meta'):
+            fast.meta(data)
+        replay = stack.pop_all()
+    num_players = 0
+    if cutoff_age is not None and h.de is not None:
+        # DE headers always have 8 player slots, only the first num_players
+        # are real and would ever age up
+        num_players = h.de.num_players
+    actions = read_actions(data, eof, num_players, cutoff_time, cutoff_age,
+                           selective)
+    actions = stage_timing.timed_iter('op_loop', actions, eof - data.tell())
+    return h, closing_iter(actions, replay)
+
+
+def closing_iter(iterable, resource):
+    with resource:
+        yield from iterable
+
+
+ReplayMetadata = namedtuple('ReplayMetadata',
+                            ['map_id', 'map_name', 'save_version', 'players'])
+PlayerMetadata = namedtuple('PlayerMetadata',
+                            ['name', 'civ_id', 'civ', 'color', 'team_id'])
+
+METADATA_CACHE_SIZE = 4096
+metadata_cache = OrderedDict()
+map_references = {}
+
+
+def get_map_reference(h):
+    # The dataset FullSummary looks builtin map ids up in, picked the same way
+    # as mgz.summary.dataset.get_dataset_data. Loaded once per dataset
+    sample = h.initial.players[0].attributes.player_stats
+    mod = h.de.dlc_ids if h.de is not None else None
+    if 'mod' in sample:
+        mod = (sample.mod.get('id'), sample.mod.get('version'))
+    key = (h.version, tuple(mod) if mod is not None else None)
+    if key not in map_references:
+        map_references[key] = get_dataset(h.version, mod)[1]
+    return map_references[key]
+
+
+def get_map_name(h):
+    # The name FullSummary.get_map() reports, but from the header alone.
+    # Raises ValueError where get_map() would, e.g. for a builtin map id the
+    # dataset doesn't know
+    if h.hd is not None:
+        map_id = h.hd.selected_map_id
+    elif h.de is not None:
+        map_id = h.de.resolved_map_id
+    else:
+        map_id = h.scenario.game_settings.map_id
+    instructions = h.scenario.messages.instructions
+    if instructions == b'\x00':
+        raise ValueError('empty instructions')
+    name = extract_from_instructions(instructions)[2]
+    name = lookup_name(map_id, name, h.version, get_map_reference(h))[0]
+    return get_modes(name)[0].strip()
+
+
+def read_replay_metadata(data):
+    # Header only parse for triage, the body is never read. Results are kept
+    # in an LRU keyed by a hash of the header bytes so the same replay is only
+    # parsed once no matter how it is passed in
+    with open_replay(data) as (stream, eof):
+        return read_stream_metadata(stream)
+
+
+def read_stream_metadata(stream):
+    start = stream.tell()
+    header_length, = struct.unpack('<I', stream.read(4))
+    stream.seek(start)
+    key = hashlib.blake2b(stream.read(header_length), digest_size=16).digest()
+    stream.seek(start)
+    if key in metadata_cache:
+        metadata_cache.move_to_end(key)
+        return metadata_cache[key]
+
+    h = header.parse_stream(stream)
+    stream.seek(start)
+    players = []
+    if h.de is not None:
+        for player in h.de.players[:h.de.num_players]:
+            players.append(PlayerMetadata(player.name.value.decode(),
+                                          player.civ_id,
+                                          CIVS.get(player.civ_id),
+                                          Color(player.color_id).name
+                                          if 0 <= player.color_id < 8 else None,
+                                          player.resolved_team_id))
+    map_id = h.de.selected_map_id if h.de is not None else None
+    try:
+        map_name = get_map_name(h)
+    except ValueError:
+        # an unknown builtin map or no instructions, the rest is still good
+        # enough to triage on
+        map_name = None
+    metadata = ReplayMetadata(map_id, map_name, h.save_version,
+                              tuple(players))
+
+    metadata_cache[key] = metadata
+    if len(metadata_cache) > METADATA_CACHE_SIZE:
+        metadata_cache.popitem(last=False)
+    return metadata
+
+
+# The only actions iter_events turns into events. Postgame is decoded since
+# it runs to the end of the file instead of its stated length
+DECODED_ACTIONS = frozenset(action.value for action in (
+    fast.Action.DE_QUEUE, fast.Action.RESEARCH, fast.Action.BUILD,
+    fast.Action.RESIGN, fast.Action.DE_TRIBUTE, fast.Action.POSTGAME))
+RESIGN_ACTIONS = frozenset((fast.Action.RESIGN.value,
+                            fast.Action.POSTGAME.value))
+
+# Opt in to skipping every other action undecoded, False decodes every op
+# with fast.operation which is handy to cross check against
+SELECTIVE_DECODING = False
+
+
+def read_selected_operation(data, eof, actions):
+    # Same as fast.operation except only the op and action headers of actions
+    # not in actions are read, their payload is skipped and None returned. A
+    # payload running past eof raises EOFError as fast.operation would
+    try:
+        op_id, = struct.unpack('<I', data.read(4))
+        if op_id != fast.Operation.ACTION.value:
+            data.seek(-4, 1)
+            return fast.operation(data)
+        length, action_id = struct.unpack('<IB', data.read(5))
+        if action_id in actions:
+            data.seek(-5, 1)
+            return fast.Operation.ACTION, fast.action(data)
+    except struct.error:
+        raise EOFError
+    #skip payload and sequence number
+    if data.tell() + length - 1 + 4 > eof:
+        raise EOFError
+    data.seek(length - 1 + 4, 1)
+    return None
+
+
+def read_actions(data, eof, num_players=0, cutoff_time=None, cutoff_age=None,
+                 selective=None):
+    # Yields (operation, time) for every action op one at a time so nothing
+    # past the current op is held in memory. With selective only the actions
+    # parse_actions uses are yielded
+    if selective is None:
+        selective = SELECTIVE_DECODING
+    # when each player reaches cutoff_age, the last click of the age up plus
+    # its research time. A click after a cancel starts the research over
+    age_reached = {}
+    cutoff_age_time = None
     time = 0
     while data.tell() < eof:
-        o = fast.operation(data)
+        if cutoff_time is not None and time > cutoff_time:
+            yield from scan_for_resignations(data, eof, time)
+            return
+        if cutoff_age_time is not None and time >= cutoff_age_time:
+            yield from scan_for_resignations(data, eof, time)
+            return
+        if selective:
+            o = read_selected_operation(data, eof, DECODED_ACTIONS)
+            if o is None:
+                continue
+        else:
+            o = fast.operation(data)
         if o[0] == fast.Operation.ACTION:
-            actions.append((o, time))
+            yield o, time
+            if num_players and o[1][0] == fast.Action.RESEARCH:
+                technology_id = o[1][1]["technology_id"]
+                if AGE_TECH_IDS.get(technology_id, 0) >= cutoff_age:
+                    age_reached[o[1][1]["player_id"]] = time + lookup_event(
+                        EventType.TECH, technology_id).duration
+                    if len(age_reached) >= num_players:
+                        cutoff_age_time = max(age_reached.values())
+        elif o[0] == fast.Operation.SYNC:
+            time += o[1][0]
+
+
+def scan_for_resignations(data, eof, time):
+    # Cheap pass over the rest of the body, only the op and action headers are
+    # read and every action other than a resignation is skipped
+    while data.tell() < eof:
+        o = read_selected_operation(data, eof, RESIGN_ACTIONS)
+        if o is None:
+            continue
+        if o[0] == fast.Operation.ACTION:
+            yield o, time
         elif o[0] == fast.Operation.SYNC:
             time += o[1][0]
-    players, civs, loser_ids = parse_actions(actions)
-    return players, h, civs, loser_ids
 
 
 def parse_actions(actions):
     #lazily init players
     players = []
     for i in range(9):
-        #List of event objects for each player
-        players.append([])
+        #Event store for each player
+        players.append(PlayerEvents())
 
-    #build civ dict
-    civs = {}
-    for name, value in AOE_DATA["civ_names"].items():
-        civs[int(value) - 10270] = name
+    loser_ids = []
+    for player_id, event in iter_events(actions):
+        if event.event_type == EventType.TECH:
+            # only keep the latest click of each tech
+            players[player_id].replace_research(event)
+            continue
+        if event.event_type == EventType.RESIGN:
+            loser_ids.append(player_id)
+        players[player_id].append(event)
 
+    return players, CIVS, loser_ids
 
-    loser_ids = []
+
+def iter_events(actions):
+    # Turns (operation, time) pairs into (player_id, event) pairs as they arrive
     for o, time in actions:
         if o[1][0] == fast.Action.DE_QUEUE:
             player_id = o[1][1]["player_id"]
             unit_id = o[1][1]["unit_id"]
-            event = None
-            if unit_id in ID_UNITS:
-                event = Event(EventType.UNIT, unit_id, ID_UNITS[unit_id],
-                              time)
-            elif str(unit_id) in AOE_DATA["data"]["units"]:
-                #unit not found in local records
-                name_id = AOE_DATA["data"]["units"][str(unit_id)]["LanguageNameId"]
-                name = AOE_STRINGS[str(name_id)]
-                event = Event(EventType.UNIT, unit_id, name, time)
-            else:
-                name = f'{unit_id}'
-                event = Event(EventType.UNIT, unit_id, name, time)
-            players[player_id].append(event)
+            info = lookup_event(EventType.UNIT, unit_id)
+            yield player_id, Event(EventType.UNIT, unit_id, info.name, time)
 
         elif o[1][0] == fast.Action.RESEARCH:
             player_id = o[1][1]["player_id"]
             technology_id = o[1][1]["technology_id"]
-            string = ""
-            duration = 0
-            if str(technology_id) in AOE_DATA["data"]["techs"]:
-                duration = int(AOE_DATA["data"]["techs"][str(technology_id)]
-                               ["ResearchTime"]) * 1000
-            event = None
-            if technology_id in ID_TECHS:
-                event = Event(EventType.TECH, technology_id,
-                              ID_TECHS[technology_id], time, duration)
-            elif str(technology_id) in AOE_DATA["data"]["techs"]:
-                name_id = AOE_DATA["data"]["techs"][str(technology_id)]["LanguageNameId"]
-                name = AOE_STRINGS[str(name_id)]
-                event = Event(EventType.TECH, technology_id, name, time,
-                              duration)
-            else:
-                name = f'{technology_id}'
-                event = Event(EventType.TECH, technology_id, name, time,
-                              duration)
-
-            found_item = item_in_list(event, players[player_id])
-            if found_item:
-                players[player_id].remove(found_item)
-
-            players[player_id].append(event)
+            info = lookup_event(EventType.TECH, technology_id)
+            yield player_id, Event(EventType.TECH, technology_id, info.name,
+                                   time, info.duration)
 
         elif o[1][0] == fast.Action.BUILD:
             player_id = o[1][1]["player_id"]
             building_id = o[1][1]["building_id"]
-            string = ""
-            if building_id in ID_BUILDINGS:
-                event = Event(EventType.BUILDING, building_id,
-                              ID_BUILDINGS[building_id], time)
-            elif str(building_id) in AOE_DATA["data"]["buildings"]:
-                name_id = AOE_DATA["data"]["buildings"][str(building_id)]["LanguageNameId"]
-                name = AOE_STRINGS[str(name_id)]
-                event = Event(EventType.BUILDING, building_id, name, time)
-            else:
-                name = f'{building_id}'
-                event = Event(EventType.BUILDING, building_id, name, time)
-            players[player_id].append(event)
+            info = lookup_event(EventType.BUILDING, building_id)
+            yield player_id, Event(EventType.BUILDING, building_id, info.name,
+                                   time)
 
         elif o[1][0] == fast.Action.RESIGN:
             name = 'Resignation'
             player_id = o[1][1]["player_id"]
             event = Event(EventType.RESIGN, 0, name, time)
-            players[player_id].append(event)
-            loser_ids.append(player_id)
+            yield player_id, event
 
         elif o[1][0] == fast.Action.DE_TRIBUTE:
             name = 'Tribute'
             player_id = o[1][1]["player_id"]
-            player_id_to = o[1][1]["player_id_to"]
+            tribute = Tribute(o[1][1]["player_id_to"], o[1][1]["food"],
+                              o[1][1]["wood"], o[1][1]["gold"],
+                              o[1][1]["stone"])
             event = Event(EventType.TRIBUTE,
                           0,
                           name,
                           time,
-                          data = o[1][1])
-            players[player_id].append(event)
-
-    return players, civs, loser_ids
+                          data = tribute)
+            yield player_id, event
 
 
 def guess_strategy(players):
     player_strategies = []
-    for player in players:
-        openings = 0
-        index = 0
-        current_age = 0  # dark = 0, feudal, castle, imp
-        mill_built = False
-        opening_found = False
-        has_archers = False
-        has_scouts = False
-        has_skirms = False
-        barracks_before_mill = False
-
-        for event in player:
-            if event.event_type == EventType.TECH:
-                if event.name == "Feudal Age":
-                    current_age = 1
-                elif event.name == "Castle Age":
-                    current_age = 2
-                    if event.timestamp < 920000:  #15:20 in millis, if clicking now you will land at 18:00
-                        openings |= OpeningType.FastCastle.value
-                elif event.name == "Imperial Age":
-                    #We arent parsing anything in imp
-                    current_age = 3
-                    break
-                elif event.name == "Crossbowman":
-                    if current_age == 2:
-                        openings |= OpeningType.CastleCrossbows.value
-                elif event.name == "Elite Skirmisher":
-                    if current_age == 2:
-                        openings |= OpeningType.CastleEliteSkirm.value
-                elif event.name == "Pikeman":
-                    if current_age == 2:
-                        openings |= OpeningType.CastlePikemen.value
-                elif event.name == "Eagle Warrior":
-                    if current_age == 2:
-                        openings |= OpeningType.CastleEagles.value
-                elif event.name == "Man-at-Arms":
-                    if current_age == 1 and (
-                            openings == 0x1 or openings == 0x2
-                    ):  #specific case where maa is a followup to drush
-                        openings |= OpeningType.Maa.value
-
-            elif event.event_type == EventType.BUILDING:
-                if event.name == "Mill":
-                    mill_built = True
-
-                if event.name == "Barracks":
-                    if mill_built:
-                        barracks_before_mill = False
-                    else:
-                        barracks_before_mill = True
-
-                if event.name == "Tower":
-                    if current_age == 1:
-                        openings |= OpeningType.FeudalTowers.value
-
-            elif event.event_type == EventType.UNIT:
-                if event.name == "Militia":
-                    if opening_found:
-                        continue
-                    if current_age == 0 and barracks_before_mill:
-                        openings |= OpeningType.PremillDrush.value
-                    elif current_age == 0:
-                        openings |= OpeningType.PostmillDrush.value
-                    elif current_age == 1:
-                        openings |= OpeningType.Maa.value
-                    opening_found = True  # First unit made is the opening, otherwise we dont care about maa i think
-
-                elif event.name == "Archer":
-                    # Only count archers once
-                    if has_archers:
-                        continue
-                    has_archers = True
-                    if current_age == 1:
-                        if not opening_found:
-                            openings |= OpeningType.FeudalArcherOpening.value
-                        else:
-                            openings |= OpeningType.FeudalArcherFollowup.value
-                        # Use xbow tech to determine if they did xbow in castle
-                    opening_found = True  # First unit made is the opening, otherwise we dont care about maa i think
-
-                elif event.name == "Scout":
-                    # Only count scouts once
-                    if has_scouts:
-                        continue
-                    has_scouts = True
-                    if current_age == 1:
-                        if not opening_found:
-                            openings |= OpeningType.FeudalScoutOpening.value
-                        else:
-                            openings |= OpeningType.FeudalScoutFollowup.value
-                    opening_found = True  # First unit made is the opening, otherwise we dont care about maa i think
-
-                elif event.name == "Skirmisher":
-                    # Only count skirms once
-                    if has_skirms:
-                        continue
-                    has_skirms = True
-                    if current_age == 1:
-                        if not opening_found:
-                            openings |= OpeningType.FeudalSkirmOpening.value
-                        else:
-                            openings |= OpeningType.FeudalSkirmFollowup.value
-                        # Use eskirm tech to determine if they did xbow in castle
-                    opening_found = True  # First unit made is the opening, otherwise we dont care about maa i think
-
-                elif event.name == "Eagle":
-                    if current_age == 1:
-                        openings |= OpeningType.FeudalEagles.value
-                    opening_found = True
-
-                elif event.name == "Knight":
-                    if current_age == 2:
-                        openings |= OpeningType.CastleKnights.value
-
-                elif event.name == "Camel":
-                    if current_age == 2:
-                        openings |= OpeningType.CastleCamels.value
-
-                elif event.name == "Mangonel":
-                    if current_age == 2:
-                        openings |= OpeningType.CastleSiege.value
-
-                elif event.name == "Scorpion":
-                    if current_age == 2:
-                        openings |= OpeningType.CastleSiege.value
-
-                elif event.name == "Battering Ram":
-                    if current_age == 2:
-                        openings |= OpeningType.CastleSiege.value
-                elif event.id in ID_UNIQUE_UNITS:
-                    if current_age == 2:
-                        openings |= OpeningType.CastleUU.value
-        if openings == 0:
-            openings = OpeningType.DidNothing.value
-        if player:
-            player_strategies.append(openings)
+    with stage_timing.stage('guess_strategy'):
+        for player in players:
+            openings = classify_opening(
+                (event.event_type.value, event.id, event.timestamp)
+                for event in player)
+            if player:
+                player_strategies.append(openings)
     return player_strategies
 
-def print_to_csv(players,
-                 summary,
-                 header,
-                 civs,
-                 player_strategies,
-                 include_units = True,
-                 only_unique_units = True,
-                 include_buildings = True,
-                 only_unique_buildings = True,
-                 include_techs = True,
-                 include_player_openings = True):
-    #output to std with information
-    ret_string = ""
+
+def classify_opening(actions):
+    # actions are (event type value, id, timestamp) in the order they happened,
+    # runs the compiled OPENING_RULES over them and returns the opening flags
+    transitions = OPENING_TRANSITIONS
+    openings = 0
+    current_age = 0  # dark = 0, feudal, castle, imp
+    mill_built = False
+    opening_found = False
+    barracks_before_mill = False
+    units_seen = 0
+    for event_type, id, timestamp in actions:
+        rule = transitions.get((event_type, id))
+        if rule is None:
+            continue
+        transition, age, flags = rule
+        if transition == FLAG:
+            if current_age == age:
+                openings |= flags[0]
+        elif transition == AGE:
+            current_age = age
+            if flags and timestamp < FAST_CASTLE_TIME:
+                openings |= flags[0]
+        elif transition == STOP:
+            break
+        elif transition == FIRST_UNIT:
+            # Only count each unit once
+            if units_seen & flags[0]:
+                continue
+            units_seen |= flags[0]
+            if current_age == age:
+                if not opening_found:
+                    openings |= flags[0]
+                else:
+                    openings |= flags[1]
+            opening_found = True
+        elif transition == MILITIA:
+            if opening_found:
+                continue
+            if current_age == age and barracks_before_mill:
+                openings |= flags[0]
+            elif current_age == age:
+                openings |= flags[1]
+            elif current_age == age + 1:
+                openings |= flags[2]
+            opening_found = True  # First unit made is the opening
+        elif transition == EAGLE:
+            if current_age == age:
+                openings |= flags[0]
+            opening_found = True
+        elif transition == DRUSH_MAA:
+            #specific case where maa is a followup to drush
+            if current_age == age and (
+                    openings == OpeningType.PremillDrush.value
+                    or openings == OpeningType.PostmillDrush.value):
+                openings |= flags[0]
+        elif transition == MILL:
+            mill_built = True
+        elif transition == BARRACKS:
+            barracks_before_mill = not mill_built
+    if openings == 0:
+        openings = OpeningType.DidNothing.value
+    return openings
+
+
+def compile_opening_arrays(transitions):
+    # Dense arrays of the compiled rules for classify_openings_batch, a rule
+    # index per (event type, id) and the rule fields per rule index. Index 0
+    # means no rule
+    stride = max(i for event_type, i in transitions) + 1
+    rule_index = np.zeros((max(e.value for e in EventType) + 1) * stride,
+                          dtype=np.int32)
+    rules = [(0, 0, 0, 0, 0)]
+    for (event_type, i), (transition, age, flags) in transitions.items():
+        flags = tuple(flags) + (0,) * (3 - len(flags))
+        rule = (transition, age) + flags
+        if rule not in rules:
+            rules.append(rule)
+        rule_index[event_type * stride + i] = rules.index(rule)
+    rules = np.array(rules, dtype=np.int64)
+    return stride, rule_index, rules
+
+
+OPENING_STRIDE, OPENING_RULE_INDEX, OPENING_RULE_FIELDS = compile_opening_arrays(
+    OPENING_TRANSITIONS)
+
+
+def classify_openings_batch(group_ids, event_types, event_ids, times):
+    # Same result as classify_opening for many players at once. The four
+    # arrays hold one action each, grouped by group_ids (a match player id)
+    # and in the order the actions happened inside each group. Returns the
+    # group ids and their opening flags
+    group_ids = np.asarray(group_ids, dtype=np.int64)
+    event_types = np.asarray(event_types, dtype=np.int64)
+    event_ids = np.asarray(event_ids, dtype=np.int64)
+    times = np.asarray(times, dtype=np.int64)
+    if len(group_ids) == 0:
+        return group_ids, np.zeros(0, dtype=np.int64)
+    all_starts = np.ones(len(group_ids), dtype=bool)
+    all_starts[1:] = group_ids[1:] != group_ids[:-1]
+    openings = np.full(np.count_nonzero(all_starts),
+                       OpeningType.DidNothing.value, dtype=np.int64)
+
+    # Most actions (villagers, houses, farms...) have no rule, drop them first
+    in_table = (event_ids >= 0) & (event_ids < OPENING_STRIDE)
+    key = np.where(in_table, event_types * OPENING_STRIDE + event_ids, 0)
+    rule = OPENING_RULE_INDEX[key]
+    keep = rule != 0
+    if not keep.any():
+        return group_ids[all_starts], openings
+    all_group = np.cumsum(all_starts) - 1
+    rule = rule[keep]
+    times = times[keep]
+    kept_group = all_group[keep]
+    n = len(rule)
+
+    starts_mask = np.ones(n, dtype=bool)
+    starts_mask[1:] = kept_group[1:] != kept_group[:-1]
+    starts = np.flatnonzero(starts_mask)
+    group = np.cumsum(starts_mask) - 1
+    group_start = starts[group]
+    pos = np.arange(n)
+    transition, age, flag0, flag1, flag2 = OPENING_RULE_FIELDS[rule].T
+
+    def first_pos(mask):
+        # first position per group where mask is set, n if never
+        return np.minimum.reduceat(np.where(mask, pos, n), starts)
+
+    def last_pos_before(mask):
+        # last position at or before each event where mask is set, -1 if none
+        # in the same group
+        last = np.maximum.accumulate(np.where(mask, pos, -1))
+        return np.where(last >= group_start, last, -1)
+
+    #nothing after clicking imp counts
+    valid = pos < first_pos(transition == STOP)[group]
+
+    last_age = last_pos_before(transition == AGE)
+    current_age = np.where(last_age >= 0, age[last_age], 0)
+
+    emit = np.zeros(n, dtype=np.int64)
+    is_age = valid & (transition == AGE)
+    emit |= np.where(is_age & (times < FAST_CASTLE_TIME), flag0, 0)
+    in_age = valid & (current_age == age)
+    emit |= np.where(in_age & ((transition == FLAG) | (transition == EAGLE)),
+                     flag0, 0)
+
+    # First unit made is the opening
+    opening_pos = first_pos(valid & ((transition == FIRST_UNIT) |
+                                     (transition == MILITIA) |
+                                     (transition == EAGLE)))[group]
+
+    militia = valid & (transition == MILITIA) & (pos == opening_pos)
+    last_barracks = last_pos_before(transition == BARRACKS)
+    first_mill = first_pos(valid & (transition == MILL))[group]
+    barracks_before_mill = (last_barracks >= 0) & (first_mill > last_barracks)
+    emit |= np.where(militia & (current_age == age) & barracks_before_mill,
+                     flag0, 0)
+    emit |= np.where(militia & (current_age == age) & ~barracks_before_mill,
+                     flag1, 0)
+    emit |= np.where(militia & (current_age == age + 1), flag2, 0)
+
+    # Only count each unit once
+    first_unit = valid & (transition == FIRST_UNIT)
+    unit_key = group[first_unit] * (1 << 32) + flag0[first_unit]
+    first_seen = pos[first_unit][np.unique(unit_key, return_index=True)[1]]
+    first_unit[:] = False
+    first_unit[first_seen] = True
+    first_unit &= current_age == age
+    emit |= np.where(first_unit & (pos == opening_pos), flag0, 0)
+    emit |= np.where(first_unit & (pos != opening_pos), flag1, 0)
+
+    #specific case where maa is a followup to drush
+    drush = (emit == OpeningType.PremillDrush.value) | (
+        emit == OpeningType.PostmillDrush.value)
+    first_drush = first_pos(drush)[group]
+    first_other = first_pos((emit != 0) & ~drush)[group]
+    drush_maa = valid & (transition == DRUSH_MAA) & (current_age == age)
+    emit |= np.where(
+        drush_maa & (first_drush < pos) & (pos < first_other), flag0, 0)
+
+    found = np.bitwise_or.reduceat(emit, starts)
+    found[found == 0] = OpeningType.DidNothing.value
+    openings[kept_group[starts]] = found
+    return group_ids[all_starts], openings
+
+
+def write_csv_report(writer,
+                     players,
+                     header,
+                     civs,
+                     player_strategies,
+                     include_units = True,
+                     only_unique_units = True,
+                     include_buildings = True,
+                     only_unique_buildings = True,
+                     include_techs = True,
+                     include_player_openings = True):
+    #rows are written to writer (anything with write()) as they are made
     if header is not None:
-        ret_string += 'Map, ' + summary.get_map()["name"] + "\n"
+        writer.write('Map, ' + get_map_name(header) + "\n")
     #go through once to get the game data before doing individual player stuff
     player_data = {}
     team_dict = {}
@@ -648,14 +1387,14 @@ def print_to_csv(players,
           elif unique_action.event_type == EventType.RESIGN:
               player_data[player_num]["victory_state"] = "Lost"
         if include_units or include_buildings or include_techs or include_player_openings:
-            ret_string += f'\n\n{player_data[player_num]["name"]}:\n'
+            writer.write(f'\n\n{player_data[player_num]["name"]}:\n')
         if include_player_openings:
-            ret_string += "Opening Flags: " + hex(player_strategies[player_num]) + "\n"
+            writer.write("Opening Flags: " + hex(player_strategies[player_num]) + "\n")
             for opening in OpeningType:
                 if opening == OpeningType.Unknown:
                     continue
                 if (player_strategies[player_num] & opening.value) == opening.value:
-                    ret_string += f'{opening}, {hex(opening.value)}\n'
+                    writer.write(f'{opening}, {hex(opening.value)}\n')
         if only_unique_units:
             temp_set = set()
             units = [x for x in units if x not in temp_set and not temp_set.add(x)]
@@ -664,45 +1403,63 @@ def print_to_csv(players,
             temp_set = set()
             buildings = [x for x in buildings if x not in temp_set and not temp_set.add(x)]
         if units and include_units:
-            ret_string += '\nUnit, Time\n'
+            writer.write('\nUnit, Time\n')
             for unit in units:
-                ret_string += f'{unit.name}, {output_time(unit.timestamp)}\n'
+                writer.write(f'{unit.name}, {output_time(unit.timestamp)}\n')
 
         if buildings and include_buildings:
-            ret_string += '\nBuilding, Time\n'
+            writer.write('\nBuilding, Time\n')
             for building in buildings:
-                ret_string += f'{building.name}, {output_time(building.timestamp)}\n'
+                writer.write(f'{building.name}, {output_time(building.timestamp)}\n')
 
         if techs and include_techs:
-            ret_string += "\nTech, Time, Est Completion\n"
+            writer.write("\nTech, Time, Est Completion\n")
             for tech in techs:
-                ret_string += f'{tech.name}, {output_time(tech.timestamp)}, {output_time(tech.timestamp + tech.duration)}\n'
+                writer.write(f'{tech.name}, {output_time(tech.timestamp)}, {output_time(tech.timestamp + tech.duration)}\n')
 
         for tribute in tributes:
-            if (tribute.data["food"] > 0  or
-                tribute.data["wood"] > 0  or
-                tribute.data["gold"] > 0  or
-                tribute.data["stone"] > 0) :
+            if (tribute.data.food > 0  or
+                tribute.data.wood > 0  or
+                tribute.data.gold > 0  or
+                tribute.data.stone > 0) :
                 tribute_strings.append((tribute.timestamp,
                         f'{player_data[player_num]["name"]}, '
-                        f'{header.de.players[tribute.data["player_id_to"]-1].name.value.decode()}, '
+                        f'{header.de.players[tribute.data.player_id_to-1].name.value.decode()}, '
                         f'{output_time(tribute.timestamp)}, '
-                        f'{tribute.data["food"]}, '
-                        f'{tribute.data["wood"]}, '
-                        f'{tribute.data["gold"]}, '
-                        f'{tribute.data["stone"]}\n'))
+                        f'{tribute.data.food}, '
+                        f'{tribute.data.wood}, '
+                        f'{tribute.data.gold}, '
+                        f'{tribute.data.stone}\n'))
         player_num += 1
-    ret_string += f'\nName, Civ, Color, Team, Victory State, Feudal Time, Castle Time, Imp Time\n'
+    writer.write(f'\nName, Civ, Color, Team, Victory State, Feudal Time, Castle Time, Imp Time\n')
     for player in player_data.values():
-        ret_string += f'{player["name"]}, {player["civ"]}, {player["color"]}, {player["team"]}, {player["victory_state"]}, {player["feudal"]}, {player["castle"]} ,{player["imp"]}\n'
+        writer.write(f'{player["name"]}, {player["civ"]}, {player["color"]}, {player["team"]}, {player["victory_state"]}, {player["feudal"]}, {player["castle"]} ,{player["imp"]}\n')
     if tribute_strings:
         tribute_strings = sorted(tribute_strings, key=lambda x:x[0])
-        ret_string += "\nTribute from Player, To Player, Time, Food, Wood, Gold, Stone\n"
+        writer.write("\nTribute from Player, To Player, Time, Food, Wood, Gold, Stone\n")
         for tribute in tribute_strings:
-          ret_string += tribute[1]
-    ret_string += f'\nDuration, {output_time(last_timestamp)}\n'
+          writer.write(tribute[1])
+    writer.write(f'\nDuration, {output_time(last_timestamp)}\n')
 
-    return ret_string
+
+def print_to_csv(players,
+                 summary,
+                 header,
+                 civs,
+                 player_strategies,
+                 include_units = True,
+                 only_unique_units = True,
+                 include_buildings = True,
+                 only_unique_buildings = True,
+                 include_techs = True,
+                 include_player_openings = True):
+    #summary is unused, the map name now comes from the header
+    output = io.StringIO()
+    write_csv_report(output, players, header, civs, player_strategies,
+                     include_units, only_unique_units, include_buildings,
+                     only_unique_buildings, include_techs,
+                     include_player_openings)
+    return output.getvalue()
 
 
 def print_events(players, header, civs, player_strategies):
@@ -728,9 +1485,55 @@ def print_events(players, header, civs, player_strategies):
         print("\n")
 
 
+def replay_paths(paths):
+    #expand directories into the replays inside them
+    for path in paths:
+        if os.path.isdir(path):
+            for file in sorted(os.listdir(path)):
+                file = os.path.join(path, file)
+                if os.path.isfile(file):
+                    yield file
+        else:
+            yield path
+
+
 if __name__ == '__main__':
-    players, header, civs, loser_ids = parse_replay(sys.argv[1])
-    player_strategies = guess_strategy(players)
-    with open(sys.argv[1], "rb") as handle:
-      game_summary = summary.FullSummary(handle)
-    print(print_to_csv(players, game_summary, header, civs, player_strategies, False, False, False, False, False, False))
+    parser = argparse.ArgumentParser(
+        description="Print a csv report for each replay, one pass per replay")
+    parser.add_argument("replays",
+                        help="Replay files or folders of replays",
+                        nargs='+',
+                        type=str)
+    parser.add_argument("-o",
+                        "--output",
+                        help="Write the report to this file instead of stdout",
+                        type=str)
+    parser.add_argument("-d",
+                        "--detailed",
+                        help="Include openings, units, buildings and techs per player",
+                        action='store_true')
+    parser.add_argument("-t",
+                        "--timing",
+                        help="Print per stage timings at exit",
+                        action='store_true')
+    args = parser.parse_args()
+    if args.timing:
+        stage_timing.enable()
+
+    writer = sys.stdout if args.output is None else open(args.output, 'w')
+    paths = list(replay_paths(args.replays))
+    for path in paths:
+        if len(paths) > 1:
+            writer.write(f'Replay, {path}\n')
+        try:
+            players, header, civs, loser_ids = parse_replay(path)
+        except Exception as e:
+            print(f'{path}: {e}', file=sys.stderr)
+            continue
+        player_strategies = guess_strategy(players)
+        write_csv_report(writer, players, header, civs, player_strategies,
+                         args.detailed, args.detailed, args.detailed,
+                         args.detailed, args.detailed, args.detailed)
+        writer.write('\n')
+    if writer is not sys.stdout:
+        writer.close()
@@ -1,11 +1,9 @@
-import os
-import json
 import argparse
+import sys
+import numpy as np
 
 import parse_replays_and_store_in_db
-from aoe_replay_stats import output_time, OpeningType
-
-aoe_data = None
+from aoe_replay_stats import output_time, lookup_event, OpeningType, EventType, CIVS, CIV_IDS
 
 Allowed_Strategies = [
     #General Openings
@@ -112,14 +110,37 @@ Allowed_Strategies = [
 ]
 
 
+#Above this share of the matches it is faster to walk match_players in match
+#order and look each match up than to go through the elo index, which visits
+#them at random
+ELO_INDEX_SHARE = 0.2
+elo_shares = {}
+
+
+def elo_index_helps(minimum_elo, maximum_elo):
+    key = (parse_replays_and_store_in_db.DB_FILE, minimum_elo, maximum_elo)
+    if key not in elo_shares:
+        in_range, total = parse_replays_and_store_in_db.connect_and_return(
+            """SELECT (SELECT COUNT(*) FROM matches
+                        WHERE average_elo > ? AND average_elo < ?),
+                      (SELECT COUNT(*) FROM matches);""",
+            (minimum_elo, maximum_elo))[0]
+        elo_shares[key] = in_range / total if total else 1
+    return elo_shares[key] <= ELO_INDEX_SHARE
+
+
 def arguments_to_query_string(match_table_tag, match_playera_table_tag,
                               match_playerb_table_tag, minimum_elo, maximum_elo,
                               map_ids, include_civ_ids, clamp_civ_ids,
                               no_mirror, exclude_civ_ids, include_ladder_ids,
                               include_patch_ids, clamp_player1, player_ids):
     string = "("
-    string += f'{match_table_tag}.average_elo > {minimum_elo}\n'
-    string += f'  AND {match_table_tag}.average_elo < {maximum_elo}\n'
+    elo = f'{match_table_tag}.average_elo'
+    if not elo_index_helps(minimum_elo, maximum_elo):
+        #unary + keeps the planner off the elo index
+        elo = '+' + elo
+    string += f'{elo} > {minimum_elo}\n'
+    string += f'  AND {elo} < {maximum_elo}\n'
 
     # ignore all did nothing results
     string += f'  AND {match_playera_table_tag}.opening_id != {OpeningType.DidNothing.value}\n'
@@ -202,97 +223,151 @@ def arguments_to_query_string(match_table_tag, match_playera_table_tag,
     return string
 
 
-def opening_matchups(opening1, opening2, minimum_elo, maximum_elo, map_ids,
-                     include_civ_ids, clamp_civ_ids, no_mirror, exclude_civ_ids,
-                     include_ladder_ids, include_patch_ids, player_ids):
-    query = """SELECT
-               sum(CASE WHEN a.victory = 1 OR a.victory = 0 THEN 1 ELSE 0 END) as Total,
-               sum(CASE WHEN a.victory = 1 THEN 1 ELSE 0 END) AS FirstOpeningWins,
-               sum(CASE WHEN b.victory = 1 THEN 1 ELSE 0 END) AS SecondOpeningWins,
-               sum(CASE WHEN a.victory = -1 THEN 1 ELSE 0 END) AS Unknown
-             FROM matches m
-             JOIN match_players a ON a.match_id = m.id
-             JOIN match_players b ON b.match_id = m.id
-             WHERE ("""
-    #strat 1 inclusions
-    count = 0
-    for i in opening1[1]:
-        count += 1
-        query += f'((a.opening_id & {i}) = {i})'
-        if count < len(opening1[1]):
-            query += ' OR '
-    query += ') AND ('
-    #Strat 1 exclusions
-    count = 0
-    for i in opening1[2]:
-        count += 1
-        query += f'(NOT (a.opening_id & {i}))'
-        if count < len(opening1[2]):
-            query += ' AND '
-    query += ') AND ('
-    #strat 2 inclusions
-    count = 0
-    for i in opening2[1]:
-        count += 1
-        query += f'((b.opening_id & {i}) = {i})'
-        if count < len(opening2[1]):
-            query += ' OR '
-    query += ') AND ('
-    #Strat 2 exclusions
-    count = 0
-    for i in opening2[2]:
-        count += 1
-        query += f'(NOT (b.opening_id & {i}))'
-        if count < len(opening2[2]):
-            query += ' AND '
+# Answer from the opening_matchup_counts aggregates whenever the filters allow
+# it, -r forces the raw self joins
+USE_AGGREGATES = True
+# filters already checked, every matchup of a report asks for the same ones
+aggregate_filters = {}
+
+
+def aggregate_filter(minimum_elo, maximum_elo, map_ids, include_civ_ids,
+                     clamp_civ_ids, no_mirror, exclude_civ_ids,
+                     include_ladder_ids, include_patch_ids, clamp_player1,
+                     player_ids):
+    #arguments_to_query_string over the aggregates (aliased g), None if only
+    #a raw scan can answer it. Players aren't aggregated
+    if not USE_AGGREGATES or player_ids is not None:
+        return None
+    key = repr((parse_replays_and_store_in_db.DB_FILE, minimum_elo, maximum_elo,
+                map_ids, include_civ_ids, clamp_civ_ids, no_mirror,
+                exclude_civ_ids, include_ladder_ids, include_patch_ids,
+                clamp_player1))
+    if key not in aggregate_filters:
+        aggregate_filters[key] = build_aggregate_filter(
+            minimum_elo, maximum_elo, map_ids, include_civ_ids, clamp_civ_ids,
+            no_mirror, exclude_civ_ids, include_ladder_ids, include_patch_ids,
+            clamp_player1)
+    return aggregate_filters[key]
 
-    query += ')'
-    query += """
-               AND a.id != b.id
-               AND """
-    query += arguments_to_query_string(
-        'm', 'a', 'b', minimum_elo, maximum_elo, map_ids, include_civ_ids,
-        clamp_civ_ids, no_mirror, exclude_civ_ids, include_ladder_ids,
-        include_patch_ids, include_civ_ids or player_ids is not None,
-        player_ids)
-    query += ';'
-    return parse_replays_and_store_in_db.connect_and_return(query, ())[0]
 
+def build_aggregate_filter(minimum_elo, maximum_elo, map_ids, include_civ_ids,
+                           clamp_civ_ids, no_mirror, exclude_civ_ids,
+                           include_ladder_ids, include_patch_ids,
+                           clamp_player1):
+    if not parse_replays_and_store_in_db.has_table('opening_matchup_counts'):
+        return None
+    string = "("
+    # ignore all did nothing results
+    string += f'g.a_opening_id != {OpeningType.DidNothing.value}\n'
+    string += f'  AND g.b_opening_id != {OpeningType.DidNothing.value}\n'
 
-def mirror_matchups(opening1, minimum_elo, maximum_elo, map_ids,
-                    include_civ_ids, clamp_civ_ids, no_mirror, exclude_civ_ids,
-                    include_ladder_ids, include_patch_ids, player_ids):
-    query = """SELECT COUNT(a.id)
-             FROM matches m
-             JOIN match_players a ON a.match_id = m.id
-             JOIN match_players b ON b.match_id = m.id
-             WHERE ("""
-    #strat 1 inclusions
-    count = 0
-    for i in opening1[1]:
-        count += 1
-        query += f'((a.opening_id & {i}) = {i})'
-        if count < len(opening1[1]):
-            query += ' OR '
-    query += ') AND ('
-    #Strat 1 exclusions
-    count = 0
-    for i in opening1[2]:
-        count += 1
-        query += f'(NOT (a.opening_id & {i}))'
-        if count < len(opening1[2]):
-            query += ' AND '
-    query += ')'
-    query += """  AND a.id != b.id
-                 AND a.victory = 1
-                 AND"""
-    query += arguments_to_query_string(
-        'm', 'a', 'b', minimum_elo, maximum_elo, map_ids, include_civ_ids,
-        clamp_civ_ids, no_mirror, exclude_civ_ids, include_ladder_ids,
-        include_patch_ids, include_civ_ids or player_ids is not None,
-        player_ids)
-    query += ';'
-    return parse_replays_and_store_in_db.connect_and_return(query, ())[0]
+    if no_mirror:
+        string += '  AND g.a_civilization != g.b_civilization\n'
+
+    if map_ids is not None:
+        string += '  AND g.map_id IN ('
+        string += ', '.join(str(map_id) for ids in map_ids for map_id in ids)
+        string += ')\n'
+
+    if include_civ_ids:
+        string += f'  AND (g.a_civilization IN ({", ".join(map(str, include_civ_ids))})'
+        if not clamp_player1:
+            string += f'\n    OR g.b_civilization IN ({", ".join(map(str, include_civ_ids))})'
+        string += ')\n'
+
+    if clamp_civ_ids:
+        string += f'  AND g.a_civilization IN ({", ".join(map(str, clamp_civ_ids))})\n'
+        string += f'  AND g.b_civilization IN ({", ".join(map(str, clamp_civ_ids))})\n'
+
+    if exclude_civ_ids:
+        string += f'  AND g.a_civilization NOT IN ({", ".join(map(str, exclude_civ_ids))})\n'
+        string += f'  AND g.b_civilization NOT IN ({", ".join(map(str, exclude_civ_ids))})\n'
+
+    if include_ladder_ids is not None:
+        string += '  AND g.ladder_id IN ('
+        string += ', '.join(str(ladder_id) for ids in include_ladder_ids for ladder_id in ids)
+        string += ')\n'
+
+    if include_patch_ids is not None:
+        string += '  AND g.patch_id IN ('
+        string += ', '.join(str(patch_id) for ids in include_patch_ids for patch_id in ids)
+        string += ')\n'
+    string += ")"
+
+    #elo bounds are strict, buckets holding a bound that aren't wholly on one
+    #side of it have to be empty
+    low = parse_replays_and_store_in_db.elo_bucket(minimum_elo)
+    high = parse_replays_and_store_in_db.elo_bucket(maximum_elo)
+    partial = [bucket for bucket in (low, high) if bucket % 2]
+    if partial:
+        games = parse_replays_and_store_in_db.connect_and_return(
+            f"""SELECT SUM(g.games) FROM opening_matchup_counts g
+                  WHERE g.elo_bucket IN ({', '.join(map(str, partial))}) AND {string};""",
+            ())[0][0]
+        if games:
+            return None
+    return f'g.elo_bucket > {low} AND g.elo_bucket < {high} AND {string}'
+
+
+def strategy_membership(opening_ids):
+    #a row per opening id and a column per Allowed_Strategies entry,
+    #inclusions or'ed and exclusions and'ed like the sql filters
+    memberships = {}
+    for opening_id in set(opening_ids):
+        memberships[opening_id] = [
+            opening_id is not None
+            and any((opening_id & i) == i for i in strategy[1])
+            and not any(opening_id & i for i in strategy[2])
+            for strategy in Allowed_Strategies]
+    return np.array([memberships[opening_id] for opening_id in opening_ids],
+                    dtype=np.int64).reshape(len(opening_ids), len(Allowed_Strategies))
+
+
+def strategy_matchup_matrix(minimum_elo, maximum_elo, map_ids, include_civ_ids,
+                            clamp_civ_ids, no_mirror, exclude_civ_ids,
+                            include_ladder_ids, include_patch_ids, player_ids):
+    #Every strategy pair from one scan of the filtered match pairs, summed per
+    #pair of opening ids. Returns totals, first wins, second wins and unknowns
+    #indexed [first strategy, second strategy] and the first side's wins per
+    #strategy against anything, which is what mirrors report
+    where = aggregate_filter(minimum_elo, maximum_elo, map_ids, include_civ_ids,
+                             clamp_civ_ids, no_mirror, exclude_civ_ids,
+                             include_ladder_ids, include_patch_ids,
+                             include_civ_ids or player_ids is not None,
+                             player_ids)
+    if where is not None:
+        query = f"""SELECT g.a_opening_id, g.b_opening_id,
+                           SUM(g.a_wins + g.a_losses), SUM(g.a_wins), SUM(g.b_wins),
+                           SUM(g.a_unknown)
+                      FROM opening_matchup_counts g
+                      WHERE {where}
+                      GROUP BY g.a_opening_id, g.b_opening_id;"""
+    else:
+        query = """SELECT a.opening_id, b.opening_id,
+                   sum(CASE WHEN a.victory = 1 OR a.victory = 0 THEN 1 ELSE 0 END) as Total,
+                   sum(CASE WHEN a.victory = 1 THEN 1 ELSE 0 END) AS FirstOpeningWins,
+                   sum(CASE WHEN b.victory = 1 THEN 1 ELSE 0 END) AS SecondOpeningWins,
+                   sum(CASE WHEN a.victory = -1 THEN 1 ELSE 0 END) AS Unknown
+                 FROM matches m
+                 JOIN match_players a ON a.match_id = m.id
+                 JOIN match_players b ON b.match_id = m.id
+                 WHERE a.id != b.id
+                   AND """
+        query += arguments_to_query_string(
+            'm', 'a', 'b', minimum_elo, maximum_elo, map_ids, include_civ_ids,
+            clamp_civ_ids, no_mirror, exclude_civ_ids, include_ladder_ids,
+            include_patch_ids, include_civ_ids or player_ids is not None,
+            player_ids)
+        query += 'GROUP BY a.opening_id, b.opening_id;'
+    rows = parse_replays_and_store_in_db.connect_and_return(query, ())
+    if not rows:
+        rows = []
+    first = strategy_membership([row[0] for row in rows])
+    second = strategy_membership([row[1] for row in rows])
+    sums = np.array([row[2:] for row in rows], dtype=np.int64).reshape(len(rows), 4)
+    total, firstwins, secondwins, unknown = (
+        (first.T @ (second * sums[:, [k]])).tolist() for k in range(4))
+    return total, firstwins, secondwins, unknown, (first.T @ sums[:, 1]).tolist()
 
 
 #Clamps to included civs!
@@ -300,11 +375,13 @@ def age_up_times_for_opening(opening1, minimum_elo, maximum_elo, map_ids,
                              include_civ_ids, clamp_civ_ids, no_mirror,
                              exclude_civ_ids, include_ladder_ids,
                              include_patch_ids, player_ids, tech_ids):
-    query = """SELECT a.id, c.event_id, c.time, c.duration
+    #one row per opponent each match player is joined with, every one of
+    #them repeats the player's actions. Counted here rather than with a
+    #GROUP BY which makes sqlite walk the whole match_players table in id order
+    query = """SELECT a.id
              FROM matches m
              JOIN match_players a ON a.match_id = m.id
              JOIN match_players b ON b.match_id = m.id
-             JOIN match_player_actions c ON a.id = c.match_player_id
              WHERE ("""
     #strat 1 inclusions
     count = 0
@@ -322,32 +399,44 @@ def age_up_times_for_opening(opening1, minimum_elo, maximum_elo, map_ids,
         if count < len(opening1[2]):
             query += ' AND '
     query += ')'
-    query += """AND a.id != b.id
-               AND c.event_type = 3
-               AND (c.event_id = 101
-                 OR c.event_id = 102
-                 OR c.event_id = 103"""
-    if tech_ids is not None:
-        query += '    OR '
-        for i in range(len(tech_ids)):
-            for j in range(len(tech_ids[i])):
-                if i + j > 0:
-                    query += '    OR '
-                query += f'c.event_id = {tech_ids[i][j]}\n'
-    query += ") "
+    query += "AND a.id != b.id "
     query += " AND "
     query += arguments_to_query_string('m', 'a', 'b', minimum_elo, maximum_elo,
                                        map_ids, include_civ_ids, clamp_civ_ids,
                                        no_mirror, exclude_civ_ids,
                                        include_ladder_ids, include_patch_ids,
                                        True, player_ids)
-    query += 'ORDER BY a.id;'
-    return parse_replays_and_store_in_db.connect_and_return(query, ())
+    query += ';'
+    match_players = parse_replays_and_store_in_db.connect_and_return(query, ())
+    if not match_players:
+        return []
+    event_ids = [101, 102, 103]
+    if tech_ids is not None:
+        for i in range(len(tech_ids)):
+            event_ids += tech_ids[i]
+    ids, counts = np.unique(
+        np.array([match_player[0] for match_player in match_players], dtype=np.int64),
+        return_counts=True)
+    #works on both the row and the packed action layout
+    group_ids, event_types, event_ids, times, durations = \
+        parse_replays_and_store_in_db.get_action_arrays(
+            ids.tolist(), EventType.TECH.value, event_ids)
+    repeats = counts[np.searchsorted(ids, group_ids)]
+    return list(zip(*(np.repeat(column, repeats).tolist()
+                      for column in (group_ids, event_ids, times, durations))))
 
 
 def total_concluded_matches(minimum_elo, maximum_elo, map_ids, include_civ_ids,
                             clamp_civ_ids, no_mirror, exclude_civ_ids,
                             include_ladder_ids, include_patch_ids, player_ids):
+    where = aggregate_filter(minimum_elo, maximum_elo, map_ids, include_civ_ids,
+                             clamp_civ_ids, no_mirror, exclude_civ_ids,
+                             include_ladder_ids, include_patch_ids, False,
+                             player_ids)
+    if where is not None:
+        query = f"""SELECT COALESCE(SUM(g.a_wins), 0)
+                      FROM opening_matchup_counts g WHERE {where};"""
+        return parse_replays_and_store_in_db.connect_and_return(query, ())[0][0]
     query = """SELECT COUNT(a.id)
              FROM match_players a
              JOIN matches m ON m.id = a.match_id
@@ -381,6 +470,15 @@ def get_civilization_count(civ_id, minimum_elo, maximum_elo, map_ids,
                            include_civ_ids, clamp_civ_ids, no_mirror,
                            exclude_civ_ids, include_ladder_ids,
                            include_patch_ids, player_ids):
+    where = aggregate_filter(minimum_elo, maximum_elo, map_ids, include_civ_ids,
+                             clamp_civ_ids, no_mirror, exclude_civ_ids,
+                             include_ladder_ids, include_patch_ids,
+                             player_ids is not None, player_ids)
+    if where is not None:
+        query = f"""SELECT SUM(g.a_wins + g.a_losses), SUM(g.a_wins), SUM(g.a_losses)
+                      FROM opening_matchup_counts g
+                      WHERE g.a_civilization = ? AND {where};"""
+        return parse_replays_and_store_in_db.connect_and_return(query, (civ_id,))[0]
     query = """SELECT
                sum(CASE WHEN a.victory = 1 OR a.victory = 0 THEN 1 ELSE 0 END) as Total,
                sum(CASE WHEN a.victory = 1 THEN 1 ELSE 0 END) as Wins,
@@ -429,14 +527,12 @@ def print_uptimes_per_strategy(total_matches, minimum_elo, maximum_elo, map_ids,
             "count"]  #use feudal count for each strategy because its pretty much guaranteed
         string = f'{Allowed_Strategies[i][0]} ({count}): '
         for k, v in sorted(research_dict.items()):
+            tech = lookup_event(EventType.TECH, k)
             if k in translated_names:
                 string += translated_names[k] + ": "
             else:
-                string += aoe_data["data"]["techs"][str(
-                    k)]["internal_name"] + ": "
-            string += output_time(
-                v["time"] / v["count"] +
-                int(aoe_data["data"]["techs"][str(k)]["ResearchTime"]) * 1000)
+                string += (tech.internal_name or tech.name) + ": "
+            string += output_time(v["time"] / v["count"] + tech.duration)
             string += ", "
         print(string)
 
@@ -446,42 +542,22 @@ def print_strategy_matchups(total_matches, minimum_elo, maximum_elo, map_ids,
                             exclude_civ_ids, include_ladder_ids,
                             include_patch_ids, player_ids, tech_ids):
     print("\nStrategy Matchups!")
+    total, firstwins, secondwins, unknown, mirrors = strategy_matchup_matrix(
+        minimum_elo, maximum_elo, map_ids, include_civ_ids, clamp_civ_ids,
+        no_mirror, exclude_civ_ids, include_ladder_ids, include_patch_ids,
+        player_ids)
 
     for i in range(len(Allowed_Strategies)):
         for j in range(len(Allowed_Strategies)):
-            if i == j:
-                if include_civ_ids or player_ids is not None:
-                    total, firstwins, secondwins, unknown = opening_matchups(
-                        Allowed_Strategies[i], Allowed_Strategies[j],
-                        minimum_elo, maximum_elo, map_ids, include_civ_ids,
-                        clamp_civ_ids, no_mirror, exclude_civ_ids,
-                        include_ladder_ids, include_patch_ids, player_ids)
-                    if total:
-                        print(
-                            f'{Allowed_Strategies[i][0]} vs {Allowed_Strategies[j][0]} - {total} ({total/total_matches:.1%}), {firstwins}:{secondwins} ({firstwins/total:.1%}:{secondwins/total:.1%}) with {unknown} unknowns'
-                        )
-                else:
-                    total = mirror_matchups(Allowed_Strategies[i], minimum_elo,
-                                            maximum_elo, map_ids,
-                                            include_civ_ids, clamp_civ_ids,
-                                            no_mirror, exclude_civ_ids,
-                                            include_ladder_ids,
-                                            include_patch_ids, player_ids)[0]
-                    if total:
-                        print(
-                            f'{Allowed_Strategies[i][0]} vs {Allowed_Strategies[i][0]} - {total} ({total/total_matches:.1%})'
-                        )
-
-            else:
-                total, firstwins, secondwins, unknown = opening_matchups(
-                    Allowed_Strategies[i], Allowed_Strategies[j], minimum_elo,
-                    maximum_elo, map_ids, include_civ_ids, clamp_civ_ids,
-                    no_mirror, exclude_civ_ids, include_ladder_ids,
-                    include_patch_ids, player_ids)
-                if total:
+            if i == j and not (include_civ_ids or player_ids is not None):
+                if mirrors[i]:
                     print(
-                        f'{Allowed_Strategies[i][0]} vs {Allowed_Strategies[j][0]} - {total} ({total/total_matches:.1%}), {firstwins}:{secondwins} ({firstwins/total:.1%}:{secondwins/total:.1%}) with {unknown} unknowns'
+                        f'{Allowed_Strategies[i][0]} vs {Allowed_Strategies[i][0]} - {mirrors[i]} ({mirrors[i]/total_matches:.1%})'
                     )
+            elif total[i][j]:
+                print(
+                    f'{Allowed_Strategies[i][0]} vs {Allowed_Strategies[j][0]} - {total[i][j]} ({total[i][j]/total_matches:.1%}), {firstwins[i][j]}:{secondwins[i][j]} ({firstwins[i][j]/total[i][j]:.1%}:{secondwins[i][j]/total[i][j]:.1%}) with {unknown[i][j]} unknowns'
+                )
 
 
 def print_civ_stats(total_matches, minimum_elo, maximum_elo, map_ids,
@@ -492,11 +568,6 @@ def print_civ_stats(total_matches, minimum_elo, maximum_elo, map_ids,
     print('\nCivilization Stats!')
     civilizations = get_civilizations()
 
-    #build civ dict
-    civs = {}
-    for name, value in aoe_data["civ_names"].items():
-        civs[int(value) - 10270] = name
-
     total_matches = total_concluded_matches(minimum_elo, maximum_elo, map_ids,
                                             include_civ_ids, clamp_civ_ids,
                                             no_mirror, exclude_civ_ids,
@@ -510,7 +581,7 @@ def print_civ_stats(total_matches, minimum_elo, maximum_elo, map_ids,
         if total:
             #divide play rate by 2 because there are 2 civs chosen for every match!
             print(
-                f'{civs[civilizations[i][0]]} - {total} ({total/total_matches/2.:.1%}), {wins}:{losses} ({wins/total:.1%})'
+                f'{CIVS[civilizations[i][0]]} - {total} ({total/total_matches/2.:.1%}), {wins}:{losses} ({wins/total:.1%})'
             )
 
 
@@ -550,29 +621,24 @@ def names_to_ids(include_civ_ids, clamp_civ_ids, exclude_civ_ids):
     if include_civ_ids is not None:
         for i in range(len(include_civ_ids)):
             for j in range(len(include_civ_ids[i])):
-                if include_civ_ids[i][j] in aoe_data["civ_names"]:
-                    new_include_civ_ids.append(
-                        int(aoe_data["civ_names"][include_civ_ids[i][j]]) -
-                        10270)
+                if include_civ_ids[i][j] in CIV_IDS:
+                    new_include_civ_ids.append(CIV_IDS[include_civ_ids[i][j]])
                 else:
                     print(f'{include_civ_ids[i][j]} is not a valid civ name!')
                     exit(0)
     if clamp_civ_ids is not None:
         for i in range(len(clamp_civ_ids)):
             for j in range(len(clamp_civ_ids[i])):
-                if clamp_civ_ids[i][j] in aoe_data["civ_names"]:
-                    new_clamp_civ_ids.append(
-                        int(aoe_data["civ_names"][clamp_civ_ids[i][j]]) - 10270)
+                if clamp_civ_ids[i][j] in CIV_IDS:
+                    new_clamp_civ_ids.append(CIV_IDS[clamp_civ_ids[i][j]])
                 else:
                     print(f'{clamp_civ_ids[i][j]} is not a valid civ name!')
                     exit(0)
     if exclude_civ_ids is not None:
         for i in range(len(exclude_civ_ids)):
             for j in range(len(exclude_civ_ids[i])):
-                if exclude_civ_ids[i][j] in aoe_data["civ_names"]:
-                    new_exclude_civ_ids.append(
-                        int(aoe_data["civ_names"][exclude_civ_ids[i][j]]) -
-                        10270)
+                if exclude_civ_ids[i][j] in CIV_IDS:
+                    new_exclude_civ_ids.append(CIV_IDS[exclude_civ_ids[i][j]])
                 else:
                     print(f'{exclude_civ_ids[i][j]} is not a valid civ name!')
                     exit(0)
@@ -655,15 +721,29 @@ if __name__ == '__main__':
                         "--db-name",
                         help="Create stats from this db instead",
                         type=str)
+    parser.add_argument("-r",
+                        "--raw-scans",
+                        help="Scan the match tables instead of using the aggregates",
+                        action='store_true')
+    parser.add_argument("-P",
+                        "--check-plans",
+                        help="Fail if a query reads a table without an index",
+                        action='store_true')
     args = parser.parse_args()
 
     if args.db_name is not None:
         parse_replays_and_store_in_db.DB_FILE = args.db_name
-    with open(os.path.join('aoe2techtree', 'data', 'data.json')) as json_file:
-        aoe_data = json.load(json_file)
+    if args.raw_scans:
+        USE_AGGREGATES = False
     include_civ_ids, clamp_civ_ids, exclude_civ_ids = names_to_ids(
         args.include_civ_names, args.clamp_civ_names, args.exclude_civ_names)
-    execute(args.minimum_elo, args.maximum_elo, args.map_ids, include_civ_ids,
-            clamp_civ_ids, args.no_mirror, exclude_civ_ids,
-            args.include_ladder_ids, args.include_patch_ids, args.player_ids,
-            args.tech_ids)
+    if args.check_plans:
+        parse_replays_and_store_in_db.CHECK_QUERY_PLANS = True
+    try:
+        execute(args.minimum_elo, args.maximum_elo, args.map_ids, include_civ_ids,
+                clamp_civ_ids, args.no_mirror, exclude_civ_ids,
+                args.include_ladder_ids, args.include_patch_ids, args.player_ids,
+                args.tech_ids)
+    except parse_replays_and_store_in_db.QueryPlanError as e:
+        print(e)
+        sys.exit(1)
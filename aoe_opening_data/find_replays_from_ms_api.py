@@ -16,6 +16,10 @@ NUM_PROCESSES = 10
 # Keep our query size as large as possible to reduce strain one aoe.ms api
 PLAYERS_PER_QUERY = 5
 ELOS_PER_QUERY = 100
+# Stop parsing the replay body once every player has reached this age,
+# the opening classifier ignores everything after imp. The match actions
+# stored for these replays end there as well
+OPENING_CUTOFF_AGE = 3
 LEADERBOARD_IDS = [
   # leaderboard id : matchtype id
   # from https://aoe-api.worldsedgelink.com/community/leaderboard/getAvailableLeaderboards?title=age2
@@ -99,7 +103,8 @@ def parse_replay_for_match(match_id, player_id, players, leaderboard_id):
     replay = replay_zip.read(replay_zip.namelist()[0])
     parse_replays_and_store_in_db.parse_replay_file(
         match_id, players,
-        leaderboard_id, io.BytesIO(replay), VERSION)
+        leaderboard_id, replay, VERSION,
+        cutoff_age=OPENING_CUTOFF_AGE)
 
   except Exception as e:
     print(e)
@@ -201,6 +206,11 @@ def execute(leaderboard_ids):
     search_player_ids = player_ids.copy()
     if matches == None:
       continue
+    # one lookup for the whole page instead of a query per match, matches
+    # queued earlier this run are skipped below anyway so they aren't asked for
+    unknown_match_ids = set(parse_replays_and_store_in_db.filter_unknown(
+        [match["id"] for match in matches["matchHistoryStats"]
+         if match["id"] not in added_matches_set]))
     for match in matches["matchHistoryStats"]:
       match_id = match["id"]
       if match["matchtype_id"] not in matchtype_ids:
@@ -242,7 +252,7 @@ def execute(leaderboard_ids):
           heapq.heappush(player_id_heap, player_id)
 
       #make sure match isnt already in db
-      if parse_replays_and_store_in_db.does_match_exist(match_id):
+      if match_id not in unknown_match_ids:
         continue
       # make sure we havent already processed this match
       if match_id in added_matches_set:
@@ -323,6 +333,8 @@ def close():
 if __name__ == "__main__":
   counter = multiprocessing.Value('i', 0)
   errors = multiprocessing.Value('i', 0)
+  # load the known match ids before forking so the consumers share them
+  parse_replays_and_store_in_db.load_match_index()
   # first lets fire off the consumers so we can parse replays as we get them
   for i in range(NUM_PROCESSES):
     p = multiprocessing.Process(target=match_queue_consumer, args=(match_queue,counter, errors))
@@ -67,6 +67,14 @@ def execute(minimum_elo, maximum_elo, output_folder, player_id, add_to_db):
         if not os.path.exists(path):
             os.mkdir(path)
 
+    if add_to_db:
+        #one lookup for the whole page instead of a query per match
+        unknown_match_ids = set(
+            parse_replays_and_store_in_db.filter_unknown([
+                match["match_id"] for match in matches
+                if match.get("match_id") is not None
+            ]))
+
     invalid_time = round(
         time.time_ns() / 1000000000
     ) - 168 * 60 * 60  #anything older than 7 days is probably too old
@@ -84,8 +92,10 @@ def execute(minimum_elo, maximum_elo, output_folder, player_id, add_to_db):
         match_id = match["match_id"]
         #check if already in db!
         if add_to_db:
-            if parse_replays_and_store_in_db.does_match_exist(match_id):
+            #or earlier on this page
+            if match_id not in unknown_match_ids:
                 continue
+            unknown_match_ids.discard(match_id)
         average_rating = 0
         divisor = 0
         for player in match["players"]:
@@ -1,19 +1,54 @@
 import sqlite3
+import numpy as np
 import aoe_replay_stats
 import grab_replays_for_player
+import stage_timing
 import os
 import re
+import math
 import sys
 import argparse
+import multiprocessing
+import threading
+import time
+import atexit
+from collections import namedtuple
+from contextlib import contextmanager
 
 fpath = os.path.realpath(__file__)
 path = os.path.dirname(fpath)
 DB_FILE = path + "/local.db"
 
+#matches written per transaction by the folder import
+WRITE_BATCH_SIZE = 50
+# match players classified per chunk when reanalysing
+REANALYSIS_CHUNK_SIZE = 5000
+
+# Everything needed to store a parsed replay, plain tuples so it is cheap to
+# send from a worker process to the writer
+ParsedMatch = namedtuple('ParsedMatch', [
+    'match_id', 'average_elo', 'map_id', 'save_version', 'ladder_id',
+    'patch_number', 'player_ids', 'match_players'
+])
+# actions are (event_type, event_id, time, duration)
+ParsedMatchPlayer = namedtuple(
+    'ParsedMatchPlayer',
+    ['player_id', 'civilization', 'victory', 'elo', 'actions'])
+
+# Optional compact layout, a match player's actions stored as one blob of
+# these records in match_player_action_blobs instead of a row each. Set with
+# -k or AOE_COMPACT_ACTIONS, readers handle both layouts
+COMPACT_ACTIONS = bool(os.environ.get('AOE_COMPACT_ACTIONS'))
+ACTION_RECORD = np.dtype([('event_type', '<i4'), ('event_id', '<i4'),
+                          ('time', '<i4'), ('duration', '<i4')])
+# bound parameters per statement, the default limit of sqlite before 3.32
+MAX_BOUND_PARAMETERS = 999
+# match players moved to the compact layout per transaction
+COMPACT_CHUNK_SIZE = 5000
+
 
 def init_db():
     sql_commands = []
-    sql_commands.append("PRAGMA foreign_keys = ON;")
     sql_commands.append(""" CREATE TABLE IF NOT EXISTS openings (
                             id integer NOT NULL PRIMARY KEY,
                             name text NOT NULL
@@ -67,23 +102,40 @@ def init_db():
         """CREATE INDEX IF NOT EXISTS idx_match_player_actions_match_player_id
                            on match_player_actions (match_player_id);""")
 
-    sql_commands.append("""CREATE INDEX IF NOT EXISTS idx_match_player_match_id
-                           on match_players (match_id);""")
+    # actions in the compact layout, see ACTION_RECORD
+    sql_commands.append(""" CREATE TABLE IF NOT EXISTS match_player_action_blobs (
+                            match_player_id integer NOT NULL PRIMARY KEY,
+                            actions blob NOT NULL,
+                            CONSTRAINT fk_match_player_id FOREIGN KEY(match_player_id) REFERENCES match_players(id) ON DELETE CASCADE
+                            ); """)
+
+    # version of each opening rule group a match player was classified with,
+    # see aoe_replay_stats.OPENING_RULE_VERSIONS
+    sql_commands.append(""" CREATE TABLE IF NOT EXISTS opening_rule_versions (
+                            match_player_id integer NOT NULL,
+                            rule text NOT NULL,
+                            version integer NOT NULL,
+                            PRIMARY KEY(match_player_id, rule),
+                            CONSTRAINT fk_match_player_id FOREIGN KEY(match_player_id) REFERENCES match_players(id) ON DELETE CASCADE
+                            ) WITHOUT ROWID; """)
     try:
-        conn = sqlite3.connect(DB_FILE, timeout=300)
-        c = conn.cursor()
-        for sql_command in sql_commands:
-            c.execute(sql_command)
-        conn.commit()
+        with transaction() as conn:
+            for sql_command in sql_commands:
+                conn.execute(sql_command)
     except Exception as e:
         print(e)
-    finally:
-        conn.close()
+    # match_players is only indexed by match through these
+    init_indexes()
+    forget_tables()
+
+
+def forget_tables():
+    for key in [key for key in known_tables if key[0] == DB_FILE]:
+        del known_tables[key]
 
 
 def init_flat_db():
     sql_commands = []
-    sql_commands.append("PRAGMA foreign_keys = ON;")
     sql_commands.append(""" CREATE TABLE IF NOT EXISTS openings (
                             id integer NOT NULL PRIMARY KEY,
                             name text NOT NULL
@@ -195,15 +247,11 @@ def init_flat_db():
                             CONSTRAINT fk_player_id FOREIGN KEY(player_id) REFERENCES players(id) ON DELETE CASCADE
                             ); """)
     try:
-        conn = sqlite3.connect(DB_FILE, timeout=300)
-        c = conn.cursor()
-        for sql_command in sql_commands:
-            c.execute(sql_command)
-        conn.commit()
+        with transaction() as conn:
+            for sql_command in sql_commands:
+                conn.execute(sql_command)
     except Exception as e:
         print(e)
-    finally:
-        conn.close()
 
 def update_schema():
     # First update to db, adding patch number and ladder id to matches
@@ -224,55 +272,433 @@ def update_schema():
         """ALTER TABLE matches ADD COLUMN patch_number integer DEFAULT 53347;""", ())
     #fourth update, try a time index
     connect_and_modify(
-        """CREATE INDEX time_index ON matches(time)""", ())
+        """CREATE INDEX IF NOT EXISTS time_index ON matches(time)""", ())
     # fifth update, match player elo on top of average elo
     connect_and_modify(
         """ALTER TABLE match_players ADD COLUMN elo integer DEFAULT -1;""", ())
+    # sixth update, opening matchup aggregates kept up to date by triggers
+    init_opening_matchups()
+    # seventh update, indexes for the statistics queries
+    init_indexes()
+
+
+# Built around the queries that run. Narrow elo ranges start from matches,
+# with ladder, patch and map included so the match rows are never read (a
+# ladder or patch alone matches too much of the table to be worth an index).
+# Otherwise match_players is walked in match order, the index covers what the
+# self joins test. Techs are read per match player in action order
+INDEXES = [
+    """CREATE INDEX IF NOT EXISTS idx_matches_elo
+         ON matches(average_elo, ladder_id, patch_id, map_id)""",
+    """CREATE INDEX IF NOT EXISTS idx_match_players_match
+         ON match_players(match_id, opening_id, civilization, victory, player_id, parser_version)""",
+    f"""CREATE INDEX IF NOT EXISTS idx_match_player_actions_techs
+         ON match_player_actions(match_player_id, id, event_id, time, duration)
+         WHERE event_type = {aoe_replay_stats.EventType.TECH.value}""",
+    #covered by idx_match_players_match
+    """DROP INDEX IF EXISTS idx_match_player_match_id""",
+]
+
+
+def init_indexes():
+    try:
+        with transaction() as conn:
+            for sql_command in INDEXES:
+                conn.execute(sql_command)
+    except Exception as e:
+        print(e)
+
+
+# With CHECK_QUERY_PLANS set (-P in create_statistics or
+# AOE_CHECK_QUERY_PLANS) connect_and_return explains every query first and
+# raises QueryPlanError if it reads a table without an index. The aggregates
+# are small and meant to be read whole
+CHECK_QUERY_PLANS = bool(os.environ.get('AOE_CHECK_QUERY_PLANS'))
+FULL_SCAN_ALLOWED = ('opening_matchup_counts', 'sqlite_master', 'sqlite_schema')
+SQL_KEYWORDS = {'ON', 'WHERE', 'JOIN', 'LEFT', 'INNER', 'CROSS', 'GROUP',
+                'ORDER', 'LIMIT', 'USING', 'NATURAL'}
+
+
+class QueryPlanError(Exception):
+    pass
+
+
+def table_aliases(statement):
+    #{alias or name: table} for the tables a statement reads
+    aliases = {}
+    for table, alias in re.findall(r'(?:FROM|JOIN)\s+([\w.]+)(?:\s+(?:AS\s+)?(\w+))?',
+                                   statement, re.IGNORECASE):
+        table = table.split('.')[-1]
+        aliases[table] = table
+        if alias and alias.upper() not in SQL_KEYWORDS:
+            aliases[alias] = table
+    return aliases
+
+
+def check_query_plan(conn, statement, args):
+    aliases = table_aliases(statement)
+    plan = conn.execute("EXPLAIN QUERY PLAN " + statement,
+                        () if args is None else args).fetchall()
+    for row in plan:
+        detail = row[-1]
+        if not detail.startswith('SCAN ') or ' INDEX ' in detail + ' ':
+            continue
+        words = detail.split()
+        if words[1] == 'TABLE':
+            #sqlite before 3.36 writes SCAN TABLE name [AS alias]
+            words = words[1:]
+            if len(words) > 3 and words[2] == 'AS':
+                words = words[2:]
+        name = words[1]
+        if name == 'CONSTANT' or name.startswith('('):
+            continue
+        if aliases.get(name, name) in FULL_SCAN_ALLOWED:
+            continue
+        raise QueryPlanError(
+            f'Full scan of {aliases.get(name, name)} ({detail}) in:\n{statement}')
+
+
+# Ordered (a, b) match player pairs of every match summed per ladder, patch,
+# map, elo bucket, civilization pair and opening pair, the same pairs the
+# statistics self join counts. Elo buckets alternate between exact multiples
+# of ELO_BUCKET_WIDTH (even) and the open range up to the next one (odd), so
+# the strict elo bounds of a query line up with whole buckets
+ELO_BUCKET_WIDTH = 25
+OPENING_MATCHUP_COLUMNS = """ladder_id, patch_id, map_id, elo_bucket,
+                             a_civilization, b_civilization, a_opening_id, b_opening_id"""
+
+
+def elo_bucket(elo):
+    step = math.floor(elo / ELO_BUCKET_WIDTH)
+    return 2 * step + (elo != step * ELO_BUCKET_WIDTH)
+
+
+def elo_bucket_sql(column):
+    #elo_bucket in sql. CAST truncates toward zero, so step one down for
+    #negative elos that aren't a multiple to get math.floor
+    quotient = f'({column} / {ELO_BUCKET_WIDTH}.0)'
+    step = f'(CAST({quotient} AS INTEGER) - ({quotient} < CAST({quotient} AS INTEGER)))'
+    return f'(2 * {step} + ({column} != {step} * {ELO_BUCKET_WIDTH}))'
+
+
+def opening_matchup_pairs(where, sign):
+    #INSERT adding sign times the pairs selected by where to the counts,
+    #removals also drop the cells they empty
+    return f"""INSERT INTO opening_matchup_counts
+                 ({OPENING_MATCHUP_COLUMNS}, games, a_wins, a_losses, a_unknown, b_wins)
+                 SELECT m.ladder_id, m.patch_id, m.map_id, {elo_bucket_sql('m.average_elo')},
+                        a.civilization, b.civilization, a.opening_id, b.opening_id,
+                        {sign}, {sign} * (a.victory IS 1), {sign} * (a.victory IS 0),
+                        {sign} * (a.victory IS -1), {sign} * (b.victory IS 1)
+                   FROM matches m
+                   JOIN match_players a on a.match_id = m.id
+                   JOIN match_players b on b.match_id = m.id
+                   WHERE a.id != b.id AND {where}
+                 ON CONFLICT({OPENING_MATCHUP_COLUMNS}) DO UPDATE SET
+                   games = games + excluded.games,
+                   a_wins = a_wins + excluded.a_wins,
+                   a_losses = a_losses + excluded.a_losses,
+                   a_unknown = a_unknown + excluded.a_unknown,
+                   b_wins = b_wins + excluded.b_wins;
+               {'DELETE FROM opening_matchup_counts WHERE games = 0;' if sign < 0 else ''}"""
+
+
+def init_opening_matchups():
+    #Creates the aggregate table and the triggers that keep it in step with
+    #matches and match_players inside the writing transaction. Triggers whose
+    #definition changed are replaced and the table is refilled from the
+    #existing rows, as it is the first time
+    match_changed = """OLD.id IS NOT NEW.id
+                       OR OLD.ladder_id IS NOT NEW.ladder_id
+                       OR OLD.patch_id IS NOT NEW.patch_id
+                       OR OLD.map_id IS NOT NEW.map_id
+                       OR OLD.average_elo IS NOT NEW.average_elo"""
+    match_player_changed = """OLD.opening_id IS NOT NEW.opening_id
+                              OR OLD.civilization IS NOT NEW.civilization
+                              OR OLD.victory IS NOT NEW.victory
+                              OR OLD.match_id IS NOT NEW.match_id"""
+    sql_commands = [
+        f""" CREATE TABLE IF NOT EXISTS opening_matchup_counts (
+                            ladder_id integer,
+                            patch_id float,
+                            map_id integer,
+                            elo_bucket integer,
+                            a_civilization integer,
+                            b_civilization integer,
+                            a_opening_id integer,
+                            b_opening_id integer,
+                            games integer NOT NULL,
+                            a_wins integer NOT NULL,
+                            a_losses integer NOT NULL,
+                            a_unknown integer NOT NULL,
+                            b_wins integer NOT NULL,
+                            UNIQUE({OPENING_MATCHUP_COLUMNS})
+                            ); """,
+        #finds the cells emptied by a decrement so they can be dropped
+        """CREATE INDEX IF NOT EXISTS idx_opening_matchup_counts_empty
+             ON opening_matchup_counts(games) WHERE games = 0;""",
+    ]
+    #an update moves the row's pairs from the old cells to the new ones
+    triggers = {
+        'opening_matchups_match_insert': f"""AFTER INSERT ON matches BEGIN
+              {opening_matchup_pairs('m.id = NEW.id', 1)}
+            END""",
+        'opening_matchups_match_delete': f"""BEFORE DELETE ON matches BEGIN
+              {opening_matchup_pairs('m.id = OLD.id', -1)}
+            END""",
+        'opening_matchups_match_update_old': f"""BEFORE UPDATE ON matches WHEN {match_changed} BEGIN
+              {opening_matchup_pairs('m.id = OLD.id', -1)}
+            END""",
+        'opening_matchups_match_update_new': f"""AFTER UPDATE ON matches WHEN {match_changed} BEGIN
+              {opening_matchup_pairs('m.id = NEW.id', 1)}
+            END""",
+        'opening_matchups_player_insert': f"""AFTER INSERT ON match_players BEGIN
+              {opening_matchup_pairs('m.id = NEW.match_id AND (a.id = NEW.id OR b.id = NEW.id)', 1)}
+            END""",
+        'opening_matchups_player_delete': f"""BEFORE DELETE ON match_players BEGIN
+              {opening_matchup_pairs('m.id = OLD.match_id AND (a.id = OLD.id OR b.id = OLD.id)', -1)}
+            END""",
+        'opening_matchups_player_update_old': f"""BEFORE UPDATE ON match_players WHEN {match_player_changed} BEGIN
+              {opening_matchup_pairs('m.id = OLD.match_id AND (a.id = OLD.id OR b.id = OLD.id)', -1)}
+            END""",
+        'opening_matchups_player_update_new': f"""AFTER UPDATE ON match_players WHEN {match_player_changed} BEGIN
+              {opening_matchup_pairs('m.id = NEW.match_id AND (a.id = NEW.id OR b.id = NEW.id)', 1)}
+            END""",
+    }
+    try:
+        with transaction() as conn:
+            for sql_command in sql_commands:
+                conn.execute(sql_command)
+            existing = dict(conn.execute(
+                """SELECT name, sql FROM sqlite_master
+                     WHERE type = 'trigger' AND name LIKE 'opening_matchups_%'"""))
+            changed = False
+            for name, body in triggers.items():
+                sql_command = f"CREATE TRIGGER {name} {body}"
+                if ' '.join(existing.pop(name, '').split()) != ' '.join(sql_command.split()):
+                    conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+                    conn.execute(sql_command)
+                    changed = True
+            for name in existing:
+                conn.execute(f"DROP TRIGGER {name}")
+                changed = True
+            if changed:
+                print('Building opening matchup aggregates')
+                rebuild_opening_matchups(conn)
+    except Exception as e:
+        print(e)
+    forget_tables()
+
+
+def rebuild_opening_matchups(conn):
+    conn.execute("DELETE FROM opening_matchup_counts")
+    conn.execute(
+        f"""INSERT INTO opening_matchup_counts
+              ({OPENING_MATCHUP_COLUMNS}, games, a_wins, a_losses, a_unknown, b_wins)
+              SELECT m.ladder_id, m.patch_id, m.map_id, {elo_bucket_sql('m.average_elo')},
+                     a.civilization, b.civilization, a.opening_id, b.opening_id,
+                     COUNT(*), SUM(a.victory IS 1), SUM(a.victory IS 0),
+                     SUM(a.victory IS -1), SUM(b.victory IS 1)
+                FROM matches m
+                JOIN match_players a on a.match_id = m.id
+                JOIN match_players b on b.match_id = m.id
+                WHERE a.id != b.id
+                GROUP BY 1, 2, 3, 4, 5, 6, 7, 8""")
+
+
+### CONNECTION MANAGEMENT ###
+
+# Connections are reused instead of opened per call. Each thread gets its own
+# read connection per db file and the process has a single write connection,
+# shared between threads behind write_lock and only used inside transaction().
+# sqlite3 keeps STATEMENT_CACHE_SIZE prepared statements per connection so
+# reuse also keeps the statements warm. Connections belong to the process
+# that opened them, a forked child drops what it inherited and opens its own.
+# foreign_keys is left at sqlite's default (off). Schema setup used to switch
+# it on for its own short lived connection only, so no writer ever enforced
+# the constraints and bulk copies don't pay for the checks
+STATEMENT_CACHE_SIZE = 256
+CONNECTION_TIMEOUT = 300
+
+# Opt in profile for many processes sharing one db (the MS API crawler),
+# turned on with enable_wal_profile() or AOE_DB_PROFILE=wal. Readers no longer
+# block writers, writers take the lock up front with BEGIN IMMEDIATE so the
+# wait can be timed, and checkpoints run on a schedule
+WAL_PROFILE = os.environ.get('AOE_DB_PROFILE') == 'wal'
+WAL_PRAGMAS = [
+    "PRAGMA synchronous = NORMAL",  # only the wal is synced, safe in wal mode
+    "PRAGMA cache_size = -65536",  # 64MB page cache
+    "PRAGMA mmap_size = 268435456",  # read the first 256MB through mmap
+    "PRAGMA temp_store = MEMORY",
+]
+CHECKPOINT_INTERVAL = 60  # seconds between passive checkpoints per writer
+SLOW_WRITER_WAIT = 5  # seconds, longer waits for the write lock are printed
+
+connection_pid = os.getpid()
+read_connections = threading.local()
+write_connections = {}
+write_lock = threading.RLock()
+write_depth = 0
+last_checkpoint = time.monotonic()
+
+
+def open_connection(check_same_thread=True, write=False):
+    conn = sqlite3.connect(DB_FILE, timeout=CONNECTION_TIMEOUT,
+                           cached_statements=STATEMENT_CACHE_SIZE,
+                           check_same_thread=check_same_thread)
+    if WAL_PROFILE:
+        if write:
+            #stored in the db file, readers pick it up from there
+            conn.execute("PRAGMA journal_mode = WAL")
+        for pragma in WAL_PRAGMAS:
+            conn.execute(pragma)
+    return conn
+
+
+def enable_wal_profile():
+    global WAL_PROFILE
+    WAL_PROFILE = True
+    #reopen with the profile's pragmas
+    close_connections()
+
+
+def check_process():
+    #after a fork the parent's connections must not be touched, forget them
+    global connection_pid, read_connections, write_connections, write_lock, write_depth
+    if connection_pid != os.getpid():
+        connection_pid = os.getpid()
+        read_connections = threading.local()
+        write_connections = {}
+        write_lock = threading.RLock()
+        write_depth = 0
+
+
+def get_read_connection():
+    check_process()
+    if not hasattr(read_connections, 'by_file'):
+        read_connections.by_file = {}
+    conn = read_connections.by_file.get(DB_FILE)
+    if conn is None:
+        conn = open_connection()
+        read_connections.by_file[DB_FILE] = conn
+    return conn
+
+
+def begin_write(conn):
+    #wait for the db write lock now instead of on the first insert
+    start = time.perf_counter()
+    conn.execute("BEGIN IMMEDIATE")
+    wait = time.perf_counter() - start
+    if stage_timing.ENABLED:
+        stage_timing.record('writer_wait', wait)
+    if wait > SLOW_WRITER_WAIT:
+        print(f'Waited {wait:.1f}s for the db write lock (pid {os.getpid()})')
+
+
+def checkpoint(conn):
+    global last_checkpoint
+    if time.monotonic() - last_checkpoint < CHECKPOINT_INTERVAL:
+        return
+    last_checkpoint = time.monotonic()
+    with stage_timing.stage('checkpoint'):
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+
+
+def get_write_connection():
+    #callers hold write_lock
+    conn = write_connections.get(DB_FILE)
+    if conn is None:
+        conn = open_connection(check_same_thread=False, write=True)
+        write_connections[DB_FILE] = conn
+    return conn
+
+
+@contextmanager
+def attached(db_file, name):
+    #attaches another db to the write connection, sqlite only allows it
+    #outside of a transaction so open this before transaction()
+    check_process()
+    with write_lock:
+        conn = get_write_connection()
+        conn.execute("ATTACH DATABASE ? AS " + name, (db_file,))
+        try:
+            yield conn
+        finally:
+            conn.execute("DETACH DATABASE " + name)
+
+
+@contextmanager
+def transaction():
+    #commits when the outermost scope exits cleanly, rolls back if it raises.
+    #Nested scopes join the outer one
+    global write_depth
+    check_process()
+    with write_lock:
+        conn = get_write_connection()
+        write_depth += 1
+        try:
+            if write_depth == 1 and WAL_PROFILE and not conn.in_transaction:
+                begin_write(conn)
+            yield conn
+            if write_depth == 1:
+                conn.commit()
+                if WAL_PROFILE:
+                    checkpoint(conn)
+        except BaseException:
+            if write_depth == 1:
+                conn.rollback()
+            raise
+        finally:
+            write_depth -= 1
+
+
+def close_connections():
+    check_process()
+    with write_lock:
+        for conn in write_connections.values():
+            conn.close()
+        write_connections.clear()
+    #other threads' read connections close when their thread goes away
+    for conn in getattr(read_connections, 'by_file', {}).values():
+        conn.close()
+    read_connections.by_file = {}
+
+
+atexit.register(close_connections)
 
 
 ### UNIVERSAL SQL FUNCTIONS ###
 
 def connect_and_modify(statement, args, conn=None):
     try:
-        manage_conn = False;
-        if conn is None:
-          conn = sqlite3.connect(DB_FILE, timeout=300)
-          manage_conn = True;
-        c = conn.cursor()
-        c.execute(statement, args)
-        if manage_conn:
-          conn.commit()
+        if conn is not None:
+            conn.execute(statement, args)
+            return
+        with transaction() as conn:
+            conn.execute(statement, args)
     except Exception as e:
         print(e)
-    finally:
-        if manage_conn:
-          conn.close()
 
 
 def connect_and_modify_with_generator(generator, conn=None):
     try:
-        manage_conn = False;
-        if conn is None:
-          conn = sqlite3.connect(DB_FILE, timeout=300)
-          manage_conn = True;
-        c = conn.cursor()
-        for statement, args in generator:
-            c.execute(statement, args)
-        if manage_conn:
-          conn.commit()
+        if conn is not None:
+            for statement, args in generator:
+                conn.execute(statement, args)
+            return
+        with transaction() as conn:
+            for statement, args in generator:
+                conn.execute(statement, args)
     except Exception as e:
         print(e)
-    finally:
-        if manage_conn:
-          conn.close()
 
 
 def connect_and_return(statement, args, conn=None):
+    if CHECK_QUERY_PLANS:
+        check_query_plan(conn or get_read_connection(), statement, args)
     try:
-        manage_conn = False;
         if conn is None:
-          conn = sqlite3.connect(DB_FILE, timeout=300)
-          manage_conn = True;
+          conn = get_read_connection()
         c = conn.cursor()
         if args is None:
             c.execute(statement)
@@ -281,15 +707,14 @@ def connect_and_return(statement, args, conn=None):
         return c.fetchall()
     except Exception as e:
         print(e)
-    finally:
-        if manage_conn:
-          conn.close()
 
 
 def connect_and_return_with_list(operations):
+    if CHECK_QUERY_PLANS:
+        for statement, args in operations:
+            check_query_plan(get_read_connection(), statement, args)
     try:
-        conn = sqlite3.connect(DB_FILE, timeout=300)
-        c = conn.cursor()
+        c = get_read_connection().cursor()
         return_list = []
         for statement, args in operations:
             c.execute(statement, args)
@@ -297,26 +722,10 @@ def connect_and_return_with_list(operations):
         return return_list
     except Exception as e:
         print(e)
-    finally:
-        conn.close()
 
 
 def connect_and_modify_with_list(operations, conn=None):
-    try:
-        manage_conn = False;
-        if conn is None:
-          conn = sqlite3.connect(DB_FILE, timeout=300)
-          manage_conn = True;
-        c = conn.cursor()
-        for statement, args in operations:
-            c.execute(statement, args)
-        if manage_conn:
-          conn.commit()
-    except Exception as e:
-        print(e)
-    finally:
-        if manage_conn:
-          conn.close()
+    connect_and_modify_with_generator(operations, conn)
 
 
 def add_player(player_id):
@@ -347,6 +756,33 @@ def update_match_player(opening_id, match_player_id):
             (opening_id, aoe_replay_stats.PARSER_VERSION, match_player_id))
 
 
+def update_match_player_openings(match_player_ids, opening_ids):
+    #one executemany for a whole batch of classified match players, their
+    #rule versions are set to the current ones in the same transaction. A
+    #missing row reads as BASE_RULE_VERSION so those aren't written
+    statement = """UPDATE match_players
+                        SET opening_id = ?, parser_version = ?, time_parsed = CURRENT_TIMESTAMP
+                        WHERE id = ?"""
+    rows = [(int(opening_id), aoe_replay_stats.PARSER_VERSION, int(match_player_id))
+            for match_player_id, opening_id in zip(match_player_ids, opening_ids)]
+    version_statement = """INSERT INTO opening_rule_versions
+                           (match_player_id, rule, version) VALUES (?,?,?)
+                           ON CONFLICT(match_player_id, rule)
+                           DO UPDATE SET version = excluded.version"""
+    versions = [(rule, version) for rule, (version, mask)
+                in aoe_replay_stats.OPENING_RULE_VERSIONS.items()
+                if version != aoe_replay_stats.BASE_RULE_VERSION]
+    version_rows = [(int(match_player_id), rule, version)
+                    for match_player_id in match_player_ids
+                    for rule, version in versions]
+    try:
+        with transaction() as conn:
+            conn.executemany(statement, rows)
+            conn.executemany(version_statement, version_rows)
+    except Exception as e:
+        print(e)
+
+
 def add_unparsed_match_player(player_id, match_id, civilization, victory, elo, conn=None):
     connect_and_modify(
         """INSERT OR IGNORE INTO match_players(player_id, match_id, civilization, victory, elo) VALUES
@@ -364,30 +800,6 @@ def match_player_actions_generator(match_player_id, action_list):
                           unique_action.duration)
 
 
-def flat_match_player_actions_generator_from_actions(match_player_actions,
-                                                match_id,
-                                                player_id):
-    statement = """INSERT OR IGNORE INTO match_player_actions
-                   (match_id, player_id, event_type, event_id, time, duration)
-                   VALUES (?,?,?,?,?,?)"""
-    for id_old, match_player_id_old, event_type, event_id, time, duration in match_player_actions:
-        if event_type != aoe_replay_stats.EventType.TECH.value:
-            continue
-        yield statement, (match_id, player_id, event_type, event_id, time, duration)
-
-def match_player_actions_generator_from_actions(match_player_actions,
-                                                match_player_id,
-                                                minimal_import):
-    statement = """INSERT OR IGNORE INTO match_player_actions
-                   (match_player_id, event_type, event_id, time, duration)
-                   VALUES (?,?,?,?,?)"""
-    for id_old, match_player_id_old, event_type, event_id, time, duration in match_player_actions:
-        if minimal_import:
-            if event_type != aoe_replay_stats.EventType.TECH.value:
-                continue
-        yield statement, (match_player_id, event_type, event_id, time, duration)
-
-
 def get_match_player_actions(match_player_id):
     match_player_actions = connect_and_return(
         "SELECT * FROM match_player_actions WHERE match_player_id = ?",
@@ -398,15 +810,86 @@ def get_match_player_actions(match_player_id):
 
 
 def add_match_player_actions(match_player_id, action_list, conn=None):
-    generator = match_player_actions_generator(match_player_id, action_list)
-    connect_and_modify_with_generator(generator, conn)
+    rows = [(match_player_id, action.event_type.value, action.id,
+             action.timestamp, action.duration) for action in action_list]
+    try:
+        if conn is not None:
+            conn.executemany(MATCH_PLAYER_ACTION_INSERT, rows)
+            return
+        with transaction() as conn:
+            conn.executemany(MATCH_PLAYER_ACTION_INSERT, rows)
+    except Exception as e:
+        print(e)
+
+
+class MatchIndex:
+    # Known match ids kept in memory: a sorted int64 array read in one query
+    # plus a set of ids added since, folded into the array once it grows.
+    # Loaded before the crawler forks its consumers they all share the array
+    # pages copy on write. Ids it doesn't know are confirmed against the db
+    # together, one query per id_filters chunk, so matches stored by another
+    # process are never fetched twice
+
+    MERGE_SIZE = 65536
+
+    def __init__(self):
+        self.db_file = None
+        self.ids = np.empty(0, dtype=np.int64)
+        self.added = set()
+
+    def load(self):
+        self.db_file = DB_FILE
+        c = get_read_connection().cursor()
+        c.execute("SELECT id FROM matches ORDER BY id")
+        self.ids = np.fromiter((row[0] for row in c), dtype=np.int64)
+        self.added = set()
+
+    def add(self, match_ids):
+        self.added.update(int(match_id) for match_id in match_ids)
+        if len(self.added) >= self.MERGE_SIZE:
+            self.ids = np.union1d(self.ids, np.fromiter(self.added, dtype=np.int64))
+            self.added = set()
+
+    def known(self, match_ids):
+        match_ids = np.asarray(match_ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            found = np.zeros(len(match_ids), dtype=bool)
+        else:
+            positions = np.minimum(np.searchsorted(self.ids, match_ids), len(self.ids) - 1)
+            found = self.ids[positions] == match_ids
+        return [bool(k) or int(match_id) in self.added
+                for match_id, k in zip(match_ids, found)]
+
+    def filter_unknown(self, match_ids, conn=None):
+        if self.db_file != DB_FILE:
+            self.load()
+        match_ids = list(match_ids)
+        unknown = [match_id for match_id, known in zip(match_ids, self.known(match_ids))
+                   if not known]
+        in_db = set()
+        for where, args in id_filters('id', sorted(set(unknown))):
+            rows = connect_and_return(f"SELECT id FROM matches WHERE {where}",
+                                      args, conn)
+            in_db.update(row[0] for row in rows or ())
+        if in_db:
+            self.add(in_db)
+        return [match_id for match_id in unknown if match_id not in in_db]
+
+
+match_index = MatchIndex()
+
+
+def load_match_index():
+    match_index.load()
+
+
+def filter_unknown(match_ids, conn=None):
+    #the ids from match_ids that aren't stored yet, in the same order
+    return match_index.filter_unknown(match_ids, conn)
 
 
 def does_match_exist(match_id):
-    match = connect_and_return("SELECT * FROM matches WHERE id=?", (match_id,))
-    if match is None or len(match) == 0:
-        return False
-    return True
+    return not filter_unknown([match_id])
 
 
 def get_match_players(match_id):
@@ -424,16 +907,80 @@ def get_match_player_id(player_id, match_id, conn=None):
     return match_player_id[0][0]
 
 
+def needing_update_condition():
+    #rows from an older parser need everything, otherwise only rows holding an
+    #older version of some rule group
+    condition = "parser_version < ?"
+    args = [aoe_replay_stats.PARSER_VERSION]
+    for rule, (version, mask) in aoe_replay_stats.OPENING_RULE_VERSIONS.items():
+        if version <= aoe_replay_stats.BASE_RULE_VERSION:
+            continue
+        condition += """ OR COALESCE((SELECT version FROM opening_rule_versions
+                                      WHERE match_player_id = match_players.id AND rule = ?), ?) < ?"""
+        args += [rule, aoe_replay_stats.BASE_RULE_VERSION, version]
+    return f"({condition})", args
+
+
 def get_match_players_needing_update():
-    #Added small thing to ignore first 1m matches when searching, remove this if you need a whole db update
+    condition, args = needing_update_condition()
     match_players = connect_and_return(
-        "SELECT * FROM match_players WHERE parser_version < ? AND match_id > 272400210",
-        (aoe_replay_stats.PARSER_VERSION,))
+        f"SELECT * FROM match_players WHERE {condition}", args)
     if len(match_players) == 0:
         return None
     return match_players
 
 
+def count_match_players_needing_update():
+    condition, args = needing_update_condition()
+    return connect_and_return(
+        f"SELECT COUNT(*) FROM match_players WHERE {condition}", args)[0][0]
+
+
+def stream_match_players_needing_update(chunk_size):
+    #Yields (match_players, action arrays) a chunk at a time, paged by match
+    #player id so memory stays at one chunk. Each page is read in full before
+    #the caller writes, an open cursor would keep the read lock through the
+    #writes in the default journal mode
+    condition, args = needing_update_condition()
+    statement = f"""SELECT * FROM match_players
+                      WHERE id > ? AND {condition}
+                      ORDER BY id LIMIT ?"""
+    last_id = -1
+    while True:
+        match_players = connect_and_return(statement, [last_id] + args + [chunk_size])
+        if not match_players:
+            return
+        last_id = match_players[-1][0]
+        with stage_timing.stage('load_actions'):
+            actions = get_action_arrays_for_match_players(match_players)
+        yield match_players, actions
+
+
+def id_filters(column, ids, reserved=0):
+    #(condition, args) pairs covering sorted, unique ids a chunk at a time,
+    #each with at most MAX_BOUND_PARAMETERS args counting the reserved ones
+    #the caller adds. A chunk without gaps is a range scan instead of an IN
+    size = MAX_BOUND_PARAMETERS - reserved
+    for start in range(0, len(ids), size):
+        chunk = ids[start:start + size]
+        if chunk[-1] - chunk[0] == len(chunk) - 1:
+            yield f'{column} BETWEEN ? AND ?', [chunk[0], chunk[-1]]
+        else:
+            yield f"{column} IN ({','.join('?' * len(chunk))})", chunk
+
+
+def get_rule_versions_for_match_players(match_player_list):
+    #{match_player_id: {rule: version}}, players without rows are left out
+    ids = sorted(set(match_player[0] for match_player in match_player_list))
+    rule_versions = {}
+    for condition, args in id_filters('match_player_id', ids):
+        for match_player_id, rule, version in connect_and_return(
+                f"""SELECT match_player_id, rule, version FROM opening_rule_versions
+                      WHERE {condition}""", args):
+            rule_versions.setdefault(match_player_id, {})[rule] = version
+    return rule_versions
+
+
 def get_actions_for_match_player(match_player_id):
     match_player_actions = connect_and_return(
         "SELECT * FROM match_player_actions WHERE match_player_id = ?",
@@ -444,82 +991,451 @@ def get_actions_for_match_player(match_player_id):
 
 
 def get_actions_for_match_players(match_player_list):
-    operations = []
-    for match_player in match_player_list:
-        operations.append(
-            ("SELECT * FROM match_player_actions WHERE match_player_id = ?",
-             (match_player[0],)))
-    match_players_actions = connect_and_return_with_list(operations)
-    if len(match_players_actions) == 0:
-        return None
-    return match_players_actions
+    #ordered queries over the page's id range, split back into a list of rows
+    #per match player
+    ids = [match_player[0] for match_player in match_player_list]
+    by_id = {}
+    for condition, args in id_filters('match_player_id', sorted(set(ids))):
+        rows = connect_and_return(
+            f"""SELECT * FROM match_player_actions
+                  WHERE {condition}
+                  ORDER BY match_player_id, id""", args)
+        if rows is None:
+            return None
+        for row in rows:
+            by_id.setdefault(row[1], []).append(row)
+    return [by_id.get(match_player_id, []) for match_player_id in ids]
+
+
+def pack_actions(actions):
+    #(event_type, event_id, time, duration) tuples to a compact blob
+    return np.array(actions, dtype=ACTION_RECORD).tobytes()
+
+
+def unpack_actions(blob):
+    #a read only view of the blob, nothing is copied
+    return np.frombuffer(blob, dtype=ACTION_RECORD)
+
+
+def filter_packed_actions(blob, event_type):
+    #the blob with only the actions of one event type
+    record = unpack_actions(blob)
+    return record[record['event_type'] == event_type].tobytes()
+
+
+known_tables = {}
+
+
+def has_table(name):
+    #cached per db, tables added by later schema updates may be missing
+    if (DB_FILE, name) not in known_tables:
+        known_tables[(DB_FILE, name)] = bool(connect_and_return(
+            "SELECT 1 FROM sqlite_master WHERE name = ?", (name,)))
+    return known_tables[(DB_FILE, name)]
+
+
+def has_action_blobs():
+    #dbs from before the compact layout have no blob table
+    return has_table('match_player_action_blobs')
+
+
+def get_action_arrays(match_player_ids, event_type=None, event_ids=None):
+    #Actions of the match players from either layout, as numpy columns
+    #(match_player_id, event_type, event_id, time, duration) ordered by match
+    #player then action. Optionally only one event type and some event ids
+    match_player_ids = sorted(set(match_player_ids))
+    filters = ""
+    filter_args = []
+    if event_type is not None:
+        #a literal so the partial tech index can be used
+        filters += f" AND event_type = {int(event_type)}"
+    if event_ids is not None:
+        filters += f" AND event_id IN ({','.join('?' * len(event_ids))})"
+        filter_args += list(event_ids)
+    group_ids = []
+    records = []
+    for condition, ids in id_filters('match_player_id', match_player_ids,
+                                     len(filter_args)):
+        rows = connect_and_return(
+            f"""SELECT match_player_id, event_type, event_id, time, duration
+                  FROM match_player_actions
+                  WHERE {condition}{filters}
+                  ORDER BY match_player_id, id""", ids + filter_args)
+        if rows:
+            columns = np.array(rows, dtype=np.int64)
+            group_ids.append(columns[:, 0])
+            record = np.empty(len(rows), dtype=ACTION_RECORD)
+            for i, name in enumerate(ACTION_RECORD.names):
+                record[name] = columns[:, i + 1]
+            records.append(record)
+        if not has_action_blobs():
+            continue
+        blobs = connect_and_return(
+            f"""SELECT match_player_id, actions FROM match_player_action_blobs
+                  WHERE {condition}""", ids)
+        if blobs:
+            #one view over all the blobs of the chunk
+            record = unpack_actions(b''.join(blob for match_player_id, blob in blobs))
+            group_ids.append(np.repeat(
+                np.array([match_player_id for match_player_id, blob in blobs], dtype=np.int64),
+                [len(blob) // ACTION_RECORD.itemsize for match_player_id, blob in blobs]))
+            records.append(record)
+    if not records:
+        return tuple(np.zeros(0, dtype=np.int64) for i in range(5))
+    group_ids = np.concatenate(group_ids)
+    record = np.concatenate(records)
+    #a match player is only in one layout, a stable sort keeps action order
+    order = np.argsort(group_ids, kind='stable')
+    group_ids = group_ids[order]
+    record = record[order]
+    keep = np.ones(len(record), dtype=bool)
+    if event_type is not None:
+        keep &= record['event_type'] == event_type
+    if event_ids is not None:
+        keep &= np.isin(record['event_id'], list(event_ids))
+    return (group_ids[keep],) + tuple(record[name][keep].astype(np.int64)
+                                      for name in ACTION_RECORD.names)
+
+
+def get_action_arrays_for_match_players(match_player_list):
+    #(match_player_id, event_type, event_id, time) columns for reanalysis
+    return get_action_arrays(
+        [match_player[0] for match_player in match_player_list])[:4]
+
+
+def convert_to_compact_actions(chunk_size=COMPACT_CHUNK_SIZE):
+    #Moves action rows into blobs a chunk of match players per transaction,
+    #so an interrupted run can simply be restarted, then vacuums the db
+    start = time.perf_counter()
+    converted = 0
+    while True:
+        with transaction() as conn:
+            ids = [row[0] for row in conn.execute(
+                """SELECT DISTINCT match_player_id FROM match_player_actions
+                     ORDER BY match_player_id LIMIT ?""", (chunk_size,))]
+            if not ids:
+                break
+            actions = {}
+            #a match player that already has a blob keeps it first
+            for condition, args in id_filters('match_player_id', ids):
+                for match_player_id, blob in conn.execute(
+                        f"""SELECT match_player_id, actions FROM match_player_action_blobs
+                              WHERE {condition}""", args):
+                    actions[match_player_id] = [tuple(record) for record in unpack_actions(blob).tolist()]
+            #every match player with action rows in the range is in ids
+            for match_player_id, event_type, event_id, action_time, duration in conn.execute(
+                    """SELECT match_player_id, event_type, event_id, time, duration
+                         FROM match_player_actions
+                         WHERE match_player_id BETWEEN ? AND ?
+                         ORDER BY match_player_id, id""", (ids[0], ids[-1])):
+                actions.setdefault(match_player_id, []).append(
+                    (event_type, event_id, action_time, duration))
+            conn.executemany(
+                "INSERT OR REPLACE INTO match_player_action_blobs(match_player_id, actions) VALUES (?,?)",
+                [(match_player_id, pack_actions(rows)) for match_player_id, rows in actions.items()])
+            conn.execute(
+                "DELETE FROM match_player_actions WHERE match_player_id BETWEEN ? AND ?",
+                (ids[0], ids[-1]))
+        converted += len(ids)
+        print(f'Converted actions of {converted} match players')
+    print(f'Converted {converted} match players in {time.perf_counter() - start:.1f}s, vacuuming')
+    check_process()
+    with write_lock:
+        get_write_connection().execute("VACUUM")
+
+
+def parse_match(match_id, player_id_elo_list, ladder_id, file_data,
+                patch_number, cutoff_time=None, cutoff_age=None):
+    players, header, civs, loser_ids = aoe_replay_stats.parse_replay(
+        file_data, cutoff_time, cutoff_age)
+    player_ids = [player["id"] for player in player_id_elo_list]
+    average_elo = sum(player["elo"] for player in player_id_elo_list) / len(player_id_elo_list)
+    if len(player_id_elo_list) > 2:
+      ladder_id = ladder_id * 100 + int(len(player_id_elo_list)/2)
+
+    match_players = []
+    player_num = 0
+    for i in range(len(players)):
+        if not players[i]:
+            continue
+        winner_value = -1
+        if loser_ids is not None:
+            if i in loser_ids:
+                winner_value = 0
+            else:
+                winner_value = 1
+        actions = [(action.event_type.value, action.id, action.timestamp,
+                    action.duration) for action in players[i]]
+        match_players.append(
+            ParsedMatchPlayer(player_id_elo_list[player_num]["id"],
+                              header.de.players[player_num].civ_id,
+                              winner_value,
+                              player_id_elo_list[player_num]["elo"],
+                              actions))
+        player_num += 1
+    return ParsedMatch(match_id, average_elo, header.de.selected_map_id,
+                       header.save_version, ladder_id, patch_number,
+                       player_ids, match_players)
+
+
+def store_parsed_match(parsed, conn):
+    #caller owns conn and the transaction
+    with stage_timing.stage('store_match'):
+        write_parsed_matches([parsed], conn)
+
+
+# INSERT ... RETURNING needs sqlite 3.35, older libraries look the ids up
+RETURNING_SUPPORTED = sqlite3.sqlite_version_info >= (3, 35, 0)
+# rows per multi row INSERT, keeps the bound parameters far below the limit
+MATCH_PLAYER_INSERT_ROWS = 150
+
+MATCH_PLAYER_ACTION_INSERT = """INSERT OR IGNORE INTO match_player_actions
+                   (match_player_id, event_type, event_id, time, duration)
+                   VALUES (?,?,?,?,?)"""
+
+
+def insert_match_players(rows, conn):
+    #rows of (player_id, match_id, civilization, victory, elo), returns
+    #{(player_id, match_id): match_player_id} with the ids taken from the
+    #insert itself
+    ids = {}
+    if RETURNING_SUPPORTED:
+        for start in range(0, len(rows), MATCH_PLAYER_INSERT_ROWS):
+            chunk = rows[start:start + MATCH_PLAYER_INSERT_ROWS]
+            statement = ("INSERT OR IGNORE INTO match_players(player_id, match_id, civilization, victory, elo) VALUES "
+                         + ",".join(["(?,?,?,?,?)"] * len(chunk))
+                         + " RETURNING id, player_id, match_id")
+            for match_player_id, player_id, match_id in conn.execute(
+                    statement, [value for row in chunk for value in row]):
+                ids[(player_id, match_id)] = match_player_id
+    else:
+        conn.executemany(
+            """INSERT OR IGNORE INTO match_players(player_id, match_id, civilization, victory, elo) VALUES
+                            (?,?,?,?,?)""", rows)
+    #ignored rows (already stored) return nothing, look those up
+    for player_id, match_id, civilization, victory, elo in rows:
+        if (player_id, match_id) not in ids:
+            ids[(player_id, match_id)] = get_match_player_id(player_id, match_id, conn)
+    return ids
+
+
+def write_parsed_matches(parsed_matches, conn):
+    #one executemany per table for the whole list of matches
+    with stage_timing.stage('insert_matches'):
+        conn.executemany("INSERT OR IGNORE INTO players(id) VALUES(?)",
+                         [(player_id,) for parsed in parsed_matches
+                          for player_id in parsed.player_ids])
+        conn.executemany(
+            "INSERT OR IGNORE INTO matches(id, average_elo, map_id, patch_id, ladder_id, patch_number) VALUES(?,?,?,?,?,?)",
+            [(parsed.match_id, parsed.average_elo, parsed.map_id,
+              parsed.save_version, parsed.ladder_id, parsed.patch_number)
+             for parsed in parsed_matches])
+    with stage_timing.stage('insert_match_players'):
+        match_player_ids = insert_match_players(
+            [(match_player.player_id, parsed.match_id,
+              match_player.civilization, match_player.victory,
+              match_player.elo)
+             for parsed in parsed_matches
+             for match_player in parsed.match_players], conn)
+    with stage_timing.stage('insert_actions'):
+        if COMPACT_ACTIONS:
+            conn.executemany(
+                "INSERT OR IGNORE INTO match_player_action_blobs(match_player_id, actions) VALUES (?,?)",
+                ((match_player_ids[(match_player.player_id, parsed.match_id)],
+                  pack_actions(match_player.actions))
+                 for parsed in parsed_matches
+                 for match_player in parsed.match_players))
+        else:
+            conn.executemany(
+                MATCH_PLAYER_ACTION_INSERT,
+                ((match_player_ids[(match_player.player_id, parsed.match_id)],) + action
+                 for parsed in parsed_matches
+                 for match_player in parsed.match_players
+                 for action in match_player.actions))
 
 
 def parse_replay_file(match_id, player_id_elo_list, ladder_id,
-                      file_data, patch_number):
+                      file_data, patch_number, cutoff_time=None,
+                      cutoff_age=None):
     #match already in db!
     if does_match_exist(match_id):
         return False
     try:
-        players, header, civs, loser_ids = aoe_replay_stats.parse_replay(
-            file_data)
+        parsed = parse_match(match_id, player_id_elo_list, ladder_id,
+                             file_data, patch_number, cutoff_time, cutoff_age)
     except Exception as e:
         print(e)
         return False
-    player_ids = [player["id"] for player in player_id_elo_list]
-    average_elo = sum(player["elo"] for player in player_id_elo_list) / len(player_id_elo_list)
-    if len(player_id_elo_list) > 2:
-      ladder_id = ladder_id * 100 + int(len(player_id_elo_list)/2)
-    player_num = 0
-
-    #now plug it into the db!
-    #first add players
-    operations = []
-    for player_id in player_ids:
-      operations.append(add_player(player_id))
-    operations.append(
-        add_match(match_id, average_elo, header.de.selected_map_id,
-                  header.save_version, ladder_id, patch_number))
 
-    # Manage connection ourselve to improve speed
     try:
-        conn = sqlite3.connect(DB_FILE, timeout=300)
-        connect_and_modify_with_list(operations, conn)
-        operations = []
-        for i in range(len(players)):
-            if not players[i]:
-                continue
-            # now add match player
-            winner_value = -1
-            if loser_ids is not None:
-                if i in loser_ids:
-                    winner_value = 0
-                else:
-                    winner_value = 1
-            player_id = player_id_elo_list[player_num]["id"]
-            player_elo = player_id_elo_list[player_num]["elo"]
-            #first add template match_player with basic info
-            add_unparsed_match_player(player_id, match_id,
-                                      header.de.players[player_num].civ_id,
-                                      winner_value,
-                                      player_elo, conn)
-            match_player_id = get_match_player_id(player_id, match_id, conn)
-            #now add player actions
-            add_match_player_actions(match_player_id, players[i], conn)
-            player_num += 1
-        conn.commit()
+        with transaction() as conn:
+            store_parsed_match(parsed, conn)
+        match_index.add([match_id])
     except Exception as e:
         print(e)
-    finally:
-        conn.close()
 
 
     return True
 
 
+def import_worker_settings():
+    #what the folder import workers need from this process's module globals
+    cache = aoe_replay_stats.replay_cache
+    return (aoe_replay_stats.SELECTIVE_DECODING,
+            None if cache is None else (cache.directory, cache.max_bytes),
+            COMPACT_ACTIONS, stage_timing.ENABLED)
+
+
+def init_import_worker(selective, cache, compact_actions, timing):
+    #Pool initializer, spawned workers (the default on macOS and Windows)
+    #start from the module defaults instead of inheriting the parent's
+    global COMPACT_ACTIONS
+    aoe_replay_stats.SELECTIVE_DECODING = selective
+    if cache is None:
+        aoe_replay_stats.replay_cache = None
+    else:
+        aoe_replay_stats.enable_replay_cache(*cache)
+    COMPACT_ACTIONS = compact_actions
+    if timing:
+        #the parent prints the merged report
+        stage_timing.enable(dump_at_exit=False)
+
+
+def parse_replay_path(item):
+    #worker side of the folder import, errors are returned instead of raised
+    #so one bad replay can't stop the run
+    file, match_id, player1_id, player2_id, average_elo, ladder_id = item
+    try:
+        #only the average elo is known from the file name
+        player_id_elo_list = [{"id": int(player1_id), "elo": int(average_elo)},
+                              {"id": int(player2_id), "elo": int(average_elo)}]
+        #patch isn't in the file name, mark it invalid
+        parsed = parse_match(int(match_id), player_id_elo_list,
+                             int(ladder_id), file, -1)
+        error = None
+    except Exception as e:
+        parsed = None
+        error = f'{type(e).__name__}: {e}'
+    return (file, parsed, error, stage_timing.take(),
+            aoe_replay_stats.take_cache_counts())
+
+
+def write_parsed_batch(batch, delete_replay_after_parse):
+    #one transaction per batch, files are only deleted once it is committed
+    stored = []
+    with transaction() as conn:
+        with stage_timing.stage('store_match'):
+            new_matches = []
+            unknown = set(filter_unknown([parsed.match_id for file, parsed in batch], conn))
+            for file, parsed in batch:
+                #match already in db or earlier in the batch!
+                if parsed.match_id not in unknown:
+                    continue
+                unknown.discard(parsed.match_id)
+                new_matches.append(parsed)
+                stored.append(file)
+            write_parsed_matches(new_matches, conn)
+    match_index.add(parsed.match_id for parsed in new_matches)
+    if delete_replay_after_parse:
+        for file in stored:
+            os.remove(file)
+    return len(stored)
+
+
+def import_folder(input_folder, delete_replay_after_parse, processes=None):
+    #workers parse replays in parallel, this process is the only db writer
+    items = []
+    failed = 0
+    for file in os.listdir(input_folder):
+        file = os.path.join(input_folder, file)
+        if not os.path.isfile(file):
+            continue
+        #important info in the map name
+        try:
+            item = (file,) + grab_replays_for_player.parse_filename(file)
+        except Exception as e:
+            failed += 1
+            print(f'{file}: {type(e).__name__}: {e}')
+            continue
+        items.append(item)
+    #match already in db!
+    unknown = set(filter_unknown([int(item[1]) for item in items]))
+    items = [item for item in items if int(item[1]) in unknown]
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    batch = []
+    stored = 0
+    done = 0
+    cache_hits = 0
+    cache_misses = 0
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=init_import_worker,
+                                    initargs=import_worker_settings())
+        results = pool.imap_unordered(parse_replay_path, items, chunksize=4)
+    else:
+        results = map(parse_replay_path, items)
+    try:
+        for file, parsed, error, timings, (hits, misses) in results:
+            #workers keep their own timings and cache counts, fold them into ours
+            stage_timing.merge(timings)
+            cache_hits += hits
+            cache_misses += misses
+            done += 1
+            if error is not None:
+                failed += 1
+                print(f'{file}: {error}')
+            else:
+                batch.append((file, parsed))
+            if len(batch) >= WRITE_BATCH_SIZE:
+                stored += write_parsed_batch(batch, delete_replay_after_parse)
+                batch = []
+                print(f'( {done} / {len(items)} ) stored {stored}, failed {failed}')
+        if batch:
+            stored += write_parsed_batch(batch, delete_replay_after_parse)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print(f'Imported {stored} of {len(items)} new replays, {failed} failed')
+    if aoe_replay_stats.replay_cache is not None:
+        print(f'Replay cache: {cache_hits} hits, {cache_misses} misses')
+
+
+def copy_rows(conn, table, statement, args=(), many=False):
+    #runs one INSERT ... SELECT (or executemany) and reports how fast it went
+    start = time.perf_counter()
+    with stage_timing.stage('import_' + table):
+        if many:
+            rows = conn.executemany(statement, args).rowcount
+        else:
+            rows = conn.execute(statement, args).rowcount
+    elapsed = time.perf_counter() - start
+    print(f'{table}: copied {rows} rows in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)')
+    return rows
+
+
+def flat_match_columns():
+    #column names and select expressions for both players of a flat match
+    columns = []
+    selects = []
+    for j, alias in ((1, 'a'), (2, 'b')):
+        columns.append(f'player{j}_id')
+        selects.append(f'{alias}.player_id')
+        for k in range(32):  #number of flags
+            columns.append(f'player{j}_opening_flag{k}')
+            selects.append(f'({alias}.opening_id >> {k}) & 1')
+        columns += [f'player{j}_civilization', f'player{j}_victory',
+                    f'player{j}_parser_version']
+        selects += [f'{alias}.civilization', f'{alias}.victory',
+                    f'{alias}.parser_version']
+    return columns, selects
+
+
 def import_from_db(input_db, minimal_import, flat_import):
-    # Since we are using a global DB handle im going to do some weird hacky stuff to not rewrite routines
-    global DB_FILE
+    #Copies every match from input_db whose players are at the current parser
+    #version and have a winner, with set based statements in one transaction
     if minimal_import:
         print(f'Writing minimal_import from {input_db} to {DB_FILE}')
     elif flat_import:
@@ -527,139 +1443,140 @@ def import_from_db(input_db, minimal_import, flat_import):
     else:
         print(f'Writing from {input_db} to {DB_FILE}')
 
-    output_conn = sqlite3.connect(DB_FILE, timeout=300)
-    output_cursor = output_conn.cursor()
-    input_conn = sqlite3.connect(input_db, timeout=300)
-    input_cursor = input_conn.cursor()
-
-    #first get all matches
-    input_cursor.execute(
-        """SELECT m.id, m.average_elo, m.map_id, m.time, m.patch_id, m.ladder_id, m.patch_number from matches m
-                            JOIN match_players a on a.match_id = m.id
-                            JOIN match_players b on b.match_id = m.id
-                            WHERE a.id != b.id
-                              AND a.parser_version == ? 
-                              AND b.parser_version == ?
-                              AND a.victory = 1""",
-        (aoe_replay_stats.PARSER_VERSION, aoe_replay_stats.PARSER_VERSION))
-    matches = input_cursor.fetchall()
-
-    #now iterate through matches and add them to other db
-    i = 0
-    for match in matches:
-        if i % 50 == 0:  #throttle for speed reasons
-            print(f'( {i} / {len(matches)} )')
-        i += 1
-        match_id, average_elo, map_id, time, patch_id, ladder_id, patch_number = match
-        #Set patch to invalid if its unavailable
-        if patch_number is None:
-          patch_number = -1
-
-        #Check if match_id exists in output db
-        output_cursor.execute("SELECT * FROM matches WHERE id=?", (match_id,))
-        match = output_cursor.fetchall()
-        if not match is None and len(match):
-            continue
-
-        #now get match players
-        input_cursor.execute("SELECT * FROM match_players WHERE match_id = ?",
-                             (match_id,))
-        match_players = input_cursor.fetchall()
-
-        #Now add players to output db:
-        for match_player in match_players:
-            player_id = match_player[1]
-            output_cursor.execute("INSERT OR IGNORE INTO players(id) VALUES(?)",
-                                  (player_id,))
-        if flat_import:
-            if len(match_players) != 2:
-                print(f'Match ({match_id}): only has {len(match_players)} player(s)')
-                return
-            statement = "INSERT INTO matches(id, average_elo, map_id, patch_id, ladder_id, time, patch_number,"
-            for j in range(1,len(match_players)+1):
-              statement += f' player{j}_id,'
-              for k in range(32) : #number of flags
-                statement += f' player{j}_opening_flag{k},'
-              statement += f' player{j}_civilization,'
-              statement += f' player{j}_victory,'
-              statement += f' player{j}_parser_version,'
-            statement = statement[:-1] #remove trailing comma
-            statement += ") "
-            statement +="VALUES(?,?,?,?,?,?,?,"
-            for j in range(1,len(match_players)+1):
-              statement += f'?,'
-              for k in range(32) : #number of flags
-                statement += f'?,'
-              statement += f'?,'
-              statement += f'?,'
-              statement += f'?,'
-            statement = statement[:-1] #remove trailing comma
-            statement+= ");"
-
-            #now generate tuple
-            arguments = []
-            arguments.append(match_id)
-            arguments.append(average_elo)
-            arguments.append(map_id)
-            arguments.append(patch_id)
-            arguments.append(ladder_id)
-            arguments.append(time)
-            arguments.append(patch_number)
-            for j in range(len(match_players)):
-              arguments.append(match_players[j][1])
-              for k in range(32) : #number of flags
-                arguments.append((match_players[j][3] & 2**k) != 0)
-              arguments.append(match_players[j][4])
-              arguments.append(match_players[j][5])
-              arguments.append(match_players[j][6])
-
-            output_cursor.execute(statement, tuple(arguments))
-
-            #now do match player actions
-            for match_player in match_players:
-              match_player_id_old, player_id, match_id, opening_id, civilization, victory, parser_version, time_parsed = match_player
-              input_cursor.execute(
-                  "SELECT * FROM match_player_actions WHERE match_player_id = ?",
-                  (match_player_id_old,))
-              match_player_actions = input_cursor.fetchall()
-              for statement, args in flat_match_player_actions_generator_from_actions(
-                      match_player_actions, match_id, player_id):
-                  output_cursor.execute(statement, args)
-        else:
-            #add match
-            output_cursor.execute(
-                "INSERT OR IGNORE INTO matches(id, average_elo, map_id, patch_id, ladder_id, time, patch_number) VALUES(?,?,?,?,?,?,?)",
-                (match_id, average_elo, map_id, patch_id, ladder_id, time, patch_number))
-
-            #now get match_player actions
-            for match_player in match_players:
-                match_player_id_old, player_id, match_id, opening_id, civilization, victory, parser_version, time_parsed = match_player
-                input_cursor.execute(
-                    "SELECT * FROM match_player_actions WHERE match_player_id = ?",
-                    (match_player_id_old,))
-                match_player_actions = input_cursor.fetchall()
-
-                #now add info to real db
+    start = time.perf_counter()
+    total = 0
+    tech = aoe_replay_stats.EventType.TECH.value
+    with attached(input_db, 'source'):
+        with transaction() as conn:
+            conn.execute("DROP TABLE IF EXISTS temp.import_matches")
+            conn.execute("CREATE TEMP TABLE import_matches (id integer NOT NULL PRIMARY KEY)")
+            conn.execute(
+                """INSERT INTO temp.import_matches
+                     SELECT DISTINCT m.id FROM source.matches m
+                       JOIN source.match_players a on a.match_id = m.id
+                       JOIN source.match_players b on b.match_id = m.id
+                       WHERE a.id != b.id
+                         AND a.parser_version == ?
+                         AND b.parser_version == ?
+                         AND a.victory = 1
+                         AND m.id NOT IN (SELECT id FROM main.matches)""",
+                (aoe_replay_stats.PARSER_VERSION, aoe_replay_stats.PARSER_VERSION))
+            if flat_import:
+                #flat rows hold exactly two players
+                skipped = conn.execute(
+                    """DELETE FROM temp.import_matches WHERE id IN
+                         (SELECT match_id FROM source.match_players
+                            WHERE match_id IN (SELECT id FROM temp.import_matches)
+                            GROUP BY match_id HAVING COUNT(*) != 2)""").rowcount
+                if skipped:
+                    print(f'Skipping {skipped} matches without exactly 2 players')
+            matches = conn.execute("SELECT COUNT(*) FROM temp.import_matches").fetchone()[0]
+            source_has_action_blobs = bool(conn.execute(
+                "SELECT 1 FROM source.sqlite_master WHERE name = 'match_player_action_blobs'").fetchall())
+            print(f'{matches} matches to import')
+            #the aggregate triggers would run a self join per copied row,
+            #they are dropped for the copy and the counts rebuilt once after
+            triggers = conn.execute(
+                """SELECT name, sql FROM main.sqlite_master
+                     WHERE type = 'trigger' AND name LIKE 'opening_matchups_%'""").fetchall()
+            for name, sql in triggers:
+                conn.execute(f"DROP TRIGGER main.{name}")
+
+            total += copy_rows(conn, 'players',
+                """INSERT OR IGNORE INTO main.players(id)
+                     SELECT DISTINCT mp.player_id FROM source.match_players mp
+                       JOIN temp.import_matches i on i.id = mp.match_id""")
+
+            #Set patch to invalid if its unavailable
+            match_columns = "id, average_elo, map_id, patch_id, ladder_id, time, patch_number"
+            match_selects = """m.id, m.average_elo, m.map_id, m.patch_id, m.ladder_id, m.time,
+                               COALESCE(m.patch_number, -1)"""
+            if flat_import:
+                columns, selects = flat_match_columns()
+                total += copy_rows(conn, 'matches',
+                    f"""INSERT INTO main.matches({match_columns}, {', '.join(columns)})
+                          SELECT {match_selects}, {', '.join(selects)}
+                            FROM source.matches m
+                            JOIN temp.import_matches i on i.id = m.id
+                            JOIN source.match_players a on a.match_id = m.id
+                            JOIN source.match_players b on b.match_id = m.id AND b.id > a.id
+                            ORDER BY m.id""")
+                total += copy_rows(conn, 'match_player_actions',
+                    """INSERT OR IGNORE INTO main.match_player_actions
+                         (match_id, player_id, event_type, event_id, time, duration)
+                         SELECT mp.match_id, mp.player_id, a.event_type, a.event_id, a.time, a.duration
+                           FROM source.match_player_actions a
+                           JOIN source.match_players mp on mp.id = a.match_player_id
+                           JOIN temp.import_matches i on i.id = mp.match_id
+                           WHERE a.event_type = ?
+                           ORDER BY a.match_player_id, a.id""", (tech,))
+                if source_has_action_blobs:
+                    blobs = conn.execute(
+                        """SELECT mp.match_id, mp.player_id, b.actions
+                             FROM source.match_player_action_blobs b
+                             JOIN source.match_players mp on mp.id = b.match_player_id
+                             JOIN temp.import_matches i on i.id = mp.match_id
+                             ORDER BY mp.id""").fetchall()
+                    total += copy_rows(conn, 'match_player_actions',
+                        """INSERT OR IGNORE INTO main.match_player_actions
+                             (match_id, player_id, event_type, event_id, time, duration)
+                             VALUES (?,?,?,?,?,?)""",
+                        ((match_id, player_id) + tuple(record)
+                         for match_id, player_id, blob in blobs
+                         for record in unpack_actions(filter_packed_actions(blob, tech)).tolist()),
+                        many=True)
+            else:
+                total += copy_rows(conn, 'matches',
+                    f"""INSERT OR IGNORE INTO main.matches({match_columns})
+                          SELECT {match_selects} FROM source.matches m
+                            JOIN temp.import_matches i on i.id = m.id
+                            ORDER BY m.id""")
+                #minimal imports keep the openings, full imports get reanalysed
+                columns = ['player_id', 'match_id', 'civilization', 'victory']
                 if minimal_import:
-                    output_cursor.execute(
-                        """INSERT OR IGNORE INTO match_players(player_id, match_id, opening_id, civilization, victory, parser_version, time_parsed) VALUES
-                                          (?,?,?,?,?,?,?)""",
-                        (player_id, match_id, opening_id, civilization, victory,
-                         parser_version, time_parsed))
-                else:
-                    output_cursor.execute(
-                        """INSERT OR IGNORE INTO match_players(player_id, match_id, civilization, victory) VALUES
-                                          (?,?,?,?)""",
-                        (player_id, match_id, civilization, victory))
-
-                match_player_id = output_cursor.lastrowid
-
-                for statement, args in match_player_actions_generator_from_actions(
-                        match_player_actions, match_player_id, minimal_import):
-                    output_cursor.execute(statement, args)
-    output_conn.commit()
-    output_conn.close()
-    input_conn.close()
+                    columns += ['opening_id', 'parser_version', 'time_parsed']
+                total += copy_rows(conn, 'match_players',
+                    f"""INSERT OR IGNORE INTO main.match_players({', '.join(columns)})
+                          SELECT {', '.join('mp.' + column for column in columns)}
+                            FROM source.match_players mp
+                            JOIN temp.import_matches i on i.id = mp.match_id
+                            ORDER BY mp.id""")
+                #new match player ids are found through (player_id, match_id)
+                total += copy_rows(conn, 'match_player_actions',
+                    f"""INSERT OR IGNORE INTO main.match_player_actions
+                          (match_player_id, event_type, event_id, time, duration)
+                          SELECT new.id, a.event_type, a.event_id, a.time, a.duration
+                            FROM source.match_player_actions a
+                            JOIN source.match_players mp on mp.id = a.match_player_id
+                            JOIN temp.import_matches i on i.id = mp.match_id
+                            JOIN main.match_players new
+                              on new.player_id = mp.player_id AND new.match_id = mp.match_id
+                            {'WHERE a.event_type = ?' if minimal_import else ''}
+                            ORDER BY a.match_player_id, a.id""",
+                    (tech,) if minimal_import else ())
+                if source_has_action_blobs:
+                    #minimal imports only keep the techs of packed actions too
+                    conn.create_function('filter_packed_actions', 2, filter_packed_actions,
+                                         deterministic=True)
+                    total += copy_rows(conn, 'match_player_action_blobs',
+                        f"""INSERT OR IGNORE INTO main.match_player_action_blobs
+                              (match_player_id, actions)
+                              SELECT new.id, {'filter_packed_actions(b.actions, ?)' if minimal_import else 'b.actions'}
+                                FROM source.match_player_action_blobs b
+                                JOIN source.match_players mp on mp.id = b.match_player_id
+                                JOIN temp.import_matches i on i.id = mp.match_id
+                                JOIN main.match_players new
+                                  on new.player_id = mp.player_id AND new.match_id = mp.match_id
+                                ORDER BY b.match_player_id""",
+                        (tech,) if minimal_import else ())
+            conn.execute("DROP TABLE temp.import_matches")
+            if triggers:
+                with stage_timing.stage('import_opening_matchups'):
+                    rebuild_opening_matchups(conn)
+                for name, sql in triggers:
+                    conn.execute(sql)
+    elapsed = time.perf_counter() - start
+    print(f'Imported {matches} matches, {total} rows in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/s)')
 
 
 def slice_generator(input_list, slice_length):
@@ -667,61 +1584,39 @@ def slice_generator(input_list, slice_length):
         yield input_list[i:i + slice_length]
 
 
-def execute(input_folder, delete_replay_after_parse, analysis_only):
+def execute(input_folder, delete_replay_after_parse, analysis_only,
+            processes=None):
     #import a folder of replays, first add replays to db and then do analysis after
     if not analysis_only:
-        for file in os.listdir(input_folder):
-            file = os.path.join(input_folder, file)
-            #important info in the map name
-            match_id, player1_id, player2_id, average_elo, ladder_id = grab_replays_for_player.parse_filename(
-                file)
-            #match already in db!
-            with open(file, 'rb') as data:
-                success = parse_replay_file(match_id, player1_id, player2_id,
-                                            average_elo, ladder_id, data)
-
-            #Now delete file if flag was selected
-            if success and delete_replay_after_parse:
-                os.remove(file)
+        import_folder(input_folder, delete_replay_after_parse, processes)
 
     #now do analytics
-    items_needing_update = get_match_players_needing_update()
+    total = count_match_players_needing_update()
+    if total == 0:
+        return
     completed_count = 0
-    slice_size = 25
-    operations = []
-    #convert to slices to do operations in bulk
-    for match_players in slice_generator(items_needing_update, slice_size):
-        print(f'( {completed_count} / {len(items_needing_update)} )')
+    #actions are classified in batches, sqlite allows 32766 bound parameters
+    for match_players, actions in stream_match_players_needing_update(REANALYSIS_CHUNK_SIZE):
+        print(f'( {completed_count} / {total} )')
         #treat players opener regardless of opponent for this stage
-        match_players_actions = get_actions_for_match_players(match_players)
-        index = -1
-        for actions in match_players_actions:
-            player_event_list = []
-            events = []
-            index += 1
-            if actions is None:
-                continue
-            for action in actions:
-                events.append(
-                    aoe_replay_stats.Event(
-                        aoe_replay_stats.EventType(action[2]), action[3], None,
-                        action[4], action[5]))
-            player_event_list.append(events)
-            player_strategies = aoe_replay_stats.guess_strategy(
-                player_event_list)
-
-            #now just update match_player
-            if not player_strategies:
-              continue
-            operations.append(
-                update_match_player(player_strategies[0],
-                                    match_players[index][0]))
-        if len(operations) > 100:
-            connect_and_modify_with_list(operations)
-            operations = []
-        completed_count += slice_size
-    if len(operations):
-        connect_and_modify_with_list(operations)
+        group_ids, event_types, event_ids, times = actions
+        #match players without actions are skipped like before
+        with stage_timing.stage('classify_batch'):
+            match_player_ids, openings = aoe_replay_stats.classify_openings_batch(
+                group_ids, event_types, event_ids, times)
+        #only the bits of outdated rule groups change
+        rule_versions = get_rule_versions_for_match_players(match_players)
+        by_id = {match_player[0]: match_player for match_player in match_players}
+        merged = []
+        for match_player_id, opening in zip(match_player_ids.tolist(), openings.tolist()):
+            match_player = by_id[match_player_id]
+            mask = aoe_replay_stats.outdated_opening_mask(
+                match_player[6], rule_versions.get(match_player_id, {}))
+            merged.append(
+                aoe_replay_stats.merge_opening(match_player[3], opening, mask))
+        with stage_timing.stage('store_openings'):
+            update_match_player_openings(match_player_ids, merged)
+        completed_count += len(match_players)
 
 
 if __name__ == '__main__':
@@ -762,6 +1657,41 @@ if __name__ == '__main__':
         "--delete-replay-after-parse",
         help="If set, this will delete replays after they have been parsed",
         action='store_true')
+    parser.add_argument(
+        "-p",
+        "--processes",
+        help="Number of processes parsing replays, defaults to the cpu count",
+        type=int)
+    parser.add_argument(
+        "-c",
+        "--replay-cache",
+        help="Keep parsed replays in this folder so repeated replays aren't parsed again",
+        type=str)
+    parser.add_argument(
+        "-s",
+        "--selective-decoding",
+        help="Only decode the actions openings are built from, skip the rest",
+        action='store_true')
+    parser.add_argument(
+        "-w",
+        "--wal",
+        help="Use the WAL storage profile so readers and other writers aren't blocked",
+        action='store_true')
+    parser.add_argument(
+        "-k",
+        "--compact-actions",
+        help="Store new actions as one packed blob per match player",
+        action='store_true')
+    parser.add_argument(
+        "-K",
+        "--convert-actions",
+        help="Move all action rows of the db into packed blobs and exit",
+        action='store_true')
+    parser.add_argument(
+        "-t",
+        "--timing",
+        help="Print per stage timings at exit (or on SIGUSR1)",
+        action='store_true')
 
     args = parser.parse_args()
     DB_FILE = args.output_db
@@ -773,12 +1703,25 @@ if __name__ == '__main__':
     elif args.flat_import_from_other_db is not None:
         args.import_from_other_db = args.flat_import_from_other_db
         flat_import = True
+    if args.timing:
+        stage_timing.enable()
+    if args.wal:
+        enable_wal_profile()
+    if args.compact_actions:
+        COMPACT_ACTIONS = True
     if flat_import:
       init_flat_db()
     else:
       init_db()
       update_schema()
 
+    if args.convert_actions:
+        convert_to_compact_actions()
+        sys.exit(0)
     if args.import_from_other_db is not None:
         import_from_db(args.import_from_other_db, minimal_import, flat_import)
-    execute(args.input, args.delete_replay_after_parse, args.analysis_only)
+    aoe_replay_stats.SELECTIVE_DECODING = args.selective_decoding
+    if args.replay_cache is not None:
+        aoe_replay_stats.enable_replay_cache(args.replay_cache)
+    execute(args.input, args.delete_replay_after_parse, args.analysis_only,
+            args.processes)
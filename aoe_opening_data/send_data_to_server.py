@@ -1,7 +1,6 @@
 import os
 import json
 import requests
-import sqlite3
 import time
 import re
 import math
@@ -74,7 +73,8 @@ def send_matches_to_server():
   last_match_time = r.json()['time']
   last_match_datetime = datetime.strptime(last_match_time, '%Y-%m-%dT%H:%M:%S%z')
   print('last_match_time: ', last_match_time, type(last_match_time), last_match_datetime)
-  conn = sqlite3.connect(parse_replays_and_store_in_db.DB_FILE)
+  # shared read connection, with the WAL profile this reads alongside writers
+  conn = parse_replays_and_store_in_db.get_read_connection()
   cursor = conn.cursor()
   start = time.time()
   # get matches that are not currently on the server
@@ -150,7 +150,6 @@ def send_matches_to_server():
     count += 1
     print('sleeping 1s')
     time.sleep(1)
-  conn.close()
 
 if __name__ == '__main__':
   #do stuff
@@ -0,0 +1,168 @@
+import atexit
+import math
+import os
+import signal
+import sys
+import time
+from contextlib import contextmanager
+
+# Per stage wall/cpu time and byte counts for every replay, off unless
+# enable() is called or AOE_STAGE_TIMING is set. Samples go into power of two
+# histograms (in microseconds) so a long run costs a few ints per stage
+
+ENABLED = False
+
+stages = {}
+
+
+class StageStats:
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytes = 0
+        self.histogram = {}
+
+    def add(self, wall, cpu, nbytes):
+        self.count += 1
+        self.wall += wall
+        self.cpu += cpu
+        self.bytes += nbytes
+        bucket = math.frexp(wall * 1000000)[1]
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.bytes += other.bytes
+        for bucket, count in other.histogram.items():
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + count
+
+    def percentile(self, fraction):
+        # upper edge of the bucket holding the sample, in millis
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= fraction * self.count:
+                return 2**bucket / 1000
+        return 0
+
+
+def record(name, wall, cpu=0.0, nbytes=0):
+    if name not in stages:
+        stages[name] = StageStats()
+    stages[name].add(wall, cpu, nbytes)
+
+
+class Sample:
+    # what a stage block yields, set bytes when they are only known at the end
+    __slots__ = ('bytes',)
+
+    def __init__(self, nbytes=0):
+        self.bytes = nbytes
+
+
+@contextmanager
+def stage(name, nbytes=0):
+    sample = Sample(nbytes)
+    if not ENABLED:
+        yield sample
+        return
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield sample
+    finally:
+        record(name, time.perf_counter() - wall, time.process_time() - cpu,
+               sample.bytes)
+
+
+def timed_iter(name, iterable, nbytes=0):
+    # Times only what happens inside the iterable (a lazy op loop for
+    # example) and records it as one sample once it is exhausted. Disabled it
+    # hands the iterable straight back
+    if not ENABLED:
+        return iterable
+    return _timed_iter(name, iter(iterable), nbytes)
+
+
+def _timed_iter(name, iterator, nbytes):
+    wall = 0.0
+    cpu = 0.0
+    try:
+        while True:
+            start_wall = time.perf_counter()
+            start_cpu = time.process_time()
+            try:
+                item = next(iterator)
+            finally:
+                wall += time.perf_counter() - start_wall
+                cpu += time.process_time() - start_cpu
+            yield item
+    except StopIteration:
+        pass
+    finally:
+        record(name, wall, cpu, nbytes)
+
+
+def take():
+    # Hands back and clears what this process recorded, used to ship worker
+    # timings to the parent which merge()s them
+    global stages
+    taken = stages
+    stages = {}
+    return taken
+
+
+def merge(taken):
+    for name, stats in taken.items():
+        if name not in stages:
+            stages[name] = StageStats()
+        stages[name].merge(stats)
+
+
+def reset():
+    stages.clear()
+
+
+def report(file=None):
+    if file is None:
+        file = sys.stderr
+    if not stages:
+        return
+    file.write(f'{"stage":<20}{"count":>8}{"total s":>10}{"cpu s":>10}'
+               f'{"mean ms":>10}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}'
+               f'{"MB/s":>10}\n')
+    for name, stats in stages.items():
+        mean = stats.wall / stats.count * 1000 if stats.count else 0
+        rate = stats.bytes / stats.wall / 1000000 if stats.wall and stats.bytes else 0
+        file.write(f'{name:<20}{stats.count:>8}{stats.wall:>10.2f}'
+                   f'{stats.cpu:>10.2f}{mean:>10.2f}'
+                   f'{stats.percentile(0.5):>10.2f}'
+                   f'{stats.percentile(0.9):>10.2f}'
+                   f'{stats.percentile(0.99):>10.2f}{rate:>10.2f}\n')
+    file.flush()
+
+
+def enable(dump_at_exit=True):
+    # SIGUSR1 dumps the report while running, where the platform has it and
+    # nothing else handles it already
+    global ENABLED
+    ENABLED = True
+    if dump_at_exit:
+        atexit.register(report)
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    if signal.getsignal(signal.SIGUSR1) not in (signal.SIG_DFL, None):
+        return
+    try:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: report())
+    except ValueError:
+        #not the main thread
+        pass
+
+
+if os.environ.get('AOE_STAGE_TIMING'):
+    enable()
@@ -13,6 +13,7 @@ setup(
     install_requires=[
       'construct==2.8.16',
       'mgz>=1.7.5',
+      'numpy>=1.21',
       'python-dotenv==0.20.0',
       'requests==2.27.1',
     ],
@@ -0,0 +1,106 @@
+import os
+import random
+import struct
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+# the scripts import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                'aoe_opening_data'))
+
+import aoe_replay_stats
+import parse_replays_and_store_in_db
+from mgz import fast
+
+
+def sync_op(increment):
+    # the next op id doubles as the marker that ends a short sync
+    return struct.pack('<II', fast.Operation.SYNC.value, increment)
+
+
+def action_op(action, payload):
+    return (struct.pack('<IIB', fast.Operation.ACTION.value, len(payload) + 1,
+                        action.value) + payload + struct.pack('<I', 0))
+
+
+def research_op(player_id, technology_id):
+    return action_op(fast.Action.RESEARCH,
+                     struct.pack('<3xIhh', 0, player_id, technology_id))
+
+
+def resign_op(player_id):
+    return action_op(fast.Action.RESIGN, struct.pack('<b3x', player_id))
+
+
+def move_op(player_id, object_id):
+    return action_op(fast.Action.MOVE, struct.pack('<b6xI2fI', player_id, 1,
+                                                   10.0, 20.0, object_id))
+
+
+def build_op(player_id, building_id):
+    return action_op(fast.Action.BUILD, struct.pack('<bh2fI', 0, player_id,
+                                                    10.0, 20.0, building_id))
+
+
+def queue_op(player_id, unit_id, object_id):
+    # DE queue, the fourth byte is the number of object ids
+    return action_op(fast.Action.DE_QUEUE, struct.pack(
+        '<b2xBxhbxI', player_id, 1, unit_id, 1, object_id))
+
+
+def tribute_op(player_id, player_id_to, food):
+    return action_op(fast.Action.DE_TRIBUTE, struct.pack(
+        '<bbbiffff', player_id, player_id_to, 0, 0, 0.0, food, 0.0, 0.0))
+
+
+def write_matches(count, seed=1, openings=(1, 2, 4, 5),
+                  elos=(-30, -10, 0, 990, 1000.5)):
+    # count random 1v1 matches with their openings classified
+    P = parse_replays_and_store_in_db
+    r = random.Random(seed)
+    parsed = []
+    for m in range(count):
+        players = [P.ParsedMatchPlayer(r.randint(1, 50) + k * 100,
+                                       r.randint(1, 5), r.choice([-1, 0, 1]),
+                                       1000, []) for k in range(2)]
+        parsed.append(P.ParsedMatch(1000 + m, r.choice(elos),
+                                    r.choice([9, 29]), 62.0, 3, 1,
+                                    [player.player_id for player in players],
+                                    players))
+    with P.transaction() as conn:
+        P.write_parsed_matches(parsed, conn)
+    ids = [id for id, in P.get_read_connection().execute(
+        "SELECT id FROM match_players ORDER BY id")]
+    P.update_match_player_openings(ids, [r.choice(openings) for _ in ids])
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    # a fresh, fully updated db that every helper points at
+    monkeypatch.setattr(parse_replays_and_store_in_db, 'DB_FILE',
+                        str(tmp_path / 'test.db'))
+    parse_replays_and_store_in_db.init_db()
+    parse_replays_and_store_in_db.update_schema()
+    yield parse_replays_and_store_in_db.DB_FILE
+    parse_replays_and_store_in_db.close_connections()
+
+
+@pytest.fixture
+def fake_header(monkeypatch):
+    # Replays here are bare op streams, the header parse and the log meta are
+    # replaced. DE headers always carry 8 player slots, num_players says how
+    # many are used
+    def install(num_players, civ_ids=(1, 2)):
+        players = [SimpleNamespace(civ_id=civ_id) for civ_id in civ_ids]
+        players += [SimpleNamespace(civ_id=0)] * (8 - len(players))
+        h = SimpleNamespace(
+            de=SimpleNamespace(players=players, num_players=num_players,
+                               selected_map_id=9),
+            save_version=61.5)
+        monkeypatch.setattr(aoe_replay_stats, 'header', SimpleNamespace(
+            parse_stream=lambda data: h))
+    monkeypatch.setattr(aoe_replay_stats.fast, 'meta', lambda data: None)
+    monkeypatch.setattr(aoe_replay_stats, 'replay_cache', None)
+    return install
@@ -0,0 +1,328 @@
+import io
+import struct
+from types import SimpleNamespace
+
+import pytest
+from construct import ConstructError
+from mgz.common.map import get_map_data
+from mgz.util import Version
+
+import aoe_replay_stats
+from conftest import (build_op, move_op, queue_op, research_op, resign_op,
+                      sync_op, tribute_op)
+
+
+def two_player_body():
+    # both players reach imp early, then a long tail of research clicks and a
+    # resignation at the end
+    body = research_op(1, 101) + research_op(2, 101) + sync_op(1000)
+    body += research_op(1, 103) + research_op(2, 103) + sync_op(1000)
+    for i in range(200):
+        body += research_op(1 + i % 2, 22) + sync_op(1000)
+    return body + resign_op(2)
+
+
+def stream(body, **cutoffs):
+    h, actions = aoe_replay_stats.stream_actions(body, **cutoffs)
+    return list(actions)
+
+
+# imp research time, an age counts for the cutoff once it has finished
+IMP_TIME = aoe_replay_stats.lookup_event(aoe_replay_stats.EventType.TECH,
+                                         103).duration
+
+
+def times(actions):
+    return [time for o, time in actions]
+
+
+def test_age_cutoff_stops_decoding_two_player_replay(fake_header):
+    fake_header(2)
+    assert len(stream(two_player_body())) == 205
+    cut = stream(two_player_body(), cutoff_age=3)
+    # the four age ups, the clicks until imp lands 190s after the 1s clicks
+    # and the resignation found by the cheap scan
+    assert len(cut) == 4 + (1000 + IMP_TIME - 2000) // 1000 + 1
+    assert max(times(cut[:-1])) < 1000 + IMP_TIME
+    assert cut[-1][0][1][0] == aoe_replay_stats.fast.Action.RESIGN
+
+
+def test_age_cutoff_waits_for_every_player(fake_header):
+    fake_header(2)
+    body = research_op(1, 103) + sync_op(1000) + research_op(2, 22)
+    body += sync_op(1000) + research_op(2, 103) + sync_op(IMP_TIME - 1)
+    body += research_op(1, 22) + sync_op(1) + research_op(2, 22)
+    # player 1 is in imp before player 2's research finishes
+    assert len(stream(body, cutoff_age=3)) == 4
+
+
+def test_age_cutoff_restarts_on_requeued_age_up(fake_header):
+    fake_header(2)
+    # player 1 clicks imp, cancels it and clicks again 60s later, a click
+    # each second after that until 300s
+    body = research_op(1, 103) + research_op(2, 103)
+    for second in range(1, 300):
+        body += sync_op(1000)
+        if second == 60:
+            body += research_op(1, 103)
+        body += research_op(2, 22)
+    # cut right before the second click finishes, nothing after it is kept
+    expected = [0, 0]
+    for second in range(1, 60 + IMP_TIME // 1000):
+        expected += [second * 1000] * (2 if second == 60 else 1)
+    assert times(stream(body, cutoff_age=3)) == expected
+
+
+def test_time_cutoff(fake_header):
+    fake_header(2)
+    # the age ups, the clicks up to 10s and the resignation
+    assert len(stream(two_player_body(), cutoff_time=10500)) == 4 + 9 + 1
+
+
+def test_parse_replay_loser_ids_survive_cutoff(fake_header):
+    fake_header(2)
+    players, h, civs, loser_ids = aoe_replay_stats.parse_replay(
+        two_player_body(), cutoff_age=3)
+    assert loser_ids == [2]
+    assert [event.id for event in players[1]] == [101, 103, 22]
+    assert [event.id for event in players[2]] == [101, 103, 22, 0]
+
+
+def mixed_body():
+    # every action iter_events knows next to moves, which it doesn't
+    body = b''
+    for second in range(20):
+        player_id = 1 + second % 2
+        body += move_op(player_id, 70 + second)
+        body += queue_op(player_id, aoe_replay_stats.UNIT_IDS['Villager'], 5)
+        if second % 3 == 0:
+            body += build_op(player_id, aoe_replay_stats.BUILDING_IDS['Mill'])
+        if second % 4 == 0:
+            body += research_op(player_id, 22)
+        if second % 5 == 0:
+            body += tribute_op(player_id, 3 - player_id, 100.0)
+        body += move_op(player_id, 90 + second) + sync_op(1000)
+    return body + resign_op(2)
+
+
+def decoded_events(data, selective):
+    h, actions = aoe_replay_stats.stream_actions(data, selective=selective)
+    return list(aoe_replay_stats.iter_events(actions))
+
+
+@pytest.mark.parametrize('as_file', [False, True])
+def test_selective_decoding_matches_full_decoding(fake_header, tmp_path,
+                                                  as_file):
+    fake_header(2)
+    body = mixed_body()
+    data = body
+    if as_file:
+        data = tmp_path / 'mixed.aoe2record'
+        data.write_bytes(body)
+    events = decoded_events(data, False)
+    assert ({event.event_type for player_id, event in events} ==
+            set(aoe_replay_stats.EventType))
+    assert decoded_events(data, True) == events
+
+
+@pytest.mark.parametrize('as_file', [False, True])
+def test_selective_decoding_of_truncated_replays(fake_header, tmp_path,
+                                                 as_file):
+    # cut anywhere, the selective decoder stops with the events and the
+    # error the full one does
+    fake_header(2)
+    body = mixed_body()[:700]
+    path = tmp_path / 'truncated.aoe2record'
+    for end in range(len(body)):
+        data = body[:end]
+        if as_file:
+            path.write_bytes(data)
+            data = path
+        results = []
+        for selective in (False, True):
+            try:
+                results.append(decoded_events(data, selective))
+            except EOFError:
+                results.append(EOFError)
+        assert results[0] == results[1], end
+
+
+def map_header(map_id, instructions):
+    stats = SimpleNamespace(player_stats={})
+    return SimpleNamespace(
+        version=Version.DE, hd=None,
+        de=SimpleNamespace(resolved_map_id=map_id, dlc_ids=[]),
+        initial=SimpleNamespace(players=[SimpleNamespace(attributes=stats)]),
+        scenario=SimpleNamespace(messages=SimpleNamespace(
+            instructions=instructions)))
+
+
+def summary_map_name(h):
+    # what FullSummary.get_map() reports for the same header fields
+    reference = aoe_replay_stats.get_map_reference(h)
+    return get_map_data(h.de.resolved_map_id,
+                        h.scenario.messages.instructions, 1, h.version, 100,
+                        reference, [(0, 0)])[0]['name']
+
+
+@pytest.mark.parametrize('map_id, instructions, name', [
+    (9, b'Map Type: Arabia.rms\n', 'Arabia'),
+    # a builtin id missing from const.DE_MAP_NAMES
+    (34, b'Map Type: Something else.rms\n', 'Canals'),
+    # custom maps keep the rms name without the userpatch modes
+    (59, b'Map Type: My Map: !PG.rms\n', 'My Map'),
+])
+def test_map_name_matches_summary(map_id, instructions, name):
+    h = map_header(map_id, instructions)
+    assert aoe_replay_stats.get_map_name(h) == name
+    assert summary_map_name(h) == name
+
+
+def test_unknown_builtin_map_raises_like_summary():
+    h = map_header(9999, b'Map Type: Mystery.rms\n')
+    with pytest.raises(ValueError):
+        summary_map_name(h)
+    with pytest.raises(ValueError):
+        aoe_replay_stats.get_map_name(h)
+
+
+@pytest.fixture
+def metadata_header(monkeypatch):
+    # read_replay_metadata over a fake header, the replay starts with the
+    # length of the header counting the length itself. Returns the header
+    # parses done so far
+    parses = []
+    player = SimpleNamespace(name=SimpleNamespace(value=b'Alice'), civ_id=1,
+                             color_id=0, resolved_team_id=1)
+
+    def install(map_id, instructions):
+        h = map_header(map_id, instructions)
+        h.de.selected_map_id = map_id
+        h.de.players = [player]
+        h.de.num_players = 1
+        h.save_version = 61.5
+        monkeypatch.setattr(aoe_replay_stats, 'header', SimpleNamespace(
+            parse_stream=lambda data: parses.append(data) or h))
+    monkeypatch.setattr(aoe_replay_stats, 'metadata_cache',
+                        aoe_replay_stats.OrderedDict())
+    return install, parses
+
+
+def test_metadata_is_parsed_once_however_it_is_passed(metadata_header,
+                                                      tmp_path):
+    install, parses = metadata_header
+    install(9, b'Map Type: Arabia.rms\n')
+    replay = struct.pack('<I', 12) + b'header!!' + b'body'
+    path = tmp_path / 'game.aoe2record'
+    path.write_bytes(replay)
+    results = [aoe_replay_stats.read_replay_metadata(data) for data in
+               (str(path), replay, bytearray(replay), memoryview(replay),
+                io.BytesIO(replay))]
+    assert len(parses) == 1
+    assert results == [results[0]] * 5
+    assert results[0].map_name == 'Arabia'
+    assert results[0].players[0].civ_id == 1
+    # a different header is parsed on its own
+    aoe_replay_stats.read_replay_metadata(
+        struct.pack('<I', 12) + b'header??' + b'body')
+    assert len(parses) == 2
+
+
+@pytest.mark.parametrize('map_id, instructions', [
+    (9999, b'Map Type: Mystery.rms\n'),
+    (9, b'\x00'),
+])
+def test_metadata_without_a_map_name(metadata_header, map_id, instructions):
+    install, parses = metadata_header
+    install(map_id, instructions)
+    metadata = aoe_replay_stats.read_replay_metadata(
+        struct.pack('<I', 8) + b'head')
+    assert metadata.map_name is None
+    assert metadata.map_id == map_id
+    assert metadata.save_version == 61.5
+
+
+@pytest.fixture
+def mapped(monkeypatch):
+    # every stream open_replay maps, to check they get closed again
+    streams = []
+    map_file = aoe_replay_stats.map_file
+
+    def record(fileno):
+        stream, eof = map_file(fileno)
+        streams.append(stream)
+        return stream, eof
+    monkeypatch.setattr(aoe_replay_stats, 'map_file', record)
+    return streams
+
+
+def test_parse_replay_unmaps_the_file(fake_header, mapped, tmp_path):
+    fake_header(2)
+    path = tmp_path / 'replay.aoe2record'
+    path.write_bytes(two_player_body())
+    players, h, civs, loser_ids = aoe_replay_stats.parse_replay(str(path))
+    assert loser_ids == [2]
+    with open(path, 'rb') as f:
+        aoe_replay_stats.parse_replay(f)
+    assert len(mapped) == 2
+    assert all(stream.closed for stream in mapped)
+
+
+def test_streamed_actions_unmap_once_read(fake_header, mapped, tmp_path):
+    fake_header(2)
+    path = tmp_path / 'replay.aoe2record'
+    path.write_bytes(two_player_body())
+    h, actions = aoe_replay_stats.stream_actions(str(path))
+    next(actions)
+    assert not mapped[0].closed
+    assert len(list(actions)) == 204
+    assert mapped[0].closed
+
+
+def test_empty_replay_file_fails_like_truncated_bytes(mapped, tmp_path):
+    path = tmp_path / 'empty.aoe2record'
+    path.write_bytes(b'')
+    with pytest.raises(ConstructError):
+        aoe_replay_stats.parse_replay(b'')
+    with pytest.raises(ConstructError):
+        aoe_replay_stats.parse_replay(str(path))
+    assert all(stream.closed for stream in mapped)
+
+
+def test_cache_hit_returns_header_summary(fake_header, monkeypatch, tmp_path):
+    fake_header(2, civ_ids=(3, 4))
+    parse_stream = aoe_replay_stats.header.parse_stream
+    parsed = []
+    monkeypatch.setattr(aoe_replay_stats.header, 'parse_stream',
+                        lambda data: parsed.append(data) or parse_stream(data))
+    aoe_replay_stats.enable_replay_cache(str(tmp_path / 'cache'))
+    miss = aoe_replay_stats.parse_replay(two_player_body(), cutoff_age=3)
+    hit = aoe_replay_stats.parse_replay(two_player_body(), cutoff_age=3)
+    assert aoe_replay_stats.take_cache_counts() == (1, 1)
+    # only the miss read the header
+    assert len(parsed) == 1
+    h = hit[1]
+    assert isinstance(h, aoe_replay_stats.HeaderSummary)
+    assert h.save_version == miss[1].save_version
+    assert h.de.selected_map_id == miss[1].de.selected_map_id
+    assert ([player.civ_id for player in h.de.players] ==
+            [player.civ_id for player in miss[1].de.players])
+    assert hit[3] == miss[3] == [2]
+    assert ([[event.id for event in player] for player in hit[0]] ==
+            [[event.id for event in player] for player in miss[0]])
+
+
+def test_failed_cache_write_leaves_no_temp_file(fake_header, monkeypatch,
+                                                tmp_path, capsys):
+    fake_header(2)
+    cache = aoe_replay_stats.enable_replay_cache(str(tmp_path / 'cache'))
+
+    def replace(source, target):
+        raise OSError('disk full')
+    monkeypatch.setattr(aoe_replay_stats.os, 'replace', replace)
+    players, h, civs, loser_ids = aoe_replay_stats.parse_replay(
+        two_player_body())
+    assert loser_ids == [2]
+    assert list((tmp_path / 'cache').iterdir()) == []
+    assert cache.size == 0
+    assert 'disk full' in capsys.readouterr().err
@@ -0,0 +1,22 @@
+import parse_replays_and_store_in_db as P
+
+
+def test_schema_setup_leaves_foreign_keys_at_the_default(db):
+    # the shared write connection must not enforce more than a fresh one
+    fresh = P.open_connection()
+    default = fresh.execute("PRAGMA foreign_keys").fetchone()
+    fresh.close()
+    assert P.get_write_connection().execute("PRAGMA foreign_keys").fetchone() == default
+    with P.transaction() as conn:
+        conn.execute("""INSERT INTO match_player_actions
+                          (match_player_id, event_type, event_id, time, duration)
+                          VALUES (12345, 3, 101, 0, 0)""")
+
+
+def test_transactions_share_the_write_connection(db):
+    with P.transaction() as outer:
+        with P.transaction() as inner:
+            assert inner is outer
+            inner.execute("INSERT INTO players(id) VALUES (1)")
+        assert outer.in_transaction
+    assert P.get_read_connection().execute("SELECT id FROM players").fetchall() == [(1,)]
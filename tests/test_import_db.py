@@ -0,0 +1,81 @@
+import sqlite3
+
+import pytest
+
+import parse_replays_and_store_in_db as P
+from aoe_replay_stats import TECH_IDS, UNIT_IDS, Event, EventType
+from conftest import write_matches
+from test_opening_matchups import assert_matches_rebuild
+
+ACTIONS = [Event(EventType.TECH, TECH_IDS['Feudal Age'], 'Feudal Age', 500000,
+                 130000),
+           Event(EventType.UNIT, UNIT_IDS['Villager'], 'Villager', 10000,
+                 25000),
+           Event(EventType.TECH, TECH_IDS['Loom'], 'Loom', 40000, 25000)]
+
+
+@pytest.fixture
+def source(db, tmp_path, monkeypatch):
+    # 60 matches with three actions per player, the import then runs into a
+    # fresh db that already holds a few of them
+    write_matches(60)
+    ids = [id for id, in P.get_read_connection().execute(
+        "SELECT id FROM match_players")]
+    with P.transaction() as conn:
+        for match_player_id in ids:
+            P.add_match_player_actions(match_player_id, ACTIONS, conn)
+    P.close_connections()
+    monkeypatch.setattr(P, 'DB_FILE', str(tmp_path / 'output.db'))
+    return db
+
+
+def count(table, where=''):
+    return P.get_read_connection().execute(
+        f"SELECT COUNT(*) FROM {table} {where}").fetchone()[0]
+
+
+def eligible(source):
+    # matches with a winner, every player is at the parser version
+    conn = sqlite3.connect(source)
+    match_ids = {id for id, in conn.execute(
+        "SELECT match_id FROM match_players WHERE victory = 1")}
+    conn.close()
+    return match_ids
+
+
+@pytest.mark.parametrize('minimal', [False, True])
+def test_import_keeps_the_aggregates(source, monkeypatch, minimal):
+    P.init_db()
+    P.update_schema()
+    write_matches(5, seed=2)
+    # the triggers present as each table is copied
+    triggers = []
+    copy_rows = P.copy_rows
+
+    def record(conn, *args, **kwargs):
+        triggers.append(conn.execute(
+            "SELECT COUNT(*) FROM main.sqlite_master WHERE type = 'trigger'"
+            ).fetchone()[0])
+        return copy_rows(conn, *args, **kwargs)
+    monkeypatch.setattr(P, 'copy_rows', record)
+    P.import_from_db(source, minimal, False)
+    assert triggers and not any(triggers)
+    match_ids = eligible(source) | set(range(1000, 1005))
+    assert count('matches') == len(match_ids)
+    assert count('match_players') == 2 * len(match_ids)
+    imported = 2 * len(eligible(source) - set(range(1000, 1005)))
+    # minimal imports keep only the techs
+    assert count('match_player_actions') == imported * (2 if minimal else 3)
+    # the triggers are back and the counts cover old and new matches
+    assert count('sqlite_master', "WHERE type = 'trigger'") == 8
+    cells = assert_matches_rebuild()
+    assert sum(cell[-5] for cell in cells) == 2 * len(match_ids)
+
+
+def test_flat_import(source):
+    P.init_flat_db()
+    P.import_from_db(source, False, True)
+    match_ids = eligible(source)
+    assert count('matches') == len(match_ids)
+    assert count('players') > 0
+    assert count('match_player_actions') == 2 * 2 * len(match_ids)
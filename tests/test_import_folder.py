@@ -0,0 +1,52 @@
+import multiprocessing
+
+import aoe_replay_stats
+import parse_replays_and_store_in_db as P
+from conftest import research_op, resign_op, sync_op
+
+
+def write_replays(folder, bodies):
+    for match_id, body in bodies.items():
+        (folder / f'{match_id}_{match_id + 1}_vs_{match_id + 2}-1000(3).aoe2record').write_bytes(body)
+
+
+def test_import_folder_reports_replay_cache_counts(db, fake_header, tmp_path, capsys):
+    fake_header(2)
+    aoe_replay_stats.enable_replay_cache(str(tmp_path / 'cache'))
+    folder = tmp_path / 'replays'
+    folder.mkdir()
+    body = research_op(1, 101) + sync_op(1000) + resign_op(2)
+    # the same replay under two match ids is one miss and one hit
+    write_replays(folder, {100: body, 200: body, 300: body + research_op(2, 101)})
+    P.import_folder(str(folder), False, processes=1)
+    out = capsys.readouterr().out
+    assert 'Imported 3 of 3 new replays, 0 failed' in out
+    assert 'Replay cache: 1 hits, 2 misses' in out
+    assert aoe_replay_stats.take_cache_counts() == (0, 0)
+    # the cache hit takes civilizations and the map from the header summary
+    rows = P.get_read_connection().execute(
+        """SELECT match_id, civilization, victory, map_id FROM match_players
+             JOIN matches ON matches.id = match_id ORDER BY match_id, player_id""").fetchall()
+    assert rows == [(100, 1, 1, 9), (100, 2, 0, 9), (200, 1, 1, 9),
+                    (200, 2, 0, 9), (300, 1, 1, 9), (300, 2, 0, 9)]
+
+
+def worker_settings():
+    return P.import_worker_settings()
+
+
+def test_spawned_workers_get_the_import_settings(tmp_path, monkeypatch):
+    monkeypatch.setattr(aoe_replay_stats, 'SELECTIVE_DECODING', True)
+    monkeypatch.setattr(aoe_replay_stats, 'replay_cache', None)
+    monkeypatch.setattr(P, 'COMPACT_ACTIONS', True)
+    aoe_replay_stats.enable_replay_cache(str(tmp_path / 'cache'), 1 << 20)
+    settings = P.import_worker_settings()
+    assert settings[:3] == (True, (str(tmp_path / 'cache'), 1 << 20), True)
+    # a spawned process starts from the module defaults, only the
+    # initializer carries the settings over
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        assert pool.apply(worker_settings) != settings
+    with context.Pool(1, initializer=P.init_import_worker,
+                      initargs=settings) as pool:
+        assert pool.apply(worker_settings) == settings
@@ -0,0 +1,44 @@
+import sqlite3
+
+import pytest
+
+import parse_replays_and_store_in_db as P
+
+
+@pytest.fixture
+def queries(db):
+    # SELECTs against matches on the read connection
+    statements = []
+    conn = P.get_read_connection()
+    conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, P.MAX_BOUND_PARAMETERS)
+    conn.set_trace_callback(statements.append)
+    P.load_match_index()
+    statements.clear()
+    yield lambda: [s for s in statements if 'FROM matches' in s]
+    conn.set_trace_callback(None)
+
+
+def test_ids_stored_elsewhere_are_checked_together(db, queries):
+    # another process stores every even match after the index was loaded
+    other = sqlite3.connect(db)
+    with other:
+        other.executemany(
+            "INSERT INTO matches (id, average_elo, map_id) VALUES (?, 1000, 9)",
+            [(match_id,) for match_id in range(2, 1201, 2)])
+    other.close()
+    match_ids = list(range(1200, 0, -1))
+    assert P.filter_unknown(match_ids) == list(range(1199, 0, -2))
+    # 1200 ids in two statements, not one per id
+    assert len(queries()) == 2
+    assert P.filter_unknown(range(2, 1201, 2)) == []
+    assert len(queries()) == 2
+
+
+def test_stored_matches_join_the_index(db, queries):
+    players = [P.ParsedMatchPlayer(k + 1, 1, k, 1000, []) for k in range(2)]
+    parsed = P.ParsedMatch(7, 1000, 9, 62.0, 3, 1, [1, 2], players)
+    assert P.write_parsed_batch([('7.aoe2record', parsed)], False) == 1
+    count = len(queries())
+    assert P.does_match_exist(7)
+    assert P.filter_unknown([7, 8]) == [8]
+    assert len(queries()) == count + 1
@@ -0,0 +1,201 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+import parse_replays_and_store_in_db as P
+
+MATCHES = 700
+
+
+def player_actions(match_id, k):
+    # a tech, a unit and a building per match player, ids tied to the player
+    return [(3, 100 + k, match_id, 10), (1, match_id % 7, match_id + 1, 0),
+            (2, k, match_id + 2, 0)]
+
+
+@pytest.fixture
+def matches(db, monkeypatch):
+    # 1400 match players, the first half with action rows and the second
+    # half packed. Statements are held to the old 999 parameter limit
+    expected = {}
+    for compact in (False, True):
+        monkeypatch.setattr(P, 'COMPACT_ACTIONS', compact)
+        parsed = []
+        for m in range(MATCHES // 2):
+            match_id = m + (MATCHES // 2 if compact else 0)
+            players = [P.ParsedMatchPlayer(k + 1, 1, k, 1000,
+                                           player_actions(match_id, k))
+                       for k in range(2)]
+            parsed.append(P.ParsedMatch(match_id, 1000, 9, 62.0, 3, 1,
+                                        [1, 2], players))
+        with P.transaction() as conn:
+            P.write_parsed_matches(parsed, conn)
+    for conn in (P.get_read_connection(), P.get_write_connection()):
+        conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, P.MAX_BOUND_PARAMETERS)
+    for match_player_id, match_id, player_id in P.get_read_connection().execute(
+            "SELECT id, match_id, player_id FROM match_players"):
+        expected[match_player_id] = player_actions(match_id, player_id - 1)
+    return expected
+
+
+def test_id_filters_stay_under_the_parameter_limit():
+    ids = list(range(1, 3001))
+    filters = list(P.id_filters('id', ids))
+    assert filters == [('id BETWEEN ? AND ?', [1, 999]),
+                       ('id BETWEEN ? AND ?', [1000, 1998]),
+                       ('id BETWEEN ? AND ?', [1999, 2997]),
+                       ('id BETWEEN ? AND ?', [2998, 3000])]
+    sparse = list(P.id_filters('id', ids[::2], reserved=9))
+    assert [len(args) for condition, args in sparse] == [990, 510]
+    assert all(condition.startswith('id IN (') for condition, args in sparse)
+
+
+def expected_arrays(expected, ids, event_type=None, event_ids=None):
+    rows = [(match_player_id,) + action
+            for match_player_id in sorted(ids)
+            for action in expected[match_player_id]
+            if (event_type is None or action[0] == event_type)
+            and (event_ids is None or action[1] in event_ids)]
+    return [list(column) for column in zip(*rows)]
+
+
+@pytest.mark.parametrize('step', [1, 3])
+@pytest.mark.parametrize('event_type, event_ids', [
+    (None, None), (3, None), (3, [100]), (None, [0, 1, 2])])
+def test_get_action_arrays_both_layouts(matches, step, event_type, event_ids):
+    ids = sorted(matches)[::step]
+    arrays = P.get_action_arrays(ids, event_type, event_ids)
+    assert [column.tolist() for column in arrays] == expected_arrays(
+        matches, ids, event_type, event_ids)
+
+
+def test_get_action_arrays_any_id_order(matches):
+    ids = sorted(matches)[::5]
+    arrays = P.get_action_arrays(ids[::-1] + ids[:10])
+    assert [column.tolist() for column in arrays] == expected_arrays(matches, ids)
+
+
+def test_convert_to_compact_actions_in_chunks(matches):
+    before = P.get_action_arrays(sorted(matches))
+    P.convert_to_compact_actions(chunk_size=1200)
+    conn = P.get_read_connection()
+    assert conn.execute("SELECT COUNT(*) FROM match_player_actions").fetchone()[0] == 0
+    assert conn.execute(
+        "SELECT COUNT(*) FROM match_player_action_blobs").fetchone()[0] == len(matches)
+    after = P.get_action_arrays(sorted(matches))
+    assert all(np.array_equal(a, b) for a, b in zip(before, after))
+
+
+def test_get_rule_versions_for_match_players(matches):
+    ids = sorted(matches)
+    P.update_match_player_openings(ids[:1200], [1] * 1200)
+    # only rules past the base version get a row
+    current = {rule: version for rule, (version, mask)
+               in P.aoe_replay_stats.OPENING_RULE_VERSIONS.items()
+               if version != P.aoe_replay_stats.BASE_RULE_VERSION}
+    assert current
+    match_players = [(match_player_id,) for match_player_id in ids]
+    assert P.get_rule_versions_for_match_players(match_players) == {
+        match_player_id: current for match_player_id in ids[:1200]}
+    sparse = match_players[::3]
+    assert P.get_rule_versions_for_match_players(sparse) == {
+        match_player_id: current for match_player_id, in sparse
+        if match_player_id in ids[:1200]}
+
+
+def test_get_actions_for_match_players_keeps_page_order(matches):
+    # only the first half is stored as rows
+    row_ids = sorted(matches)[:MATCHES]
+    page = [(match_player_id,) for match_player_id in row_ids[::-2] + row_ids[:1100]]
+    actions = P.get_actions_for_match_players(page)
+    assert [[row[2:] for row in rows] for rows in actions] == [
+        matches[match_player_id] for match_player_id, in page]
+
+
+def test_stream_match_players_needing_update_pages(matches):
+    ids = sorted(matches)
+    P.update_match_player_openings(ids[::2], [1] * len(ids[::2]))
+    pages = list(P.stream_match_players_needing_update(400))
+    assert [len(match_players) for match_players, actions in pages] == [400, 300]
+    streamed = [match_player[0] for match_players, actions in pages
+                for match_player in match_players]
+    assert streamed == ids[1::2]
+    assert P.count_match_players_needing_update() == len(streamed)
+    group_ids = np.concatenate([actions[0] for match_players, actions in pages])
+    assert np.array_equal(np.unique(group_ids), streamed)
+
+
+def test_update_match_player_openings_skips_base_versions(matches, monkeypatch):
+    ids = sorted(matches)[:10]
+    versions = dict(P.aoe_replay_stats.OPENING_RULE_VERSIONS)
+    versions['maa'] = (3, versions['maa'][1])
+    monkeypatch.setattr(P.aoe_replay_stats, 'OPENING_RULE_VERSIONS', versions)
+    P.update_match_player_openings(ids, [1] * len(ids))
+    conn = P.get_read_connection()
+    rules = conn.execute(
+        "SELECT DISTINCT rule FROM opening_rule_versions ORDER BY rule").fetchall()
+    assert rules == [('feudal_towers',), ('maa',)]
+    assert conn.execute("SELECT COUNT(*) FROM opening_rule_versions").fetchone()[0] == 20
+    # classifying again updates the rows in place
+    versions['maa'] = (4, versions['maa'][1])
+    P.update_match_player_openings(ids, [1] * len(ids))
+    assert P.get_rule_versions_for_match_players([(i,) for i in ids]) == {
+        i: {'feudal_towers': 2, 'maa': 4} for i in ids}
+    assert P.count_match_players_needing_update() == len(matches) - len(ids)
+
+
+def odd_actions(match_id, k):
+    # what parse_match stores for events with negative and missing values: a
+    # tribute's data isn't kept, an unknown id and a cancel can go negative
+    Event, EventType = P.aoe_replay_stats.Event, P.aoe_replay_stats.EventType
+    tribute = P.aoe_replay_stats.Tribute(2 - k, 100.0, 0.0, 0.0, 0.0)
+    events = [Event(EventType.TECH, 101, None, match_id * 1000, 130000),
+              Event(EventType.TRIBUTE, 0, 'Tribute', match_id, data=tribute),
+              Event(EventType.UNIT, -1, None, -match_id, -k - 1),
+              Event(EventType.BUILDING, 12, None, 2**31 - 1, -2**31)]
+    return [(event.event_type.value, event.id, event.timestamp, event.duration)
+            for event in events]
+
+
+def test_pack_actions_round_trip():
+    actions = odd_actions(7, 1)
+    assert actions[1] == (P.aoe_replay_stats.EventType.TRIBUTE.value, 0, 7, 0)
+    blob = P.pack_actions(actions)
+    assert len(blob) == len(actions) * P.ACTION_RECORD.itemsize
+    assert [tuple(record) for record in P.unpack_actions(blob).tolist()] == actions
+    assert P.unpack_actions(P.pack_actions([])).tolist() == []
+    techs = P.filter_packed_actions(blob, 3)
+    assert [tuple(record) for record in P.unpack_actions(techs).tolist()] == actions[:1]
+    # a duration has to be known, the action rows don't take NULL either
+    with pytest.raises(TypeError):
+        P.pack_actions([(1, 83, 5, None)])
+
+
+def test_convert_to_compact_actions_keeps_odd_values(db, monkeypatch):
+    # the same actions written as rows and as blobs, then all converted
+    for compact in (False, True):
+        monkeypatch.setattr(P, 'COMPACT_ACTIONS', compact)
+        parsed = []
+        for m in range(20):
+            match_id = m + (20 if compact else 0)
+            players = [P.ParsedMatchPlayer(k + 1, 1, k, 1000,
+                                           odd_actions(m, k))
+                       for k in range(2)]
+            parsed.append(P.ParsedMatch(match_id, 1000, 9, 62.0, 3, 1,
+                                        [1, 2], players))
+        with P.transaction() as conn:
+            P.write_parsed_matches(parsed, conn)
+    expected = {}
+    for match_player_id, match_id, player_id in P.get_read_connection().execute(
+            "SELECT id, match_id, player_id FROM match_players"):
+        expected[match_player_id] = odd_actions(match_id % 20, player_id - 1)
+    ids = sorted(expected)
+    before = P.get_action_arrays(ids)
+    assert [column.tolist() for column in before] == expected_arrays(expected, ids)
+    P.convert_to_compact_actions(chunk_size=7)
+    assert P.get_read_connection().execute(
+        "SELECT COUNT(*) FROM match_player_actions").fetchone()[0] == 0
+    after = P.get_action_arrays(ids)
+    assert all(np.array_equal(a, b) for a, b in zip(before, after))
+    assert all(a.dtype == b.dtype for a, b in zip(before, after))
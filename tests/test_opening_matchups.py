@@ -0,0 +1,75 @@
+import sqlite3
+
+import pytest
+
+import parse_replays_and_store_in_db as P
+from conftest import write_matches
+
+ELOS = [-1000, -60, -50, -25.5, -25, -24.5, -10, -0.5, 0, 0.5, 10, 24.999, 25,
+        25.001, 1000, 1012.5, 1025, 1987.25]
+
+
+@pytest.mark.parametrize('elo', ELOS)
+def test_elo_bucket_matches_sql(elo):
+    conn = sqlite3.connect(':memory:')
+    assert conn.execute(f"SELECT {P.elo_bucket_sql('elo')} FROM (SELECT ? AS elo)",
+                        (elo,)).fetchone()[0] == P.elo_bucket(elo)
+
+
+def test_elo_bucket_matches_sql_for_integer_columns():
+    # integer division in sql truncates, the column type must not matter
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE t (elo integer)")
+    conn.executemany("INSERT INTO t VALUES (?)", [(elo,) for elo in range(-80, 80)])
+    for elo, bucket in conn.execute(f"SELECT elo, {P.elo_bucket_sql('elo')} FROM t"):
+        assert bucket == P.elo_bucket(elo), elo
+
+
+def cells(conn):
+    return sorted(conn.execute(
+        f"""SELECT {P.OPENING_MATCHUP_COLUMNS}, games, a_wins, a_losses,
+                   a_unknown, b_wins
+              FROM opening_matchup_counts"""), key=repr)
+
+
+def assert_matches_rebuild():
+    conn = P.get_read_connection()
+    incremental = cells(conn)
+    with P.transaction() as write:
+        P.rebuild_opening_matchups(write)
+    assert incremental == cells(conn)
+    return incremental
+
+
+def test_triggers_follow_inserts_and_player_updates(db):
+    write_matches(40)
+    assert len(assert_matches_rebuild()) > 0
+    with P.transaction() as conn:
+        conn.execute("UPDATE match_players SET victory = 1 - victory WHERE id % 3 = 0")
+        conn.execute("DELETE FROM match_players WHERE id % 7 = 0")
+        conn.execute("DELETE FROM matches WHERE id % 5 = 0")
+    assert_matches_rebuild()
+
+
+def test_triggers_follow_match_updates(db):
+    write_matches(40)
+    with P.transaction() as conn:
+        conn.execute("UPDATE matches SET average_elo = -average_elo - 12 WHERE id % 2 = 0")
+        conn.execute("UPDATE matches SET map_id = 33, ladder_id = 13 WHERE id % 3 = 0")
+        conn.execute("UPDATE matches SET patch_id = 61.5 WHERE id % 4 = 0")
+    assert_matches_rebuild()
+
+
+def test_changed_triggers_are_replaced_and_rebuilt(db):
+    write_matches(10)
+    with P.transaction() as conn:
+        conn.execute("DROP TRIGGER opening_matchups_match_update_old")
+        conn.execute("""CREATE TRIGGER opening_matchups_match_update_old
+                          BEFORE UPDATE ON matches BEGIN SELECT 1; END""")
+        conn.execute("DELETE FROM opening_matchup_counts")
+    P.init_opening_matchups()
+    sql = P.get_read_connection().execute(
+        """SELECT sql FROM sqlite_master
+             WHERE name = 'opening_matchups_match_update_old'""").fetchone()[0]
+    assert 'opening_matchup_counts' in sql
+    assert len(assert_matches_rebuild()) > 0
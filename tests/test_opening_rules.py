@@ -0,0 +1,214 @@
+import random
+
+import pytest
+
+import aoe_replay_stats as S
+from aoe_replay_stats import Event, EventType, OpeningType
+
+
+def old_guess_strategy(player):
+    # The name based classifier the rule table replaced, as it was before
+    # except for the tower check which compared against "Tower", a name no
+    # building has
+    openings = 0
+    current_age = 0
+    mill_built = False
+    opening_found = False
+    has_archers = False
+    has_scouts = False
+    has_skirms = False
+    barracks_before_mill = False
+    for event in player:
+        if event.event_type == EventType.TECH:
+            if event.name == "Feudal Age":
+                current_age = 1
+            elif event.name == "Castle Age":
+                current_age = 2
+                if event.timestamp < 920000:
+                    openings |= OpeningType.FastCastle.value
+            elif event.name == "Imperial Age":
+                break
+            elif event.name == "Crossbowman":
+                if current_age == 2:
+                    openings |= OpeningType.CastleCrossbows.value
+            elif event.name == "Elite Skirmisher":
+                if current_age == 2:
+                    openings |= OpeningType.CastleEliteSkirm.value
+            elif event.name == "Pikeman":
+                if current_age == 2:
+                    openings |= OpeningType.CastlePikemen.value
+            elif event.name == "Eagle Warrior":
+                if current_age == 2:
+                    openings |= OpeningType.CastleEagles.value
+            elif event.name == "Man-at-Arms":
+                if current_age == 1 and (openings == 0x1 or openings == 0x2):
+                    openings |= OpeningType.Maa.value
+        elif event.event_type == EventType.BUILDING:
+            if event.name == "Mill":
+                mill_built = True
+            if event.name == "Barracks":
+                barracks_before_mill = not mill_built
+            if event.name == "Watch Tower":
+                if current_age == 1:
+                    openings |= OpeningType.FeudalTowers.value
+        elif event.event_type == EventType.UNIT:
+            if event.name == "Militia":
+                if opening_found:
+                    continue
+                if current_age == 0 and barracks_before_mill:
+                    openings |= OpeningType.PremillDrush.value
+                elif current_age == 0:
+                    openings |= OpeningType.PostmillDrush.value
+                elif current_age == 1:
+                    openings |= OpeningType.Maa.value
+                opening_found = True
+            elif event.name in ("Archer", "Scout", "Skirmisher"):
+                if event.name == "Archer":
+                    if has_archers:
+                        continue
+                    has_archers = True
+                    flags = (OpeningType.FeudalArcherOpening.value,
+                             OpeningType.FeudalArcherFollowup.value)
+                elif event.name == "Scout":
+                    if has_scouts:
+                        continue
+                    has_scouts = True
+                    flags = (OpeningType.FeudalScoutOpening.value,
+                             OpeningType.FeudalScoutFollowup.value)
+                else:
+                    if has_skirms:
+                        continue
+                    has_skirms = True
+                    flags = (OpeningType.FeudalSkirmOpening.value,
+                             OpeningType.FeudalSkirmFollowup.value)
+                if current_age == 1:
+                    openings |= flags[1] if opening_found else flags[0]
+                opening_found = True
+            elif event.name == "Eagle":
+                if current_age == 1:
+                    openings |= OpeningType.FeudalEagles.value
+                opening_found = True
+            elif event.name == "Knight":
+                if current_age == 2:
+                    openings |= OpeningType.CastleKnights.value
+            elif event.name == "Camel":
+                if current_age == 2:
+                    openings |= OpeningType.CastleCamels.value
+            elif event.name in ("Mangonel", "Scorpion", "Battering Ram"):
+                if current_age == 2:
+                    openings |= OpeningType.CastleSiege.value
+            elif event.id in S.ID_UNIQUE_UNITS:
+                if current_age == 2:
+                    openings |= OpeningType.CastleUU.value
+    if openings == 0:
+        openings = OpeningType.DidNothing.value
+    return openings
+
+
+# every id a rule fires on plus a few that none do, towers are listed on
+# their own since the rule table used to miss them
+VOCABULARY = sorted(S.OPENING_TRANSITIONS) + [
+    (EventType.BUILDING.value, S.BUILDING_IDS["Watch Tower"]),
+    (EventType.UNIT.value, S.UNIT_IDS["Villager"]),
+    (EventType.BUILDING.value, S.BUILDING_IDS["Market"]),
+    (EventType.TECH.value, S.TECH_IDS["Loom"]),
+]
+# ages are clicked far more often than anything else in a real opening
+AGES = [(EventType.TECH.value, S.TECH_IDS[age])
+        for age in ("Feudal Age", "Castle Age", "Imperial Age")]
+
+
+def generated_actions(rng):
+    # (event type value, id, timestamp) in time order, ages in order so most
+    # sequences get past dark age
+    actions = []
+    timestamp = 0
+    ages = list(AGES)
+    for i in range(rng.randrange(0, 40)):
+        timestamp += rng.randrange(0, 60000)
+        if ages and rng.random() < 0.15:
+            event_type, id = ages.pop(0)
+        else:
+            event_type, id = rng.choice(VOCABULARY)
+        actions.append((event_type, id, timestamp))
+    return actions
+
+
+def events(actions):
+    return [Event(EventType(event_type), id,
+                  S.lookup_event(EventType(event_type), id).name, timestamp)
+            for event_type, id, timestamp in actions]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_rule_table_matches_old_guess_strategy(seed):
+    rng = random.Random(seed)
+    for _ in range(200):
+        actions = generated_actions(rng)
+        assert (S.classify_opening(actions) ==
+                old_guess_strategy(events(actions))), actions
+
+
+def test_feudal_towers():
+    tower = S.BUILDING_IDS["Watch Tower"]
+    actions = [(EventType.TECH.value, S.TECH_IDS["Feudal Age"], 500000),
+               (EventType.BUILDING.value, tower, 600000)]
+    assert S.classify_opening(actions) == OpeningType.FeudalTowers.value
+    # only a feudal age tower counts
+    assert (S.classify_opening(actions[1:]) ==
+            OpeningType.DidNothing.value)
+
+
+def batch(groups):
+    # classify_openings_batch over {group id: actions}, back as a dict
+    rows = [(group_id,) + action for group_id, actions in groups.items()
+            for action in actions]
+    columns = [list(column) for column in zip(*rows)] or [[], [], [], []]
+    group_ids, openings = S.classify_openings_batch(*columns)
+    return dict(zip(group_ids.tolist(), openings.tolist()))
+
+
+TECH = EventType.TECH.value
+UNIT = EventType.UNIT.value
+CASTLE = S.TECH_IDS["Castle Age"]
+FEUDAL = S.TECH_IDS["Feudal Age"]
+
+
+@pytest.mark.parametrize('actions', [
+    # nothing any rule looks at
+    [(UNIT, S.UNIT_IDS["Villager"], 0)],
+    [(UNIT, S.UNIT_IDS["Villager"], 0), (TECH, S.TECH_IDS["Loom"], 10)],
+    # a single event
+    [(TECH, FEUDAL, 0)],
+    [(UNIT, S.UNIT_IDS["Militia"], 0)],
+    [(TECH, S.TECH_IDS["Imperial Age"], 0)],
+    # clicked exactly at and right before the fast castle time
+    [(TECH, FEUDAL, 0), (TECH, CASTLE, S.FAST_CASTLE_TIME)],
+    [(TECH, FEUDAL, 0), (TECH, CASTLE, S.FAST_CASTLE_TIME - 1)],
+    # several events at the same time
+    [(TECH, FEUDAL, 5), (UNIT, S.UNIT_IDS["Archer"], 5),
+     (UNIT, S.UNIT_IDS["Scout"], 5), (UNIT, S.UNIT_IDS["Archer"], 5)],
+])
+def test_batch_matches_classify_opening(actions):
+    expected = S.classify_opening(actions)
+    assert batch({7: actions}) == {7: expected}
+    # and the same next to groups without rule events
+    villager = [(UNIT, S.UNIT_IDS["Villager"], 0)]
+    assert batch({6: villager, 7: actions, 8: villager}) == {
+        6: OpeningType.DidNothing.value, 7: expected,
+        8: OpeningType.DidNothing.value}
+
+
+def test_batch_of_nothing():
+    assert batch({}) == {}
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_batch_matches_classify_opening_per_group(seed):
+    rng = random.Random(seed)
+    groups = {group_id: generated_actions(rng) for group_id in range(300)}
+    # a player without actions has no rows and so no group
+    groups = {group_id: actions for group_id, actions in groups.items()
+              if actions}
+    assert batch(groups) == {group_id: S.classify_opening(actions)
+                             for group_id, actions in groups.items()}
@@ -0,0 +1,80 @@
+import pytest
+
+import create_statistics as C
+import parse_replays_and_store_in_db as P
+from aoe_replay_stats import OpeningType
+from conftest import write_matches
+
+OPENINGS = (OpeningType.PremillDrush.value, OpeningType.FeudalScoutOpening.value,
+            OpeningType.PremillDrushFC.value, OpeningType.MaaArchers.value,
+            OpeningType.ScoutsSkirms.value, OpeningType.PremillDrushMaa.value)
+
+# (minimum elo, maximum elo, map ids, include civs, clamp civs, no mirror,
+#  exclude civs, ladders, patches, players, techs) as create_statistics
+#  takes them from the command line
+FILTERS = {
+    'everything': (0, 9999, None, [], [], False, [], None, None, None, None),
+    'narrow elo': (1000, 1100, None, [], [], False, [], None, None, None, None),
+    'map ladder patch': (900, 1500, [[9]], [], [], False, [], [[3]], [['62.0']],
+                         None, [[22]]),
+    'include civs': (0, 9999, None, [1, 2], [], True, [], None, None, None,
+                     None),
+    'clamp and exclude civs': (0, 9999, [[9, 29]], [], [2, 3, 4], False, [5],
+                               None, None, None, None),
+    'players': (0, 9999, None, [], [], False, [], None, None, [[101, 120, 150]],
+                None),
+}
+
+
+@pytest.fixture
+def stats_db(db, monkeypatch):
+    # the curated indexes over 200 matches spread from 800 to 2000 elo, every
+    # query create_statistics sends is explained first
+    P.init_indexes()
+    write_matches(200, openings=OPENINGS, elos=tuple(range(800, 2000, 10)))
+    monkeypatch.setattr(C, 'elo_shares', {})
+    monkeypatch.setattr(C, 'aggregate_filters', {})
+    monkeypatch.setattr(P, 'CHECK_QUERY_PLANS', True)
+    return db
+
+
+def test_both_elo_paths_are_covered(stats_db):
+    # wide ranges hide the elo index behind a unary +, narrow ones use it
+    assert not C.elo_index_helps(0, 9999)
+    assert C.elo_index_helps(1000, 1100)
+
+
+@pytest.mark.parametrize('aggregates', [False, True])
+@pytest.mark.parametrize('name', FILTERS)
+def test_statistics_queries_use_indexes(stats_db, monkeypatch, capsys,
+                                        aggregates, name):
+    monkeypatch.setattr(C, 'USE_AGGREGATES', aggregates)
+    filters = FILTERS[name]
+    # every report section runs, not just the match count
+    assert C.total_concluded_matches(*filters[:-1]) > 0
+    C.execute(*filters)
+    assert 'Civilization Stats!' in capsys.readouterr().out
+
+
+def test_dropped_index_fails_the_check(stats_db, monkeypatch):
+    monkeypatch.setattr(C, 'USE_AGGREGATES', False)
+    with P.transaction() as conn:
+        conn.execute("DROP INDEX idx_match_players_match")
+    with pytest.raises(P.QueryPlanError):
+        C.execute(*FILTERS['everything'])
+
+
+def test_init_db_alone_indexes_match_players(tmp_path, monkeypatch):
+    # a db that never went through update_schema still joins players by match
+    monkeypatch.setattr(P, 'DB_FILE', str(tmp_path / 'fresh.db'))
+    P.init_db()
+    try:
+        with P.transaction() as conn:
+            names = {row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'")}
+            assert 'idx_match_players_match' in names
+            P.check_query_plan(conn, """SELECT b.opening_id FROM matches m
+                JOIN match_players b ON b.match_id = m.id
+                WHERE m.id = ?""", (1,))
+    finally:
+        P.close_connections()
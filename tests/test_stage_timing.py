@@ -0,0 +1,103 @@
+import io
+import signal
+import time
+
+import pytest
+
+import stage_timing
+
+
+@pytest.fixture
+def timing(monkeypatch):
+    # enabled, with nothing recorded yet and the module state put back after
+    monkeypatch.setattr(stage_timing, 'ENABLED', True)
+    monkeypatch.setattr(stage_timing, 'stages', {})
+    return stage_timing
+
+
+def test_stage_records_time_and_bytes(timing):
+    for nbytes in (100, 300):
+        with timing.stage('header', nbytes):
+            time.sleep(0.001)
+    with timing.stage('header') as sample:
+        sample.bytes = 600
+    stats = timing.stages['header']
+    assert stats.count == 3
+    assert stats.bytes == 1000
+    assert stats.wall >= 0.002
+    assert sum(stats.histogram.values()) == 3
+    assert stats.percentile(0.5) >= 1
+
+
+def test_stage_is_free_when_disabled(timing, monkeypatch):
+    monkeypatch.setattr(stage_timing, 'ENABLED', False)
+    with timing.stage('header', 100) as sample:
+        sample.bytes = 200
+    items = [1, 2]
+    assert timing.timed_iter('op_loop', items) is items
+    assert timing.stages == {}
+
+
+def test_timed_iter_times_only_the_iterable(timing):
+    def slow():
+        for i in range(3):
+            time.sleep(0.005)
+            yield i
+
+    items = []
+    for item in timing.timed_iter('op_loop', slow(), 50):
+        # the consumer's time isn't the iterable's
+        time.sleep(0.05)
+        items.append(item)
+    assert items == [0, 1, 2]
+    stats = timing.stages['op_loop']
+    assert stats.count == 1
+    assert stats.bytes == 50
+    assert 0.015 <= stats.wall < 0.15
+
+
+def test_timed_iter_records_a_closed_iterator(timing):
+    items = timing.timed_iter('op_loop', iter(range(10)))
+    next(items)
+    items.close()
+    assert timing.stages['op_loop'].count == 1
+
+
+def test_merge_adds_up_worker_stages(timing):
+    timing.record('header', 0.001, nbytes=10)
+    timing.record('meta', 0.002)
+    worker = timing.take()
+    assert timing.stages == {}
+    timing.record('header', 0.004, nbytes=30)
+    timing.merge(worker)
+    timing.merge({'op_loop': worker['meta']})
+    header = timing.stages['header']
+    assert (header.count, header.bytes) == (2, 40)
+    assert header.wall == pytest.approx(0.005)
+    assert sum(header.histogram.values()) == 2
+    assert set(timing.stages) == {'header', 'meta', 'op_loop'}
+    out = io.StringIO()
+    timing.report(out)
+    assert len(out.getvalue().splitlines()) == 4
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason='no SIGUSR1')
+def test_enable_keeps_an_existing_signal_handler(timing):
+    def handler(signum, frame):
+        pass
+
+    previous = signal.signal(signal.SIGUSR1, handler)
+    try:
+        timing.enable(dump_at_exit=False)
+        assert signal.getsignal(signal.SIGUSR1) is handler
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        timing.enable(dump_at_exit=False)
+        assert signal.getsignal(signal.SIGUSR1) is not signal.SIG_DFL
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+
+
+def test_enable_without_sigusr1(timing, monkeypatch):
+    monkeypatch.delattr(signal, 'SIGUSR1', raising=False)
+    timing.enable(dump_at_exit=False)
+    assert timing.ENABLED
@@ -0,0 +1,83 @@
+import random
+
+import pytest
+
+import create_statistics as C
+import parse_replays_and_store_in_db as P
+from aoe_replay_stats import OpeningType
+from conftest import write_matches
+from test_query_plans import FILTERS
+
+
+def opening_ids(seed):
+    # one to three flags or'ed together, so strategies with exclusions and
+    # several inclusions match some players and miss others
+    r = random.Random(seed)
+    flags = [opening.value for opening in OpeningType]
+    return tuple(sum(set(r.sample(flags, r.randint(1, 3)))) for i in range(60))
+
+
+@pytest.fixture
+def matchup_db(db, monkeypatch):
+    P.init_indexes()
+    write_matches(300, openings=opening_ids(3) + (OpeningType.DidNothing.value,),
+                  elos=tuple(range(800, 2000, 10)))
+    monkeypatch.setattr(C, 'elo_shares', {})
+    monkeypatch.setattr(C, 'aggregate_filters', {})
+    return db
+
+
+def strategy_condition(tag, strategy):
+    # inclusions or'ed and exclusions and'ed, as the per pair queries did
+    inclusions = ' OR '.join(f'(({tag}.opening_id & {i}) = {i})'
+                             for i in strategy[1])
+    exclusions = ' AND '.join(f'(NOT ({tag}.opening_id & {i}))'
+                              for i in strategy[2])
+    return f'({inclusions}) AND ({exclusions})'
+
+
+def pair_query(select, condition, filters):
+    return f"""SELECT {select}
+                 FROM matches m
+                 JOIN match_players a ON a.match_id = m.id
+                 JOIN match_players b ON b.match_id = m.id
+                 WHERE {condition} AND a.id != b.id AND """ + \
+        C.arguments_to_query_string(
+            'm', 'a', 'b', *filters[:9], filters[3] or filters[9] is not None,
+            filters[9])
+
+
+def opening_matchups(first, second, filters):
+    # the query strategy_matchup_matrix replaced, one per strategy pair
+    return P.connect_and_return(pair_query(
+        """sum(CASE WHEN a.victory = 1 OR a.victory = 0 THEN 1 ELSE 0 END),
+           sum(CASE WHEN a.victory = 1 THEN 1 ELSE 0 END),
+           sum(CASE WHEN b.victory = 1 THEN 1 ELSE 0 END),
+           sum(CASE WHEN a.victory = -1 THEN 1 ELSE 0 END)""",
+        strategy_condition('a', first) + ' AND ' +
+        strategy_condition('b', second), filters), ())[0]
+
+
+def mirror_matchups(strategy, filters):
+    return P.connect_and_return(pair_query(
+        'COUNT(a.id)', strategy_condition('a', strategy) + ' AND a.victory = 1',
+        filters), ())[0][0]
+
+
+@pytest.mark.parametrize('aggregates', [False, True])
+@pytest.mark.parametrize('name', FILTERS)
+def test_matrix_matches_per_pair_queries(matchup_db, monkeypatch, aggregates,
+                                         name):
+    monkeypatch.setattr(C, 'USE_AGGREGATES', aggregates)
+    filters = FILTERS[name][:-1]
+    total, firstwins, secondwins, unknown, mirrors = C.strategy_matchup_matrix(
+        *filters)
+    strategies = C.Allowed_Strategies
+    assert sum(map(sum, total)) > 0
+    for i, first in enumerate(strategies):
+        assert mirrors[i] == mirror_matchups(first, filters), first[0]
+        for j, second in enumerate(strategies):
+            expected = [count or 0 for count in
+                        opening_matchups(first, second, filters)]
+            assert [total[i][j], firstwins[i][j], secondwins[i][j],
+                    unknown[i][j]] == expected, (first[0], second[0])